@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+audio_dsp.py - NumPy signal processing for call audio
+Mixing and limiting, reblocking and resampling, shared by the relay's
+per-room mixer and AudioEngine.
+
+Mixing is N-1: every frame of a tick is stacked into one preallocated 2-D
+array, the room total is summed once, and each speaker's mix is the total
+minus their own row. Nobody hears themselves, and no voice is scaled down
+as the room grows; instead a soft limiter leaves normal levels untouched
+and bends only the peaks that would otherwise clip.
+
+Everything downstream of the microphone works in 20 ms frames at 16 kHz.
+A Reblocker cuts whatever block size a device or a TCP client delivers into
+those frames, and a polyphase Resampler converts devices that run at
+44.1 or 48 kHz to and from 16 kHz in NumPy, instead of leaving it to PortAudio.
+
+A VoiceDetector decides per frame whether anyone is talking, so open but
+silent microphones send nothing, and ComfortNoise fills the silence on the
+receiving end at the level the sender reported.
+"""
+
+import collections
+import math
+from typing import Optional, Sequence
+
+from backend.audio_transport import FRAME_SIZE, SAMPLE_RATE, get_numpy
+
+FULL_SCALE = 32767.0
+KNEE = 16384.0  # -6 dBFS: below this the limiter is transparent
+
+
+def soft_limit(samples, knee: float = KNEE):
+    """Float samples -> int16, compressing anything above knee along a tanh curve.
+
+    Levels under the knee pass through unchanged and the curve approaches
+    full scale without ever reaching it, so there is no hard clip. samples
+    is modified in place.
+    """
+    np = get_numpy()
+    if samples.size and max(samples.max(), -samples.min()) > knee:
+        headroom = FULL_SCALE - knee
+        over = np.abs(samples) > knee
+        loud = samples[over]
+        samples[over] = np.sign(loud) * (knee + headroom * np.tanh((np.abs(loud) - knee) / headroom))
+    return samples.astype(np.int16)
+
+
+class Mixer:
+    """N-1 mixer with preallocated scratch space that grows with the room"""
+
+    def __init__(self, frame_size: int = FRAME_SIZE, capacity: int = 8):
+        self.frame_size = frame_size
+        self._allocate(capacity)
+
+    def _allocate(self, capacity: int):
+        np = get_numpy()
+        self.capacity = capacity
+        # Rows 0..n-1: speakers' frames; row n: the total (what non-speakers hear)
+        self.stack = np.zeros((capacity, self.frame_size), dtype=np.float32)
+        self.out = np.zeros((capacity + 1, self.frame_size), dtype=np.float32)
+
+    def _load(self, frames: Sequence):
+        n = len(frames)
+        if n > self.capacity:
+            self._allocate(max(n, 2 * self.capacity))
+        stack = self.stack[:n]
+        for row, frame in zip(stack, frames):
+            length = min(len(frame), self.frame_size)
+            row[:length] = frame[:length]
+            row[length:] = 0
+        return stack
+
+    def mix(self, frames: Sequence):
+        """(n+1, frame_size) int16 for n frames: row i is everyone but speaker i, row n is everyone.
+
+        One allocation per call, for the result; its rows are safe to hand to
+        other threads.
+        """
+        np = get_numpy()
+        n = len(frames)
+        stack = self._load(frames)
+        out = self.out[:n + 1]
+        np.sum(stack, axis=0, out=out[n])
+        np.subtract(out[n], stack, out=out[:n])
+        return soft_limit(out)
+
+    def mix_all(self, frames: Sequence):
+        """Everyone together, for a listener who is not one of the speakers"""
+        stack = self._load(frames)
+        return soft_limit(stack.sum(axis=0))
+
+
+class Reblocker:
+    """Cuts a stream of arbitrarily sized sample blocks into fixed frames"""
+
+    def __init__(self, frame_size: int = FRAME_SIZE, max_block: int = 4096):
+        np = get_numpy()
+        self.frame_size = frame_size
+        self.buffer = np.zeros(frame_size + max_block, dtype=np.int16)
+        self.fill = 0  # Samples in the buffer
+        self.start = 0  # Samples already handed out as frames by the last push
+
+    @property
+    def pending(self) -> int:
+        """Samples waiting for the rest of their frame"""
+        return self.fill - self.start
+
+    def push(self, samples):
+        """Append int16 samples; returns a (k, frame_size) view of the k whole frames now complete.
+
+        The view is only valid until the next push.
+        """
+        np = get_numpy()
+        leftover = self.fill - self.start
+        if self.start:
+            # Less than a frame left over, always from beyond the first frame: no overlap
+            self.buffer[:leftover] = self.buffer[self.start:self.fill]
+        self.fill, self.start = leftover, 0
+
+        end = self.fill + len(samples)
+        if end > len(self.buffer):
+            grown = np.zeros(end + self.frame_size, dtype=np.int16)
+            grown[:self.fill] = self.buffer[:self.fill]
+            self.buffer = grown
+        self.buffer[self.fill:end] = samples
+        self.fill = end
+
+        count = self.fill // self.frame_size
+        self.start = count * self.frame_size
+        return self.buffer[:self.start].reshape(count, self.frame_size)
+
+    def reset(self):
+        self.fill = self.start = 0
+
+
+class Resampler:
+    """Streaming polyphase resampler between two fixed rates (e.g. 48000 -> 16000).
+
+    A Kaiser-windowed sinc low-pass at the lower of the two Nyquist rates is
+    split into one short filter per phase, so each output sample costs one
+    phase's worth of multiply-adds (about taps * the decimation factor)
+    whatever the ratio. Blocks may be any size; filter history carries over
+    between them.
+    """
+
+    def __init__(self, from_rate: int, to_rate: int, taps: int = 16):
+        np = get_numpy()
+        g = math.gcd(int(from_rate), int(to_rate))
+        self.up, self.down = int(to_rate) // g, int(from_rate) // g
+        # taps per cycle of the slower rate, so the transition band is the same width either way
+        self.taps = taps = max(2, math.ceil(taps * max(self.up, self.down) / self.up))
+        length = self.up * taps
+        cutoff = 0.45 / max(self.up, self.down)  # Cycles per sample at the upsampled rate, 10% roll-off
+        n = np.arange(length) - (length - 1) / 2
+        h = 2 * cutoff * np.sinc(2 * cutoff * n) * np.kaiser(length, 8.0) * self.up
+        # phases[p, k] = h[p + k * up]; columns reversed so a row meets history oldest-first
+        self.phases = h.reshape(taps, self.up).T[:, ::-1].astype(np.float32)
+        self.history = np.zeros(taps - 1, dtype=np.float32)
+        self.consumed = 0  # Input samples seen so far
+        self.produced = 0  # Output samples emitted so far
+
+    @property
+    def passthrough(self) -> bool:
+        return self.up == self.down
+
+    def process(self, block):
+        """int16 samples at from_rate in, int16 samples at to_rate out"""
+        np = get_numpy()
+        if self.passthrough:
+            return block
+        signal = np.concatenate((self.history, np.asarray(block, dtype=np.float32)))
+        available = self.consumed + len(block)
+        # Output m reads input samples m*down//up - taps + 1 .. m*down//up; emit all that are complete
+        last = (available * self.up - 1) // self.down
+        m = np.arange(self.produced, last + 1, dtype=np.int64)
+        position = m * self.down
+        newest = position // self.up - (self.consumed - self.taps + 1)
+        windows = signal[newest[:, None] + np.arange(-self.taps + 1, 1)]
+        out = np.einsum('ij,ij->i', windows, self.phases[position % self.up])
+
+        self.history = signal[len(signal) - self.taps + 1:]
+        self.consumed = available
+        self.produced = last + 1
+        return np.clip(np.rint(out), -32768, 32767).astype(np.int16)
+
+
+class VoiceDetector:
+    """Energy and zero-crossing voice activity detection with hangover.
+
+    A frame is loud when its energy is MARGIN_DB above the noise floor, which
+    follows the quietest frame of the last FLOOR_WINDOW: speech dips to the
+    background between words, a fan that switches on does not. Loud frames with a voice-like zero-crossing rate count as speech;
+    noise-like ones (fans, hiss, keyboard) only when twice as far above the
+    floor, which keeps strong fricatives. Speech keeps the detector active
+    for HANGOVER_FRAMES more frames so word endings and short pauses go out.
+    """
+
+    MARGIN_DB = 9.0
+    MIN_SPEECH_DB = -55.0  # Quieter than this is never speech, whatever the floor
+    NOISE_ZCR = 0.3  # Zero crossings per sample above which a frame sounds like noise
+    HANGOVER_FRAMES = 15  # 300 ms
+    FLOOR_WINDOW = 100  # 2 s
+    FLOOR_RISE_DB = 0.5  # Per frame, towards the window minimum once the room got louder
+    INITIAL_FLOOR_DB = -70.0  # Start low and learn upwards, so the first words are never the floor
+
+    def __init__(self):
+        self.floor_db = self.INITIAL_FLOOR_DB
+        self.recent = collections.deque(maxlen=self.FLOOR_WINDOW)
+        self.hangover = 0
+        self.active = False
+
+    @property
+    def noise_rms(self) -> int:
+        """The tracked background level as an int16 RMS, for a SILENCE payload"""
+        return min(0xFFFF, int(FULL_SCALE * 10 ** (self.floor_db / 20)))
+
+    def update(self, frame) -> bool:
+        """Feed one frame; True while the sender should be transmitting"""
+        np = get_numpy()
+        samples = frame.astype(np.float32)
+        energy_db = 10 * math.log10(float(np.dot(samples, samples)) / (len(samples) * FULL_SCALE ** 2) + 1e-10)
+        crossings = np.count_nonzero(np.signbit(frame[1:]) != np.signbit(frame[:-1])) / len(frame)
+
+        loud = energy_db > self.floor_db + self.MARGIN_DB and energy_db > self.MIN_SPEECH_DB
+        speech = loud and (crossings < self.NOISE_ZCR or energy_db > self.floor_db + 2 * self.MARGIN_DB)
+
+        self.recent.append(energy_db)
+        if energy_db < self.floor_db:
+            self.floor_db = energy_db  # Quieter than the floor: that is the new floor
+        elif not loud:
+            self.floor_db += 0.05 * (energy_db - self.floor_db)
+        else:
+            self.floor_db += min(self.FLOOR_RISE_DB, max(0.0, min(self.recent) - self.floor_db))
+
+        if speech:
+            self.hangover = self.HANGOVER_FRAMES
+        elif self.hangover:
+            self.hangover -= 1
+        self.active = speech or self.hangover > 0
+        return self.active
+
+
+class ComfortNoise:
+    """Low-level noise for the gaps between talkspurts, so silence does not sound like a dropout"""
+
+    MAX_RMS = 1000  # About -30 dBFS: never louder than this, whatever the sender reported
+
+    def __init__(self, frame_size: int = FRAME_SIZE, seed: Optional[int] = None):
+        np = get_numpy()
+        # One second of unit-RMS noise, played in a loop: no random numbers per frame
+        self.table = np.random.default_rng(seed).standard_normal(SAMPLE_RATE).astype(np.float32)
+        self.scratch = np.zeros(frame_size, dtype=np.float32)
+        self.frame = np.zeros(frame_size, dtype=np.int16)
+        self.position = 0
+
+    def next(self, rms: int):
+        """One frame at the given RMS; the array is reused by the next call"""
+        np = get_numpy()
+        size = len(self.frame)
+        if self.position + size > len(self.table):
+            self.position = 0
+        np.multiply(self.table[self.position:self.position + size], min(rms, self.MAX_RMS), out=self.scratch)
+        np.copyto(self.frame, self.scratch, casting='unsafe')
+        self.position += size
+        return self.frame
@@ -4,18 +4,25 @@ audio_module.py - Real-time audio conferencing for Shadow Nexus
 Handles audio capture, encoding, transmission, mixing, and playback
 """
 
-import queue
 import threading
 import socket
 import json
 import base64
+import collections
+import hashlib
+import io
+import math
+import queue
 import time
 import os
+import wave
 from datetime import datetime
 from typing import Optional, Dict, List
 from dotenv import load_dotenv
 import sys
 
+from backend import audio_dsp, audio_transport
+
 # Load environment variables - check multiple possible locations for .env
 if getattr(sys, 'frozen', False):
     # Running as compiled executable
@@ -60,10 +67,23 @@ def get_numpy():
     return _numpy
 
 # Audio configuration
-SAMPLE_RATE = 16000
-CHUNK_SIZE = 512
+SAMPLE_RATE = audio_transport.SAMPLE_RATE
 CHANNELS = 1
-FRAME_SIZE = SAMPLE_RATE // 50  # 20ms frames
+FRAME_SIZE = audio_transport.FRAME_SIZE  # 20ms frames
+
+# 'udp' (default) or 'tcp' for networks that block UDP to the relay
+AUDIO_TRANSPORT = os.getenv('SHADOW_NEXUS_AUDIO_TRANSPORT', 'udp').lower()
+# Rate to open the sound devices at: unset for SAMPLE_RATE, 'native' for each device's own
+# default, or a number. Anything but SAMPLE_RATE is resampled here rather than by PortAudio.
+AUDIO_DEVICE_RATE = os.getenv('SHADOW_NEXUS_AUDIO_DEVICE_RATE', '').lower()
+# '0' keeps the microphone streaming through silence instead of sending only while someone talks
+AUDIO_VAD = os.getenv('SHADOW_NEXUS_AUDIO_VAD', '1') != '0'
+# Audio per PortAudio buffer: a profile below or a number of milliseconds. Smaller buffers
+# mean less delay and more wakeups; 'safe' suits machines that glitch on 'normal'.
+LATENCY_PROFILES = {'low': 10, 'normal': 20, 'safe': 40}
+AUDIO_LATENCY = os.getenv('SHADOW_NEXUS_AUDIO_LATENCY', 'normal').lower()
+# '0' opens blocking streams driven by our own threads instead of PortAudio callbacks
+AUDIO_CALLBACKS = os.getenv('SHADOW_NEXUS_AUDIO_CALLBACKS', '1') != '0'
 
 def get_audio_format():
     pyaudio = get_pyaudio()
@@ -72,26 +92,54 @@ def get_audio_format():
 class AudioEngine:
     """Handles all audio operations"""
     
-    def __init__(self, username: str, server_host: str = None, audio_port: int = 5557):
+    def __init__(self, username: str, server_host: str = None, audio_port: int = 5557, transport: str = None):
         if server_host is None:
             server_host = DEFAULT_AUDIO_SERVER_IP
         
         self.username = username
         self.server_host = server_host
         self.audio_port = audio_port
+        self.transport = transport or AUDIO_TRANSPORT
         
         # Defer heavy initialization
         self.audio = None
         self.running = False
         self.enabled = False
         
-        # Audio queues
-        self.input_queue: queue.Queue = queue.Queue(maxsize=10)
-        self.output_queue: queue.Queue = queue.Queue(maxsize=50)
+        # Device rates and the 16 kHz conversions, settled when the streams open
+        self.input_rate = self.output_rate = SAMPLE_RATE
+        self.buffer_ms = self._buffer_ms()
+        self.capture_block = FRAME_SIZE  # Samples per PortAudio buffer at input_rate
+        self.callbacks = AUDIO_CALLBACKS  # PortAudio drives capture and playback; False after a fallback
+        self.captured = threading.Event()  # Set by the input callback when frames are in input_ring
+        self.playout = None  # Device-rate samples decoded but not yet handed to the output callback
+        self.playout_fill = 0
+        self.capture_resampler: Optional[audio_dsp.Resampler] = None
+        self.playback_resampler: Optional[audio_dsp.Resampler] = None
+        self.reblocker: Optional[audio_dsp.Reblocker] = None
+        
+        # Audio rings (allocated with the streams): one producer and one consumer thread each
+        self.input_ring: Optional[audio_transport.FrameRing] = None
+        self.output_ring: Optional[audio_transport.FrameRing] = None
         self.playback_buffer = None
         
-        # Socket for audio
+        # Socket to the audio relay
         self.audio_socket: Optional[socket.socket] = None
+        self.room: Optional[str] = None
+        self.room_participants: List[str] = []
+        
+        # UDP: our stream id from the relay, send sequence and the receive jitter buffer
+        self.stream_id = 0
+        self.send_seq = 0
+        self.send_ts = 0  # Samples captured, sent or not: the timestamp runs on through silence
+        
+        # Voice activity: send only while talking, then one SILENCE with our background level
+        self.vad: Optional[audio_dsp.VoiceDetector] = audio_dsp.VoiceDetector() if AUDIO_VAD else None
+        self.talking = False
+        self.comfort: Optional[audio_dsp.ComfortNoise] = None
+        self.comfort_level = 0  # Background of the room, from the relay's last SILENCE
+        self.sender: Optional[audio_transport.FrameSender] = None
+        self.jitter = audio_transport.JitterBuffer()
         
         # Streams
         self.input_stream = None
@@ -99,6 +147,7 @@ class AudioEngine:
         
         # Participants audio (for mixing)
         self.participant_audio: Dict[str, dict] = {}
+        self.mixer: Optional[audio_dsp.Mixer] = None
         
         print(f"[AUDIO] Engine initialized for {username}")
     
@@ -114,141 +163,424 @@ class AudioEngine:
                 if self.playback_buffer is None:
                     np = get_numpy()
                     self.playback_buffer = np.zeros(FRAME_SIZE, dtype=np.int16)
+                    self.input_ring = audio_transport.FrameRing(10)
+                    self.output_ring = audio_transport.FrameRing(50)
             
-            audio_format = get_audio_format()
-            
-            # Input stream (microphone) - without callback for better compatibility
-            try:
-                self.input_stream = self.audio.open(
-                    format=audio_format,
-                    channels=CHANNELS,
-                    rate=SAMPLE_RATE,
-                    input=True,
-                    frames_per_buffer=CHUNK_SIZE,
-                    exception_on_overflow=False
-                )
-                self.input_stream.start_stream()
-                print("[AUDIO] Input stream initialized")
-            except Exception as e:
-                print(f"[AUDIO] Failed to initialize input stream: {e}")
-                return False
-            
-            # Output stream (speaker) - without callback for better compatibility
-            try:
-                self.output_stream = self.audio.open(
-                    format=audio_format,
-                    channels=CHANNELS,
-                    rate=SAMPLE_RATE,
-                    output=True,
-                    frames_per_buffer=CHUNK_SIZE,
-                    exception_on_overflow=False
-                )
-                self.output_stream.start_stream()
-                print("[AUDIO] Output stream initialized")
-            except Exception as e:
-                print(f"[AUDIO] Failed to initialize output stream: {e}")
-                if self.input_stream:
-                    self.input_stream.stop_stream()
-                    self.input_stream.close()
-                return False
+            self._configure_rates()
+            if self.callbacks:
+                try:
+                    self._open_streams(callbacks=True)
+                except Exception as e:
+                    print(f"[AUDIO] Callback streams unavailable ({e}), using blocking streams")
+                    self._close_streams()
+                    self.callbacks = False
+            if not self.callbacks:
+                try:
+                    self._open_streams(callbacks=False)
+                except Exception as e:
+                    print(f"[AUDIO] Failed to initialize streams: {e}")
+                    self._close_streams()
+                    return False
             
-            print("[AUDIO] Streams initialized successfully")
+            mode = 'callback' if self.callbacks else 'blocking'
+            print(f"[AUDIO] Streams initialized successfully ({mode}, {self.buffer_ms} ms buffers)")
             return True
         except Exception as e:
             print(f"[AUDIO] Failed to initialize streams: {e}")
             return False
     
+    @staticmethod
+    def _buffer_ms() -> int:
+        """Milliseconds per PortAudio buffer, per SHADOW_NEXUS_AUDIO_LATENCY"""
+        if AUDIO_LATENCY in LATENCY_PROFILES:
+            return LATENCY_PROFILES[AUDIO_LATENCY]
+        try:
+            return max(5, min(100, int(AUDIO_LATENCY)))
+        except ValueError:
+            print(f"[AUDIO] Unknown latency profile {AUDIO_LATENCY!r}, using normal")
+            return LATENCY_PROFILES['normal']
+    
+    def _open_streams(self, callbacks: bool):
+        """Open microphone and speaker; with callbacks PortAudio pulls and pushes frames itself"""
+        np = get_numpy()
+        audio_format = get_audio_format()
+        self.capture_block = self.input_rate * self.buffer_ms // 1000
+        playback_block = self.output_rate * self.buffer_ms // 1000
+        # Room for one buffer plus one resampled 20 ms frame on top of a partial buffer
+        self.playout = np.zeros(2 * (playback_block + self.output_rate // 50 + 16), dtype=np.int16)
+        self.playout_fill = 0
+        
+        self.input_stream = self.audio.open(
+            format=audio_format,
+            channels=CHANNELS,
+            rate=self.input_rate,
+            input=True,
+            frames_per_buffer=self.capture_block,
+            stream_callback=self._input_callback if callbacks else None
+        )
+        print("[AUDIO] Input stream initialized")
+        self.output_stream = self.audio.open(
+            format=audio_format,
+            channels=CHANNELS,
+            rate=self.output_rate,
+            output=True,
+            frames_per_buffer=playback_block,
+            stream_callback=self._output_callback if callbacks else None
+        )
+        print("[AUDIO] Output stream initialized")
+    
+    def _close_streams(self):
+        for stream in (self.input_stream, self.output_stream):
+            if stream is not None:
+                try:
+                    stream.stop_stream()
+                    stream.close()
+                except Exception:
+                    pass
+        self.input_stream = self.output_stream = None
+    
+    def _device_rate(self, kind: str) -> int:
+        """Rate to open the default input or output device at, per SHADOW_NEXUS_AUDIO_DEVICE_RATE"""
+        if not AUDIO_DEVICE_RATE:
+            return SAMPLE_RATE
+        try:
+            if AUDIO_DEVICE_RATE == 'native':
+                info = (self.audio.get_default_input_device_info() if kind == 'input'
+                        else self.audio.get_default_output_device_info())
+                return int(info['defaultSampleRate'])
+            return int(AUDIO_DEVICE_RATE)
+        except (IOError, ValueError, KeyError) as e:
+            print(f"[AUDIO] Using {SAMPLE_RATE} Hz for {kind}: {e}")
+            return SAMPLE_RATE
+    
+    def _configure_rates(self):
+        """Pick device rates and set up resampling to and from the 16 kHz call rate"""
+        self.input_rate = self._device_rate('input')
+        self.output_rate = self._device_rate('output')
+        self.capture_resampler = (audio_dsp.Resampler(self.input_rate, SAMPLE_RATE)
+                                  if self.input_rate != SAMPLE_RATE else None)
+        self.playback_resampler = (audio_dsp.Resampler(SAMPLE_RATE, self.output_rate)
+                                   if self.output_rate != SAMPLE_RATE else None)
+        self.reblocker = audio_dsp.Reblocker()
+        if self.capture_resampler or self.playback_resampler:
+            print(f"[AUDIO] Resampling: microphone {self.input_rate} Hz, speaker {self.output_rate} Hz")
+    
+    def _frames_from_device(self, data: bytes):
+        """Captured bytes at the device rate -> whole 20 ms frames at 16 kHz (possibly none yet)"""
+        np = get_numpy()
+        samples = np.frombuffer(data, dtype=np.int16)
+        if self.capture_resampler:
+            samples = self.capture_resampler.process(samples)
+        return self.reblocker.push(samples)
+    
+    def _to_device(self, frame) -> bytes:
+        """A 16 kHz frame as bytes for the output device"""
+        if self.playback_resampler:
+            frame = self.playback_resampler.process(frame)
+        return frame.tobytes()
+    
     def _input_callback(self, in_data, frame_count, time_info, status):
-        """Capture audio from microphone"""
+        """PortAudio thread: captured audio into input_ring as 20 ms frames, then wake the sender"""
         if status:
             print(f"[AUDIO] Input status: {status}")
         
-        try:
-            self.input_queue.put_nowait(np.frombuffer(in_data, dtype=np.int16))
-        except queue.Full:
-            print("[AUDIO] Input queue full, dropping frame")
-        
-        return (in_data, pyaudio.paContinue)
+        for frame in self._frames_from_device(in_data):
+            self.input_ring.write(frame)
+        self.captured.set()
+        return (None, get_pyaudio().paContinue)
     
     def _output_callback(self, in_data, frame_count, time_info, status):
-        """Play audio to speaker"""
+        """PortAudio thread: the device clock paces playout, one 20 ms frame whenever it runs low"""
         if status:
             print(f"[AUDIO] Output status: {status}")
         
-        try:
-            audio_data = self.output_queue.get_nowait()
-            return (audio_data.tobytes(), pyaudio.paContinue)
-        except queue.Empty:
-            # Return silence if no audio
-            silence = np.zeros(frame_count, dtype=np.int16)
-            return (silence.tobytes(), pyaudio.paContinue)
+        np = get_numpy()
+        needed = frame_count + self.output_rate // 50 + 16
+        if len(self.playout) < needed:
+            # PortAudio asked for more than the buffer size we opened with
+            grown = np.zeros(2 * needed, dtype=np.int16)
+            grown[:self.playout_fill] = self.playout[:self.playout_fill]
+            self.playout = grown
+        while self.playout_fill < frame_count:
+            frame = self._next_frame()
+            if frame is None:
+                frame = self.playback_buffer  # Silence
+            if self.playback_resampler:
+                frame = self.playback_resampler.process(frame)
+            end = self.playout_fill + len(frame)
+            self.playout[self.playout_fill:end] = frame
+            self.playout_fill = end
+        data = self.playout[:frame_count].tobytes()
+        rest = self.playout_fill - frame_count
+        self.playout[:rest] = self.playout[frame_count:self.playout_fill]
+        self.playout_fill = rest
+        return (data, get_pyaudio().paContinue)
     
-    def start(self):
-        """Start audio engine"""
+    def _next_frame(self):
+        """The next 20 ms to play: relay audio, concealment or comfort noise; None for silence"""
+        if self.transport != 'udp':
+            return self.output_ring.read()
+        frame = self.jitter.pop()
+        if frame is None and self.comfort_level:
+            if self.comfort is None:
+                self.comfort = audio_dsp.ComfortNoise()
+            frame = self.comfort.next(self.comfort_level)
+        return frame
+    
+    def start(self, room: str = 'global'):
+        """Start audio engine and join a room on the audio relay"""
         if not self.initialize_streams():
             return False
         
         self.running = True
         self.enabled = True
         
-        # Start capture thread
-        capture_thread = threading.Thread(target=self._capture_audio, daemon=True)
-        capture_thread.start()
+        if not self.audio_socket and not self.connect(room):
+            # Release the microphone: a retry opens fresh streams, and two input callbacks must never share input_ring
+            self.running = False
+            self.enabled = False
+            self._close_streams()
+            return False
+        
+        if self.callbacks:
+            # PortAudio plays on its own; one thread sends what the input callback captured
+            threading.Thread(target=self._send_captured, daemon=True).start()
+        else:
+            # Start capture and playback threads
+            capture_thread = threading.Thread(target=self._capture_audio, daemon=True)
+            capture_thread.start()
+            playback_thread = threading.Thread(target=self._play_audio, daemon=True)
+            playback_thread.start()
         
         print("[AUDIO] Engine started")
         return True
     
+    def connect(self, room: str = 'global') -> bool:
+        """Connect to the audio relay and join a room"""
+        if self.transport == 'udp':
+            return self._connect_udp(room)
+        
+        try:
+            sock = socket.create_connection((self.server_host, self.audio_port), timeout=5)
+            sock.settimeout(None)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.sendall(audio_transport.pack_frame(
+                audio_transport.JOIN, json.dumps({'username': self.username, 'room': room}).encode()))
+        except OSError as e:
+            print(f"[AUDIO] Could not reach audio relay at {self.server_host}:{self.audio_port}: {e}")
+            return False
+        
+        self.room = room
+        self.send_seq = self.send_ts = 0
+        self.talking = False
+        self.comfort_level = 0
+        self.sender = audio_transport.FrameSender(sock, framed=True)
+        self.set_audio_socket(sock)
+        receive_thread = threading.Thread(target=self._receive_audio, args=(sock,), daemon=True)
+        receive_thread.start()
+        print(f"[AUDIO] Joined audio room {room}")
+        return True
+    
+    def _connect_udp(self, room: str) -> bool:
+        """Join a room over UDP; the relay answers with our stream id"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        join = audio_transport.pack_json(audio_transport.JOIN, {'username': self.username, 'room': room})
+        try:
+            sock.connect((self.server_host, self.audio_port))
+            sock.settimeout(0.5)
+            for _ in range(6):
+                sock.send(join)
+                try:
+                    kind, _, stream, _, _, payload = audio_transport.unpack(sock.recv(audio_transport.MAX_DATAGRAM))
+                except (socket.timeout, ConnectionRefusedError, ValueError):
+                    continue
+                if kind == audio_transport.JOINED:
+                    self.stream_id = stream
+                    break
+            else:
+                print(f"[AUDIO] No answer from audio relay at {self.server_host}:{self.audio_port}")
+                sock.close()
+                return False
+        except OSError as e:
+            print(f"[AUDIO] Could not reach audio relay at {self.server_host}:{self.audio_port}: {e}")
+            sock.close()
+            return False
+        
+        self.room = room
+        self.send_seq = self.send_ts = 0
+        self.talking = False
+        self.comfort_level = 0
+        self.sender = audio_transport.FrameSender(sock)
+        self.jitter = audio_transport.JitterBuffer()
+        self.set_audio_socket(sock)
+        receive_thread = threading.Thread(target=self._receive_datagrams, args=(sock,), daemon=True)
+        receive_thread.start()
+        print(f"[AUDIO] Joined audio room {room} over UDP (stream {self.stream_id})")
+        return True
+    
+    def _receive_datagrams(self, sock: socket.socket):
+        """Mixes from the relay go into the jitter buffer; also keeps our UDP mapping alive"""
+        sock.settimeout(audio_transport.KEEPALIVE_INTERVAL)
+        last_keepalive = time.monotonic()
+        buffer = bytearray(audio_transport.MAX_DATAGRAM)
+        view = memoryview(buffer)
+        while self.running and self.audio_socket is sock:
+            try:
+                n = sock.recv_into(buffer)
+                kind, _, _, seq, timestamp, payload = audio_transport.unpack(view[:n])
+                if kind == audio_transport.AUDIO:
+                    self.jitter.put(seq, timestamp, payload)
+                elif kind == audio_transport.SILENCE:
+                    self.jitter.end(seq)
+                    self.comfort_level = audio_transport.silence_level(payload)
+                elif kind == audio_transport.PARTICIPANTS:
+                    message = json.loads(bytes(payload))
+                    self.room_participants = message.get('participants', [])
+                    print(f"[AUDIO] In room {message.get('room')}: {', '.join(self.room_participants)}")
+            except (socket.timeout, ConnectionRefusedError, ValueError):
+                pass
+            except OSError as e:
+                if self.running:
+                    print(f"[AUDIO] Audio relay connection lost: {e}")
+                break
+            
+            now = time.monotonic()
+            if now - last_keepalive >= audio_transport.KEEPALIVE_INTERVAL:
+                last_keepalive = now
+                try:
+                    sock.send(audio_transport.pack(audio_transport.KEEPALIVE, self.stream_id))
+                except OSError:
+                    pass
+    
+    def _receive_audio(self, sock: socket.socket):
+        """Read mixes and room updates from the relay"""
+        np = get_numpy()
+        reader = audio_transport.FrameReader(sock)
+        try:
+            while self.running:
+                frame = reader.read()
+                if frame is None:
+                    break
+                kind, _, _, _, _, payload = frame
+                if kind == audio_transport.AUDIO:
+                    # Copied into the output ring before the reader reuses its buffer
+                    self.queue_playback(np.frombuffer(payload, dtype=np.int16))
+                elif kind == audio_transport.PARTICIPANTS:
+                    message = json.loads(bytes(payload))
+                    self.room_participants = message.get('participants', [])
+                    print(f"[AUDIO] In room {message.get('room')}: {', '.join(self.room_participants)}")
+        except (OSError, ValueError) as e:
+            if self.running:
+                print(f"[AUDIO] Audio relay connection lost: {e}")
+        finally:
+            if self.audio_socket is sock:
+                self.audio_socket = None
+    
+    def _play_audio(self):
+        """Write received mixes to the speaker"""
+        if self.transport == 'udp':
+            return self._play_jitter_buffer()
+        while self.running:
+            frame = self.output_ring.read()
+            if frame is None:
+                time.sleep(audio_transport.FRAME_SECONDS / 2)
+                continue
+            try:
+                if self.output_stream and self.output_stream.is_active():
+                    self.output_stream.write(self._to_device(frame))
+            except Exception as e:
+                print(f"[AUDIO] Playback error: {e}")
+                time.sleep(0.1)
+    
+    def _play_jitter_buffer(self):
+        """Blocking streams: pop one frame (real, concealed or comfort noise) every 20 ms"""
+        next_tick = time.monotonic()
+        while self.running:
+            frame = self._next_frame()
+            if frame is not None:
+                try:
+                    if self.output_stream and self.output_stream.is_active():
+                        self.output_stream.write(self._to_device(frame))
+                except Exception as e:
+                    print(f"[AUDIO] Playback error: {e}")
+            next_tick += audio_transport.FRAME_SECONDS
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -audio_transport.FRAME_SECONDS:
+                next_tick = time.monotonic()
+    
     def stop(self):
         """Stop audio engine"""
         self.running = False
         self.enabled = False
         
-        if self.input_stream:
-            self.input_stream.stop_stream()
-            self.input_stream.close()
+        if self.audio_socket:
+            try:
+                if self.transport == 'udp':
+                    self.audio_socket.send(audio_transport.pack(audio_transport.LEAVE, self.stream_id))
+            except OSError:
+                pass
+            try:
+                self.audio_socket.close()
+            except OSError:
+                pass
+            self.audio_socket = None
         
-        if self.output_stream:
-            self.output_stream.stop_stream()
-            self.output_stream.close()
+        self._close_streams()
         
         self.audio.terminate()
         print("[AUDIO] Engine stopped")
     
+    def _send_captured(self):
+        """Callback streams: send frames from input_ring as the input callback delivers them"""
+        while self.running and self.enabled:
+            if not self.captured.wait(0.1):
+                continue
+            self.captured.clear()
+            try:
+                frame = self.input_ring.read()
+                while frame is not None:
+                    self.send_ts += FRAME_SIZE
+                    if self.audio_socket:
+                        self._send_frame(frame)
+                    frame = self.input_ring.read()
+            except Exception as e:
+                print(f"[AUDIO] Send error: {e}")
+    
     def _capture_audio(self):
-        """Capture and send audio to server"""
+        """Blocking streams: capture and send audio to server"""
         while self.running and self.enabled:
             try:
                 # Read directly from input stream
                 if self.input_stream and self.input_stream.is_active():
-                    audio_data = self.input_stream.read(CHUNK_SIZE, exception_on_overflow=False)
-                    np = get_numpy()
-                    frame = np.frombuffer(audio_data, dtype=np.int16)
+                    # One buffer at the device rate; reblocking cuts it into 20 ms frames
+                    audio_data = self.input_stream.read(self.capture_block, exception_on_overflow=False)
                     
-                    # Queue for processing
-                    try:
-                        self.input_queue.put_nowait(frame)
-                    except queue.Full:
-                        print("[AUDIO] Input queue full, dropping frame")
-                    
-                    if self.audio_socket:
-                        # Send audio frame with header
-                        header = {
-                            'type': 'audio_frame',
-                            'sender': self.username,
-                            'timestamp': datetime.now().isoformat(),
-                            'size': len(frame)
-                        }
-                        
-                        # Send as: [HEADER_JSON]\n[AUDIO_BYTES]
-                        self.audio_socket.send(
-                            (json.dumps(header) + '\n').encode() + frame.tobytes()
-                        )
+                    for frame in self._frames_from_device(audio_data):
+                        self.send_ts += FRAME_SIZE
+                        if self.audio_socket:
+                            self._send_frame(frame)
                 else:
                     time.sleep(0.01)
             except Exception as e:
                 print(f"[AUDIO] Capture error: {e}")
                 time.sleep(0.1)
     
+    def _send_frame(self, frame):
+        """Send a captured frame while talking; when the talkspurt ends, one SILENCE instead"""
+        if self.vad is None or self.vad.update(frame):
+            self.talking = True
+            kind, payload = audio_transport.AUDIO, frame  # Samples straight from the reblocking buffer
+        elif self.talking:
+            self.talking = False
+            kind = audio_transport.SILENCE
+            payload = audio_transport.SILENCE_PAYLOAD.pack(self.vad.noise_rms)
+        else:
+            return
+        self.send_seq += 1
+        self.sender.send(kind, self.stream_id, self.send_seq, self.send_ts, payload)
+    
     def set_audio_socket(self, sock: socket.socket):
         """Set socket for audio transmission"""
         self.audio_socket = sock
@@ -263,35 +595,15 @@ class AudioEngine:
         np = get_numpy()
         if not self.participant_audio:
             return np.zeros(FRAME_SIZE, dtype=np.int16)
-        
-        mixed = np.zeros(FRAME_SIZE, dtype=np.float32)
-        
-        for username, audio_data in self.participant_audio.items():
-            # Ensure audio is the right size
-            if len(audio_data) != FRAME_SIZE:
-                audio_data = np.pad(audio_data, (0, FRAME_SIZE - len(audio_data)))
-            
-            mixed += audio_data.astype(np.float32)
-        
-        # Normalize to prevent clipping
-        num_streams = len(self.participant_audio)
-        if num_streams > 0:
-            mixed = mixed / num_streams
-        
-        # Convert back to int16
-        mixed = np.clip(mixed, -32768, 32767).astype(np.int16)
-        
-        # Clear participant audio
+        if self.mixer is None:
+            self.mixer = audio_dsp.Mixer()
+        mixed = self.mixer.mix_all(list(self.participant_audio.values()))
         self.participant_audio.clear()
-        
         return mixed
     
     def queue_playback(self, audio_data):
-        """Queue audio for playback"""
-        try:
-            self.output_queue.put_nowait(audio_data)
-        except queue.Full:
-            print("[AUDIO] Playback queue full, dropping frame")
+        """Queue audio for playback; a full ring drops the frame and counts an overrun"""
+        self.output_ring.write(audio_data)
     
     def toggle_audio(self, enabled: bool):
         """Toggle audio on/off"""
@@ -300,60 +612,233 @@ class AudioEngine:
         print(f"[AUDIO] Audio {status}")
 
 
-# Server-side audio handler
-class ServerAudioHandler:
-    """Handles audio mixing and broadcasting on server"""
+class VoicePlayer:
+    """Plays voice messages through one long-lived output stream.
     
-    def __init__(self, audio_port: int = 5557):
-        self.audio_port = audio_port
-        self.participant_streams: Dict[str, queue.Queue] = {}
-        self.running = False
-        
-        print("[SERVER AUDIO] Handler initialized")
-    
-    def add_participant(self, username: str) -> queue.Queue:
-        """Add participant to audio session"""
-        self.participant_streams[username] = queue.Queue(maxsize=50)
-        print(f"[SERVER AUDIO] Added participant: {username}")
-        return self.participant_streams[username]
-    
-    def remove_participant(self, username: str):
-        """Remove participant from audio session"""
-        if username in self.participant_streams:
-            del self.participant_streams[username]
-            print(f"[SERVER AUDIO] Removed participant: {username}")
-    
-    def process_audio_frame(self, username: str, audio_data):
-        """Process incoming audio frame and distribute to others"""
-        # Broadcast to all other participants
-        for participant, queue_obj in self.participant_streams.items():
-            if participant != username:
-                try:
-                    queue_obj.put_nowait(audio_data)
-                except queue.Full:
-                    print(f"[SERVER AUDIO] Queue full for {participant}")
+    Clips are decoded in memory to 16 kHz mono int16, whatever rate and channel
+    count their WAV header says, so every clip fits the same stream. A worker
+    thread plays them in the order they were queued, and the decoded PCM of
+    recently played clips is kept, so replaying a message skips the decode.
+    """
     
-    def get_mixed_audio(self):
-        """Get mixed audio from all participants"""
-        np = get_numpy()
-        mixed = np.zeros(FRAME_SIZE, dtype=np.float32)
-        count = 0
+    CACHE_BYTES = 16 << 20  # Decoded PCM kept for replays, about 8 minutes of audio
+    WRITE_SAMPLES = FRAME_SIZE * 5  # 100 ms per write, so skip() takes effect quickly
+    
+    def __init__(self):
+        self.audio = None
+        self.stream = None
+        self.clips = queue.Queue()  # (generation, samples); None stops the worker
+        self.generation = 0  # Bumped by skip(): clips queued under an older generation are not played
+        self.thread: Optional[threading.Thread] = None
+        self.lock = threading.Lock()
+        self.cache = collections.OrderedDict()  # Digest of the base64 clip -> int16 samples, oldest first
+        self.cache_bytes = 0
+    
+    def decode(self, audio_data: str):
+        """Base64 WAV -> 16 kHz mono int16 samples, from the cache if the clip was played lately"""
+        key = hashlib.blake2b(audio_data.encode('ascii'), digest_size=16).digest()
+        with self.lock:
+            samples = self.cache.get(key)
+            if samples is not None:
+                self.cache.move_to_end(key)
+                return samples
         
-        for username, queue_obj in self.participant_streams.items():
+        np = get_numpy()
+        with wave.open(io.BytesIO(base64.b64decode(audio_data)), 'rb') as wf:
+            width, channels, rate = wf.getsampwidth(), wf.getnchannels(), wf.getframerate()
+            raw = wf.readframes(wf.getnframes())
+        if width == 2:
+            samples = np.frombuffer(raw, dtype='<i2')
+        elif width == 1:
+            samples = ((np.frombuffer(raw, dtype=np.uint8).astype(np.int16) - 128) << 8)
+        else:
+            raise ValueError(f"Unsupported sample width: {width * 8} bits")
+        if channels > 1:
+            samples = samples[:len(samples) // channels * channels].reshape(-1, channels).mean(axis=1)
+        if rate != SAMPLE_RATE:
+            samples = audio_dsp.Resampler(rate, SAMPLE_RATE).process(samples)
+        samples = np.ascontiguousarray(samples, dtype=np.int16)
+        
+        with self.lock:
+            self.cache[key] = samples
+            self.cache_bytes += samples.nbytes
+            while self.cache_bytes > self.CACHE_BYTES and len(self.cache) > 1:
+                _, evicted = self.cache.popitem(last=False)
+                self.cache_bytes -= evicted.nbytes
+        return samples
+    
+    def play(self, audio_data: str) -> float:
+        """Queue a clip behind any already playing; returns its length in seconds"""
+        samples = self.decode(audio_data)
+        with self.lock:
+            self.clips.put((self.generation, samples))
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._play_clips, daemon=True)
+                self.thread.start()
+        return len(samples) / SAMPLE_RATE
+    
+    def skip(self):
+        """Stop the clip that is playing and drop the queued ones"""
+        with self.lock:
+            self.generation += 1
             try:
                 while True:
-                    audio_data = queue_obj.get_nowait()
-                    mixed += audio_data.astype(np.float32)
-                    count += 1
+                    self.clips.get_nowait()
             except queue.Empty:
-                continue
-        
-        if count > 0:
-            mixed = mixed / count
-        
-        # Normalize and convert back to int16
-        mixed = np.clip(mixed, -32768, 32767).astype(np.int16)
-        return mixed
+                pass
+    
+    def _open(self):
+        """Open the output stream once; later clips reuse it"""
+        if self.audio is None:
+            self.audio = get_pyaudio().PyAudio()
+        if self.stream is None:
+            self.stream = self.audio.open(format=get_audio_format(), channels=CHANNELS, rate=SAMPLE_RATE,
+                                          output=True, frames_per_buffer=FRAME_SIZE)
+        elif self.stream.is_stopped():
+            self.stream.start_stream()
+    
+    def _play_clips(self):
+        """Worker: play queued clips back to back, pausing the stream while the queue is empty"""
+        while True:
+            clip = self.clips.get()
+            if clip is None:
+                break
+            generation, samples = clip
+            if generation != self.generation:
+                continue  # Skipped while it waited
+            try:
+                self._open()
+                for start in range(0, len(samples), self.WRITE_SAMPLES):
+                    if generation != self.generation:
+                        break
+                    self.stream.write(samples[start:start + self.WRITE_SAMPLES].tobytes())
+                if self.clips.empty():
+                    self.stream.stop_stream()  # Stays open: starting it again is cheap
+            except Exception as e:
+                print(f"[AUDIO] Playback error: {e}")
+                self._close_stream()
+    
+    def _close_stream(self):
+        if self.stream is not None:
+            try:
+                self.stream.close()
+            except Exception:
+                pass
+            self.stream = None
+    
+    def close(self):
+        """Stop playback and release the sound device"""
+        self.skip()
+        if self.thread is not None and self.thread.is_alive():
+            self.clips.put(None)
+            self.thread.join(timeout=1)
+        self.thread = None
+        self._close_stream()
+        if self.audio is not None:
+            self.audio.terminate()
+            self.audio = None
+
+
+class VoiceRecorder:
+    """Records a voice message into memory.
+    
+    The input callback copies each block straight into one preallocated int16
+    buffer, which doubles when full, up to MAX_SECONDS. The level meter and the
+    waveform peaks are updated as each block arrives, so stopping only has to
+    put a WAV header in front of the samples.
+    """
+    
+    MAX_SECONDS = 60
+    INITIAL_SECONDS = 10
+    WAVEFORM_BUCKET = FRAME_SIZE * 5  # One waveform peak per 100 ms
+    WAVEFORM_BARS = 64
+    METER_FALL_DB = 20.0  # Per second: the meter jumps up to a peak and falls back slowly
+    
+    def __init__(self):
+        np = get_numpy()
+        self.buffer = np.zeros(SAMPLE_RATE * self.INITIAL_SECONDS, dtype=np.int16)
+        self.length = 0  # Samples recorded
+        self.peaks = np.zeros(-(-SAMPLE_RATE * self.MAX_SECONDS // self.WAVEFORM_BUCKET), dtype=np.int32)
+        self.level_db = -100.0
+        self.recording = False
+        self.audio = None
+        self.stream = None
+    
+    def start(self):
+        pyaudio = get_pyaudio()
+        self.audio = pyaudio.PyAudio()
+        self.recording = True
+        self.stream = self.audio.open(format=get_audio_format(), channels=CHANNELS, rate=SAMPLE_RATE,
+                                      input=True, frames_per_buffer=FRAME_SIZE,
+                                      stream_callback=self._input_callback)
+    
+    def _input_callback(self, in_data, frame_count, time_info, status):
+        """PortAudio thread: append the block, then update the meter and the waveform"""
+        np = get_numpy()
+        pyaudio = get_pyaudio()
+        if not self.recording:
+            return (None, pyaudio.paComplete)
+        
+        block = np.frombuffer(in_data, dtype=np.int16)
+        start = self.length
+        end = min(start + len(block), SAMPLE_RATE * self.MAX_SECONDS)
+        if end > len(self.buffer):
+            grown = np.zeros(min(max(end, 2 * len(self.buffer)), SAMPLE_RATE * self.MAX_SECONDS), dtype=np.int16)
+            grown[:start] = self.buffer[:start]
+            self.buffer = grown
+        self.buffer[start:end] = block[:end - start]
+        self.length = end
+        if end == start:
+            return (None, pyaudio.paComplete)
+        
+        samples = block[:end - start].astype(np.float32)
+        rms = math.sqrt(float(np.dot(samples, samples)) / len(samples))
+        fall = self.METER_FALL_DB * len(samples) / SAMPLE_RATE
+        self.level_db = max(20 * math.log10(rms / 32767 + 1e-5), self.level_db - fall)
+        
+        # Peaks of the buckets this block touched, the first one possibly begun by an earlier block
+        first = start // self.WAVEFORM_BUCKET
+        touched = np.abs(self.buffer[first * self.WAVEFORM_BUCKET:end].astype(np.int32))
+        bucket_peaks = np.maximum.reduceat(touched, np.arange(0, len(touched), self.WAVEFORM_BUCKET))
+        self.peaks[first:first + len(bucket_peaks)] = bucket_peaks
+        return (None, pyaudio.paContinue if end < SAMPLE_RATE * self.MAX_SECONDS else pyaudio.paComplete)
+    
+    def close(self):
+        """Stop capturing and release the microphone"""
+        self.recording = False
+        if self.stream is not None:
+            try:
+                self.stream.stop_stream()
+                self.stream.close()
+            except Exception:
+                pass
+            self.stream = None
+        if self.audio is not None:
+            self.audio.terminate()
+            self.audio = None
+    
+    def to_wav(self) -> bytes:
+        """The recording as a 16 kHz mono 16-bit WAV, built in memory"""
+        out = io.BytesIO()
+        with wave.open(out, 'wb') as wf:
+            wf.setnchannels(CHANNELS)
+            wf.setsampwidth(2)
+            wf.setframerate(SAMPLE_RATE)
+            wf.writeframes(self.buffer[:self.length])
+        return out.getvalue()
+    
+    def waveform(self) -> List[float]:
+        """Up to WAVEFORM_BARS peak levels between 0 and 1, for drawing the message"""
+        np = get_numpy()
+        peaks = self.peaks[:-(-self.length // self.WAVEFORM_BUCKET)]
+        if len(peaks) > self.WAVEFORM_BARS:
+            edges = np.linspace(0, len(peaks), self.WAVEFORM_BARS + 1).astype(np.int64)[:-1]
+            peaks = np.maximum.reduceat(peaks, edges)
+        return [round(int(peak) / 32768, 3) for peak in peaks]
+
+
+# The server-side mixer lives with the relay, which the server can import without eel
+from backend.audio_relay import ServerAudioHandler
 
 
 # Integration with Eel client
@@ -380,12 +865,12 @@ def toggle_microphone(enabled: bool):
         return {'success': False, 'message': str(e)}
 
 @eel.expose
-def start_audio():
-    """Start audio engine"""
+def start_audio(room: str = None):
+    """Start audio engine in a relay room"""
     try:
         global audio_engine
         if audio_engine:
-            if audio_engine.start():
+            if audio_engine.start(room or 'global'):
                 eel.showNotification('Microphone started', 'success')
                 return {'success': True}
         return {'success': False, 'message': 'Failed to start audio'}
@@ -409,206 +894,99 @@ def stop_audio():
         
 @eel.expose
 def start_audio_recording():
-    """Start audio recording"""
+    """Start recording a voice message"""
     try:
-        pyaudio = get_pyaudio()
-        import threading
-        import time
-        
-        global recording_state
-        if recording_state['is_recording']:
+        global recorder
+        if recorder and recorder.recording:
             return {'success': False, 'message': 'Already recording'}
         
-        # Audio parameters
-        FORMAT = pyaudio.paInt16
-        CHANNELS = 1
-        RATE = 16000
-        CHUNK = 1024
-        
-        # Initialize recording state
-        recording_state['is_recording'] = True
-        recording_state['frames'] = []
-        recording_state['start_time'] = time.time()
-        
-        # Create PyAudio instance
-        try:
-            recording_state['audio'] = pyaudio.PyAudio()
-        except Exception as e:
-            print(f"[AUDIO] PyAudio initialization error: {e}")
-            recording_state['is_recording'] = False
-            return {'success': False, 'message': f'Audio system error: {str(e)}'}
-        
-        # Open stream with better error handling
+        recorder = VoiceRecorder()
         try:
-            recording_state['stream'] = recording_state['audio'].open(
-                format=FORMAT, 
-                channels=CHANNELS,
-                rate=RATE, 
-                input=True,
-                frames_per_buffer=CHUNK,
-                exception_on_overflow=False
-            )
+            recorder.start()
         except Exception as e:
-            print(f"[AUDIO] Stream open error: {e}")
-            recording_state['audio'].terminate()
-            recording_state['is_recording'] = False
+            print(f"[AUDIO] Recording stream error: {e}")
+            recorder.close()
             return {'success': False, 'message': f'Could not access microphone: {str(e)}. Please check permissions.'}
         
-        # Start recording in a separate thread
-        recording_thread = threading.Thread(target=_record_audio_thread, daemon=True)
-        recording_thread.start()
-        
         # Show recording state
-        eel.showRecordingState(True, 60)  # Max 60 seconds
+        eel.showRecordingState(True, VoiceRecorder.MAX_SECONDS)
         
         print("[AUDIO] Recording started")
         return {'success': True}
     
     except Exception as e:
         print(f"[AUDIO] Start recording error: {e}")
-        if 'recording_state' in globals():
-            recording_state['is_recording'] = False
         return {'success': False, 'message': str(e)}
 
-def _record_audio_thread():
-    """Background thread for recording audio"""
-    try:
-        while recording_state['is_recording']:
-            try:
-                data = recording_state['stream'].read(1024, exception_on_overflow=False)
-                recording_state['frames'].append(data)
-            except Exception as e:
-                print(f"[AUDIO] Recording thread error: {e}")
-                break
-    except Exception as e:
-        print(f"[AUDIO] Recording thread error: {e}")
+@eel.expose
+def get_recording_level():
+    """Live input level while recording, for a meter"""
+    if not recorder or not recorder.recording:
+        return {'success': False, 'message': 'Not recording'}
+    return {'success': True, 'level_db': round(recorder.level_db, 1),
+            'duration': round(recorder.length / SAMPLE_RATE, 1)}
 
 @eel.expose
-def stop_audio_recording():
-    """Stop audio recording and return the recorded data"""
+def stop_audio_recording(send: bool = False):
+    """Stop recording and return the voice message; with send, also send it to the current chat"""
     try:
-        global recording_state
-        if not recording_state['is_recording']:
+        if not recorder or not recorder.recording:
             return {'success': False, 'message': 'Not recording'}
         
-        # Stop recording
-        recording_state['is_recording'] = False
-        
-        # Calculate duration
-        duration = int(time.time() - recording_state['start_time'])
-        
-        # Stop and close the stream
-        if recording_state['stream']:
-            recording_state['stream'].stop_stream()
-            recording_state['stream'].close()
-        
-        if recording_state['audio']:
-            recording_state['audio'].terminate()
+        recorder.close()
         
         # Hide recording state
         eel.showRecordingState(False)
         
-        # Process recorded audio
-        if recording_state['frames']:
-            import wave
-            import tempfile
-            import os
-            import base64
-            
-            # Create a temporary file
-            with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as temp_file:
-                temp_path = temp_file.name
-            
-            # Audio parameters
-            FORMAT = pyaudio.paInt16
-            CHANNELS = 1
-            RATE = 16000
-            
-            # Write to WAV file
-            wf = wave.open(temp_path, 'wb')
-            wf.setnchannels(CHANNELS)
-            wf.setsampwidth(2)  # 16-bit
-            wf.setframerate(RATE)
-            wf.writeframes(b''.join(recording_state['frames']))
-            wf.close()
-            
-            # Read the file and convert to base64
-            with open(temp_path, 'rb') as audio_file:
-                audio_data = base64.b64encode(audio_file.read()).decode('utf-8')
-            
-            # Clean up
-            os.unlink(temp_path)
-            
-            print(f"[AUDIO] Recording stopped, duration: {duration}s")
-            return {
-                'success': True, 
-                'audio_data': audio_data,
-                'duration': duration,
-                'timestamp': datetime.now().isoformat()
-            }
-        else:
+        if not recorder.length:
             return {'success': False, 'message': 'No audio data recorded'}
+        
+        audio_data = base64.b64encode(recorder.to_wav()).decode('ascii')
+        duration = int(recorder.length / SAMPLE_RATE)
+        result = {
+            'success': True,
+            'audio_data': audio_data,
+            'duration': duration,
+            'waveform': recorder.waveform(),
+            'timestamp': datetime.now().isoformat()
+        }
+        if send:
+            if send_voice_message is None:
+                return {'success': False, 'message': 'Not connected'}
+            result['sent'] = send_voice_message(audio_data, duration)
+        
+        print(f"[AUDIO] Recording stopped, duration: {duration}s")
+        return result
     
     except Exception as e:
         print(f"[AUDIO] Stop recording error: {e}")
         return {'success': False, 'message': str(e)}
 
-# Initialize recording state
-recording_state = {
-    'is_recording': False,
-    'frames': [],
-    'start_time': 0,
-    'audio': None,
-    'stream': None
-}
+# Voice message recording (one recorder per message)
+recorder: Optional[VoiceRecorder] = None
+# Set by client.py to its send_audio_message(audio_data, duration)
+send_voice_message = None
+
+# Voice message playback (created on first play)
+voice_player: Optional[VoicePlayer] = None
 
 @eel.expose
 def play_audio(audio_data):
-    """Play audio from base64 data"""
+    """Queue a base64 WAV voice message for playback; returns without waiting for it to play"""
     try:
-        pyaudio = get_pyaudio()
-        import wave
-        import tempfile
-        import os
-        import base64
-        
-        # Create a temporary file
-        with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as temp_file:
-            temp_path = temp_file.name
-            
-        # Decode base64 and write to file
-        audio_bytes = base64.b64decode(audio_data)
-        with open(temp_path, 'wb') as f:
-            f.write(audio_bytes)
-            
-        # Open the WAV file
-        wf = wave.open(temp_path, 'rb')
-        
-        # Create PyAudio instance
-        audio = pyaudio.PyAudio()
-        
-        # Open stream
-        stream = audio.open(format=audio.get_format_from_width(wf.getsampwidth()),
-                          channels=wf.getnchannels(),
-                          rate=wf.getframerate(),
-                          output=True)
-        
-        # Read and play data
-        data = wf.readframes(1024)
-        while data:
-            stream.write(data)
-            data = wf.readframes(1024)
-            
-        # Stop and close
-        stream.stop_stream()
-        stream.close()
-        audio.terminate()
-        
-        # Clean up
-        os.unlink(temp_path)
-        
-        return {'success': True}
+        global voice_player
+        if voice_player is None:
+            voice_player = VoicePlayer()
+        duration = voice_player.play(audio_data)
+        return {'success': True, 'duration': round(duration, 2)}
     
     except Exception as e:
         print(f"[AUDIO] Playback error: {e}")
-        return {'success': False, 'message': str(e)}
\ No newline at end of file
+        return {'success': False, 'message': str(e)}
+
+@eel.expose
+def stop_audio_playback():
+    """Stop the voice message that is playing and any queued behind it"""
+    if voice_player:
+        voice_player.skip()
+    return {'success': True}
@@ -0,0 +1,525 @@
+#!/usr/bin/env python3
+"""
+audio_relay.py - Server-side audio relay on the audio port (5557)
+Clients join a room and stream PCM in; a mixer thread ticks every 20 ms, takes
+one frame per speaker from the room's ServerAudioHandler and sends each
+participant the mix of everyone else. A call costs every client one stream up
+and one down however big it gets, instead of the N-1 uploads of the browser
+mesh.
+
+UDP (see backend/audio_transport.py) is the main transport: each speaker gets a
+jitter buffer the mixer pops once per tick, so reordering and loss on the way
+in are smoothed out and concealed before mixing. TCP on the same port number
+remains for networks that block UDP, with the same binary frames plus a length
+field. Either way a client's first message is a JOIN whose payload is
+{"username", "room"} as JSON.
+Usage: python -m backend.audio_relay [--port 5557]
+"""
+
+import argparse
+import json
+import queue
+import socket
+import threading
+import time
+from typing import Dict, List, Optional
+
+from backend.audio_dsp import Mixer, Reblocker
+from backend.audio_transport import (AUDIO, FRAME_SECONDS, FRAME_SIZE, JOIN, JOINED, KEEPALIVE, LEAVE,
+                                     MAX_DATAGRAM, PARTICIPANTS, PEER_TIMEOUT, SAMPLE_RATE, SILENCE,
+                                     SILENCE_PAYLOAD, FrameReader, FrameRing, FrameSender, JitterBuffer, get_numpy,
+                                     pack_json, silence_level, unpack)
+from backend.logger import get_logger
+from backend.metrics import registry
+
+log = get_logger('audio')
+
+AUDIO_PORT = 5557
+TICK = FRAME_SECONDS
+MAX_BUFFERED = 5  # Frames a speaker may run ahead of the mixer (100 ms) before the oldest go
+OUTBOX_FRAMES = 10  # Mixes queued for a slow listener before new ones are dropped
+CONTROL_KINDS = {'joined': JOINED, 'participants': PARTICIPANTS}
+
+audio_frames = registry.counter('audio_frames', "Audio frames through the relay", labels=('direction',))
+audio_frames_dropped = registry.counter('audio_frames_dropped', "Audio frames the relay dropped", labels=('reason',))
+audio_mix_seconds = registry.histogram('audio_mix_seconds', "Time to mix and queue one tick for every room")
+audio_late_ticks = registry.counter('audio_late_ticks', "Mixer ticks skipped because the mixer fell behind")
+audio_mix_errors = registry.counter('audio_mix_errors', "Rooms whose mixer tick failed with an error")
+
+
+class ServerAudioHandler:
+    """Mixes one room: a short ring of inbound frames per speaker, mixed N-1 each tick"""
+
+    def __init__(self, audio_port: int = AUDIO_PORT):
+        self.audio_port = audio_port
+        self.participant_streams: Dict[str, FrameRing] = {}
+        self.mixer = Mixer()
+        self.speakers = 0  # Frames mixed in the last tick
+        self.running = False
+
+    def add_participant(self, username: str) -> FrameRing:
+        """Add participant to audio session"""
+        self.participant_streams[username] = FrameRing(MAX_BUFFERED)
+        log.info("Added audio participant %s", username)
+        return self.participant_streams[username]
+
+    def remove_participant(self, username: str):
+        """Remove participant from audio session"""
+        if self.participant_streams.pop(username, None) is not None:
+            log.info("Removed audio participant %s", username)
+
+    def process_audio_frame(self, username: str, audio_data):
+        """Buffer one FRAME_SIZE frame from a speaker for the coming ticks.
+
+        Called only from the thread that reads that speaker (its TCP
+        connection, or the mixer for UDP), so each ring has one producer.
+        """
+        stream = self.participant_streams.get(username)
+        if stream is not None and not stream.write(audio_data):
+            # Speaker's clock runs ahead of ours; a full ring bounds the latency that adds
+            audio_frames_dropped.labels('overrun').inc()
+
+    def mix_tick(self) -> Dict[str, object]:
+        """Take one frame per speaker; returns each listener's mix of everyone else.
+
+        Listeners with nothing to hear (nobody else spoke this tick) are left
+        out, so a silent room sends nothing.
+        """
+        speakers, frames = [], []
+        for username, stream in list(self.participant_streams.items()):
+            frame = stream.read()
+            if frame is not None:
+                frames.append(frame)
+                speakers.append(username)
+        self.speakers = len(frames)
+        if not frames:
+            return {}
+
+        mixed = self.mixer.mix(frames)
+        everyone = mixed[len(frames)]
+        mixes = {username: everyone for username in list(self.participant_streams)}
+        if len(frames) > 1:
+            mixes.update(zip(speakers, mixed))
+        else:
+            mixes.pop(speakers[0], None)  # Alone on the air: nothing to hear
+        return mixes
+
+
+class Participant:
+    """One TCP connection on the audio port; mixes leave through its own sender thread"""
+
+    stream = 0
+    jitter = None  # TCP delivers in order; its frames go straight to the handler
+    noise = 0  # Background level from the speaker's last SILENCE
+    hearing = False  # Got a mix last tick; a SILENCE follows when the mixes stop
+
+    def __init__(self, sock: socket.socket, address, username: str, room: str):
+        self.sock = sock
+        self.address = address
+        self.username = username
+        self.room = room
+        self.outbox: queue.Queue = queue.Queue(maxsize=OUTBOX_FRAMES)
+        self.thread = threading.Thread(target=self._send_loop, name=f'audio-send-{username}', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def send(self, frame: Optional[tuple]) -> bool:
+        """Queue (kind, seq, timestamp, payload) for the sender thread without blocking; None stops it"""
+        try:
+            self.outbox.put_nowait(frame)
+            return True
+        except queue.Full:
+            return False
+
+    def send_mix(self, mix, tick: int) -> bool:
+        return self.send((AUDIO, tick, tick * FRAME_SIZE, mix))
+
+    def send_silence(self, level: int, tick: int) -> bool:
+        return self.send((SILENCE, tick, tick * FRAME_SIZE, SILENCE_PAYLOAD.pack(level)))
+
+    def send_json(self, message: Dict):
+        # Control messages are rare and must not be dropped like audio
+        self.outbox.put((CONTROL_KINDS[message['type']], 0, 0, json.dumps(message).encode('utf-8')))
+
+    def close(self):
+        """Make the reader thread see EOF and leave"""
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def stopped(self):
+        self.send(None)
+
+    def _send_loop(self):
+        sender = FrameSender(self.sock, framed=True)
+        while True:
+            frame = self.outbox.get()
+            if frame is None:
+                return
+            kind, seq, timestamp, payload = frame
+            try:
+                sender.send(kind, self.stream, seq, timestamp, payload)
+            except OSError:
+                # The reader notices the dead socket and removes us
+                try:
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                return
+
+
+class UdpParticipant:
+    """A client on the UDP port, known by its address and the stream id it was given"""
+
+    def __init__(self, sock: socket.socket, sender: FrameSender, address, username: str, room: str, stream: int):
+        self.sock = sock
+        self.sender = sender  # The relay's, used only from the mixer thread
+        self.address = address
+        self.username = username
+        self.room = room
+        self.stream = stream
+        self.jitter = JitterBuffer()
+        self.last_seen = time.monotonic()
+        self.seq = 0
+        self.noise = 0
+        self.hearing = False
+
+    def start(self):
+        pass
+
+    def send_mix(self, mix, tick: int) -> bool:
+        self.seq += 1
+        try:
+            self.sender.send(AUDIO, self.stream, self.seq, tick * FRAME_SIZE, mix, self.address)
+            return True
+        except OSError:
+            return False
+
+    def send_silence(self, level: int, tick: int) -> bool:
+        self.seq += 1
+        try:
+            self.sender.send(SILENCE, self.stream, self.seq, tick * FRAME_SIZE, SILENCE_PAYLOAD.pack(level),
+                             self.address)
+            return True
+        except OSError:
+            return False
+
+    def send_json(self, message: Dict):
+        try:
+            self.sock.sendto(pack_json(CONTROL_KINDS[message['type']], message, self.stream), self.address)
+        except OSError:
+            pass
+
+    def close(self):
+        pass
+
+    def stopped(self):
+        pass
+
+
+class Room:
+    def __init__(self, name: str):
+        self.name = name
+        self.handler = ServerAudioHandler()
+        self.participants: Dict[str, Participant] = {}
+        self.failing = False  # The last tick raised; logged once until a tick succeeds
+
+
+class AudioRelay:
+    """Accepts audio connections, keeps rooms and runs the 20 ms mixer"""
+
+    def __init__(self, host: str = '0.0.0.0', port: int = AUDIO_PORT):
+        self.host = host
+        self.port = port
+        self.rooms: Dict[str, Room] = {}
+        self.udp_peers: Dict[tuple, UdpParticipant] = {}
+        self.lock = threading.Lock()
+        self.running = False
+        self.sock: Optional[socket.socket] = None
+        self.udp: Optional[socket.socket] = None
+        self.udp_sender: Optional[FrameSender] = None
+        self._next_stream = 0
+        self.active_speakers = 0
+        registry.gauge('audio_active_speakers', "Speakers mixed in the last tick, across rooms",
+                       fn=lambda: self.active_speakers)
+        registry.gauge('audio_rooms', "Audio rooms with at least one participant", fn=lambda: len(self.rooms))
+        registry.gauge('audio_participants', "Connections in audio rooms",
+                       fn=lambda: sum(len(room.participants) for room in list(self.rooms.values())))
+
+    def start(self, sock: Optional[socket.socket] = None) -> 'AudioRelay':
+        """Bind TCP (unless handed a listening socket) and UDP on the same port, then start the threads"""
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((self.host, self.port))
+            sock.listen(64)
+        self.sock = sock
+        self.port = sock.getsockname()[1]
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        self.udp.bind((self.host, self.port))
+        self.udp_sender = FrameSender(self.udp)
+        self.running = True
+        threading.Thread(target=self._accept_loop, name='audio-accept', daemon=True).start()
+        threading.Thread(target=self._udp_loop, name='audio-udp', daemon=True).start()
+        threading.Thread(target=self._mix_loop, name='audio-mixer', daemon=True).start()
+        log.info("Audio relay listening on %s:%s (TCP and UDP)", self.host, self.port)
+        return self
+
+    def stop(self):
+        self.running = False
+        for sock in (self.sock, self.udp):
+            if sock:
+                try:
+                    sock.close()
+                except OSError:
+                    pass
+        with self.lock:
+            participants = [p for room in self.rooms.values() for p in room.participants.values()]
+        for participant in participants:
+            participant.close()
+
+    def _accept_loop(self):
+        while self.running:
+            try:
+                client, address = self.sock.accept()
+            except OSError:
+                if self.running:
+                    log.exception("Audio accept failed")
+                return
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self._handle, args=(client, address), daemon=True).start()
+
+    def _handle(self, sock: socket.socket, address):
+        """Reader for one connection: join, then frames until it closes"""
+        reader = FrameReader(sock)
+        participant = None
+        try:
+            first = reader.read()
+            join = json.loads(bytes(first[5])) if first is not None and first[0] == JOIN else None
+            if not isinstance(join, dict) or not join.get('username'):
+                log.warning("Audio connection from %s did not join a room", address[0])
+                return
+            participant = self._join(sock, address, str(join['username']), str(join.get('room') or 'global'))
+            handler = self.rooms[participant.room].handler
+
+            np = get_numpy()
+            reblocker = Reblocker()
+            while self.running:
+                frame = reader.read()
+                if frame is None or frame[0] == LEAVE:
+                    break
+                if frame[0] == SILENCE:
+                    participant.noise = silence_level(frame[5])
+                    reblocker.reset()  # A partial frame would otherwise open the next talkspurt
+                    continue
+                if frame[0] != AUDIO:
+                    continue
+                if len(frame[5]) % 2:
+                    audio_frames_dropped.labels('malformed').inc()
+                    continue
+                # Older clients send whatever block size their device likes; the mixer wants 20 ms
+                for samples in reblocker.push(np.frombuffer(frame[5], dtype=np.int16)):
+                    handler.process_audio_frame(participant.username, samples)
+                    audio_frames.labels('in').inc()
+        except (OSError, ValueError) as e:
+            log.debug("Audio connection from %s ended: %s", address[0], e)
+        finally:
+            if participant is not None:
+                self._leave(participant)
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+    def _join(self, sock: socket.socket, address, username: str, room_name: str) -> Participant:
+        return self._add(Participant(sock, address, username, room_name))
+
+    def _add(self, participant):
+        username, room_name = participant.username, participant.room
+        with self.lock:
+            room = self.rooms.get(room_name)
+            if room is None:
+                room = self.rooms[room_name] = Room(room_name)
+            previous = room.participants.get(username)
+            room.participants[username] = participant
+            room.handler.add_participant(username)
+            if isinstance(participant, UdpParticipant):
+                self.udp_peers[participant.address] = participant
+            if previous is not None and self.udp_peers.get(previous.address) is previous:
+                del self.udp_peers[previous.address]
+            others = list(room.participants.values())
+        if previous is not None:
+            # Same user reconnecting: the new connection wins
+            previous.close()
+        participant.start()
+        participant.send_json({'type': 'joined', 'room': room_name, 'stream': participant.stream,
+                               'sample_rate': SAMPLE_RATE, 'frame_size': FRAME_SIZE})
+        self._announce(room_name, others)
+        log.info("%s joined audio room %s from %s", username, room_name, participant.address[0])
+        return participant
+
+    def _leave(self, participant):
+        with self.lock:
+            if self.udp_peers.get(participant.address) is participant:
+                del self.udp_peers[participant.address]
+            room = self.rooms.get(participant.room)
+            if room is None or room.participants.get(participant.username) is not participant:
+                others = []
+            else:
+                del room.participants[participant.username]
+                room.handler.remove_participant(participant.username)
+                others = list(room.participants.values())
+                if not others:
+                    del self.rooms[participant.room]
+        participant.stopped()
+        if others:
+            self._announce(participant.room, others)
+        log.info("%s left audio room %s", participant.username, participant.room)
+
+    def _announce(self, room_name: str, participants: List[Participant]):
+        message = {'type': 'participants', 'room': room_name,
+                   'participants': sorted(p.username for p in participants)}
+        for participant in participants:
+            participant.send_json(message)
+
+    def _udp_loop(self):
+        """Datagrams from every UDP client: joins, keepalives and audio into each speaker's jitter buffer"""
+        buffer = bytearray(MAX_DATAGRAM)
+        view = memoryview(buffer)
+        while self.running:
+            try:
+                n, address = self.udp.recvfrom_into(buffer)
+            except ConnectionResetError:
+                continue  # Windows reports an earlier send's ICMP unreachable here
+            except OSError:
+                if self.running:
+                    log.exception("Audio UDP receive failed")
+                return
+            try:
+                kind, _, stream, seq, timestamp, payload = unpack(view[:n])
+            except ValueError:
+                audio_frames_dropped.labels('malformed').inc()
+                continue
+
+            peer = self.udp_peers.get(address)
+            if kind == AUDIO:
+                if peer is None or stream != peer.stream:
+                    audio_frames_dropped.labels('unknown_peer').inc()
+                    continue
+                peer.last_seen = time.monotonic()
+                if peer.jitter.put(seq, timestamp, payload, peer.last_seen):
+                    audio_frames.labels('in').inc()
+                else:
+                    audio_frames_dropped.labels('late').inc()
+            elif kind == KEEPALIVE:
+                if peer is not None:
+                    peer.last_seen = time.monotonic()
+            elif kind == SILENCE:
+                if peer is not None and stream == peer.stream:
+                    peer.last_seen = time.monotonic()
+                    peer.noise = silence_level(payload)
+                    peer.jitter.end(seq)
+            elif kind == JOIN:
+                if peer is not None:
+                    # Our reply was lost and the client asked again
+                    peer.last_seen = time.monotonic()
+                    peer.send_json({'type': 'joined', 'room': peer.room, 'stream': peer.stream,
+                                    'sample_rate': SAMPLE_RATE, 'frame_size': FRAME_SIZE})
+                    continue
+                try:
+                    join = json.loads(bytes(payload))
+                    username, room_name = str(join['username']), str(join.get('room') or 'global')
+                except (ValueError, KeyError, TypeError):
+                    log.warning("Bad audio join from %s", address[0])
+                    continue
+                self._next_stream = self._next_stream % 0xFFFF + 1
+                self._add(UdpParticipant(self.udp, self.udp_sender, address, username, room_name, self._next_stream))
+            elif kind == LEAVE and peer is not None:
+                self._leave(peer)
+
+    def _expire_udp_peers(self):
+        cutoff = time.monotonic() - PEER_TIMEOUT
+        for peer in [p for p in list(self.udp_peers.values()) if p.last_seen < cutoff]:
+            log.info("Audio peer %s timed out", peer.username)
+            self._leave(peer)
+
+    def _mix_room(self, room: Room, tick: int) -> int:
+        """One tick for one room: play out jitter buffers, mix, send; returns the speakers mixed"""
+        for participant in list(room.participants.values()):
+            if participant.jitter is not None:
+                frame = participant.jitter.pop()
+                if frame is not None:
+                    room.handler.process_audio_frame(participant.username, frame)
+        mixes = room.handler.mix_tick() if room.participants else {}
+        participants = list(room.participants.values())
+        for participant in participants:
+            mix = mixes.get(participant.username)
+            if mix is not None:
+                participant.hearing = True
+                if participant.send_mix(mix, tick):
+                    audio_frames.labels('out').inc()
+                else:
+                    audio_frames_dropped.labels('slow_listener').inc()
+            elif participant.hearing:
+                # Everyone else went quiet: end the talkspurt and pass on the room's background
+                participant.hearing = False
+                level = max((p.noise for p in participants if p is not participant), default=0)
+                participant.send_silence(level, tick)
+        return room.handler.speakers
+
+    def _mix_loop(self):
+        """Every 20 ms: one mix per listener, handed to their sender thread or socket"""
+        next_tick = time.monotonic()
+        tick = 0
+        while self.running:
+            started = time.monotonic()
+            tick += 1
+            speakers = 0
+            with self.lock:
+                rooms = list(self.rooms.values())
+            for room in rooms:
+                # One room's failure must not stop the only mixer thread, and with it every other room
+                try:
+                    speakers += self._mix_room(room, tick)
+                    room.failing = False
+                except Exception:
+                    audio_mix_errors.inc()
+                    if not room.failing:
+                        log.exception("Mixing room %s failed", room.name)
+                    room.failing = True
+            self.active_speakers = speakers
+            audio_mix_seconds.observe(time.monotonic() - started)
+            if tick % 50 == 0:
+                try:
+                    self._expire_udp_peers()
+                except Exception:
+                    log.exception("Expiring audio peers failed")
+
+            next_tick += TICK
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -TICK:
+                # More than a tick behind: resync instead of bursting to catch up
+                audio_late_ticks.inc()
+                next_tick = time.monotonic()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Shadow Nexus audio relay")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=AUDIO_PORT)
+    args = parser.parse_args()
+    relay = AudioRelay(args.host, args.port).start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        relay.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+"""
+audio_transport.py - Datagram format, jitter buffer and loss concealment for call audio
+Shared by the audio relay and AudioEngine. Audio travels as one 20 ms frame per
+UDP datagram behind a small binary header, so a lost packet costs 20 ms of
+concealed audio instead of a TCP retransmit stall for everything behind it.
+
+TCP, for networks that block UDP, carries the same header plus a payload
+length. Senders pack headers into a preallocated buffer and hand header and
+payload to one sendmsg() call, so a frame goes out without being copied or
+concatenated first; TCP readers recv_into a preallocated buffer.
+
+Receivers put datagrams into a JitterBuffer as they arrive and pop one frame
+per 20 ms tick. The buffer holds back just enough audio to ride out the
+arrival jitter it has recently seen, and fills gaps by repeating the last
+frame with a fade to silence. Between threads inside one process, frames
+move through preallocated FrameRings instead of queues.
+
+Senders stop sending while nobody talks. The last frame of a talkspurt is
+followed by a SILENCE carrying the background noise level, which tells the
+receiver's JitterBuffer that the gap ahead is not loss and gives it a level
+to fill that gap with comfort noise. The timestamp keeps counting captured
+samples through the silence; the sequence number counts sent datagrams only.
+"""
+
+import collections
+import json
+import math
+import socket
+import struct
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+SAMPLE_RATE = 16000
+FRAME_SIZE = SAMPLE_RATE // 50  # 20 ms frames
+FRAME_BYTES = FRAME_SIZE * 2
+FRAME_SECONDS = FRAME_SIZE / SAMPLE_RATE
+
+# kind, flags, stream id, sequence number, timestamp (in samples)
+HEADER = struct.Struct('!BBHII')
+# The same fields plus the payload length, for TCP where there are no datagram boundaries
+FRAME_HEADER = struct.Struct('!BBHIIH')
+MAX_DATAGRAM = 2048
+MAX_PAYLOAD = 0xFFFF
+
+# Datagram kinds
+JOIN, JOINED, AUDIO, LEAVE, KEEPALIVE, PARTICIPANTS, SILENCE = range(1, 8)
+# A SILENCE payload: the sender's background noise RMS, for the receiver's comfort noise
+SILENCE_PAYLOAD = struct.Struct('!H')
+
+KEEPALIVE_INTERVAL = 2.0  # seconds between keepalives from a connected client
+PEER_TIMEOUT = 10.0  # seconds of silence from a UDP peer before the relay drops it
+
+# Lazy import: numpy is only needed once audio flows
+_numpy = None
+
+
+def get_numpy():
+    global _numpy
+    if _numpy is None:
+        import numpy as np
+        _numpy = np
+    return _numpy
+
+
+def pack(kind: int, stream: int = 0, seq: int = 0, timestamp: int = 0, payload: bytes = b'', flags: int = 0) -> bytes:
+    return HEADER.pack(kind, flags, stream, seq & 0xFFFFFFFF, timestamp & 0xFFFFFFFF) + payload
+
+
+def pack_json(kind: int, message: Dict, stream: int = 0) -> bytes:
+    return pack(kind, stream, payload=json.dumps(message).encode('utf-8'))
+
+
+def pack_frame(kind: int, payload: bytes = b'', stream: int = 0, seq: int = 0, timestamp: int = 0) -> bytes:
+    """One TCP frame, for control messages; audio goes through a FrameSender"""
+    return FRAME_HEADER.pack(kind, 0, stream, seq & 0xFFFFFFFF, timestamp & 0xFFFFFFFF, len(payload)) + payload
+
+
+def silence_level(payload) -> int:
+    """Noise RMS from a SILENCE payload; 0 (plain silence) if there is none"""
+    return SILENCE_PAYLOAD.unpack_from(payload)[0] if len(payload) >= SILENCE_PAYLOAD.size else 0
+
+
+def unpack(datagram: bytes) -> Tuple[int, int, int, int, int, memoryview]:
+    """(kind, flags, stream, seq, timestamp, payload); raises ValueError on a runt"""
+    if len(datagram) < HEADER.size:
+        raise ValueError(f"datagram of {len(datagram)} bytes is shorter than the header")
+    kind, flags, stream, seq, timestamp = HEADER.unpack_from(datagram)
+    return kind, flags, stream, seq, timestamp, memoryview(datagram)[HEADER.size:]
+
+
+class FrameSender:
+    """Sends frames with the header packed into a preallocated buffer.
+
+    With sendmsg() (everywhere but Windows) header and payload leave in one
+    scatter-gather call straight from their own buffers; otherwise the
+    payload is copied once into the preallocated buffer behind the header.
+    Not thread-safe: give each sending thread its own.
+    """
+
+    def __init__(self, sock: socket.socket, framed: bool = False, max_payload: int = 4096):
+        self.sock = sock
+        self.framed = framed  # TCP: the header carries the payload length
+        self.header = FRAME_HEADER if framed else HEADER
+        self.buffer = bytearray(self.header.size + max_payload)
+        self.view = memoryview(self.buffer)
+        self.head = self.view[:self.header.size]
+        self.scatter = hasattr(sock, 'sendmsg')
+
+    def send(self, kind: int, stream: int, seq: int, timestamp: int, payload, address=None, flags: int = 0):
+        """payload is bytes or a C-contiguous numpy frame, passed through as-is.
+
+        Wrapping a numpy frame in memoryview().cast() costs more than copying
+        640 bytes, so the payload is never converted on the fast path.
+        """
+        size = self.header.size
+        length = payload.nbytes if hasattr(payload, 'nbytes') else len(payload)
+        if self.framed:
+            self.header.pack_into(self.buffer, 0, kind, flags, stream, seq & 0xFFFFFFFF, timestamp & 0xFFFFFFFF,
+                                  length)
+        else:
+            self.header.pack_into(self.buffer, 0, kind, flags, stream, seq & 0xFFFFFFFF, timestamp & 0xFFFFFFFF)
+
+        if self.scatter:
+            parts = (self.head, payload)
+            sent = self.sock.sendmsg(parts) if address is None else self.sock.sendmsg(parts, (), 0, address)
+            if sent < size + length:
+                # Short write on a full TCP buffer: finish the frame the ordinary way
+                self.sock.sendall((bytes(self.head) + bytes(payload))[sent:])
+            return
+
+        end = size + length
+        if end > len(self.buffer):
+            data = bytes(self.head) + bytes(payload)  # Larger than any audio frame; control messages only
+        else:
+            self.view[size:end] = memoryview(payload).cast('B')
+            data = self.view[:end]
+        if address is not None:
+            self.sock.sendto(data, address)
+        elif self.framed:
+            self.sock.sendall(data)
+        else:
+            self.sock.send(data)
+
+
+class FrameReader:
+    """Reads TCP frames into one preallocated buffer"""
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.buffer = bytearray(FRAME_HEADER.size + MAX_PAYLOAD)
+        self.view = memoryview(self.buffer)
+
+    def _fill(self, start: int, end: int) -> bool:
+        while start < end:
+            n = self.sock.recv_into(self.view[start:end])
+            if not n:
+                return False
+            start += n
+        return True
+
+    def read(self) -> Optional[Tuple[int, int, int, int, int, memoryview]]:
+        """Next (kind, flags, stream, seq, timestamp, payload), or None at EOF.
+
+        The payload view is only valid until the next read.
+        """
+        size = FRAME_HEADER.size
+        if not self._fill(0, size):
+            return None
+        kind, flags, stream, seq, timestamp, length = FRAME_HEADER.unpack_from(self.buffer)
+        if not self._fill(size, size + length):
+            return None
+        return kind, flags, stream, seq, timestamp, self.view[size:size + length]
+
+
+class FrameRing:
+    """Single-producer/single-consumer ring of fixed-size int16 frames.
+
+    Frames are copied into one preallocated array, so the audio path does not
+    allocate per frame, and there is no lock: each cursor only ever moves
+    forward and is written by one side, and the producer fills a slot before
+    publishing it. One thread writes, one thread reads.
+    A full ring drops the incoming frame (an overrun); reading an empty one
+    returns None (an underrun).
+    """
+
+    def __init__(self, capacity: int, frame_size: int = FRAME_SIZE):
+        np = get_numpy()
+        self.capacity = capacity
+        self.frame_size = frame_size
+        # One spare slot keeps the frame handed out by the last read() intact until the next
+        self.slots = np.zeros((capacity + 1, frame_size), dtype=np.int16)
+        self.write_pos = 0
+        self.read_pos = 0
+        self.overruns = 0
+        self.underruns = 0
+
+    def __len__(self) -> int:
+        return self.write_pos - self.read_pos
+
+    def write(self, frame) -> bool:
+        """Copy one frame in (shorter frames are zero-padded); False if the ring was full"""
+        if self.write_pos - self.read_pos >= self.capacity:
+            self.overruns += 1
+            return False
+        slot = self.slots[self.write_pos % len(self.slots)]
+        length = min(len(frame), self.frame_size)
+        slot[:length] = frame[:length]
+        slot[length:] = 0
+        self.write_pos += 1
+        return True
+
+    def read(self):
+        """The oldest frame as a view into the ring, valid until the next read(); None if empty"""
+        if self.read_pos == self.write_pos:
+            self.underruns += 1
+            return None
+        frame = self.slots[self.read_pos % len(self.slots)]
+        self.read_pos += 1
+        return frame
+
+    def clear(self):
+        """Consumer side: drop everything buffered"""
+        self.read_pos = self.write_pos
+
+
+class Concealer:
+    """Packet loss concealment: repeat the last good frame, fading to silence"""
+
+    FADE_FRAMES = 5  # 100 ms from a full repeat to silence
+
+    def __init__(self, frame_size: int = FRAME_SIZE):
+        self.frame_size = frame_size
+        self.last = None
+        self.run = 0  # Consecutive frames concealed so far
+
+    def good(self, frame):
+        self.last = frame
+        self.run = 0
+        return frame
+
+    def conceal(self):
+        np = get_numpy()
+        self.run += 1
+        if self.last is None or self.run > self.FADE_FRAMES:
+            return np.zeros(self.frame_size, dtype=np.int16)
+        # Linear gain ramp across the whole run, so consecutive repeats join up without a step
+        start = 1.0 - (self.run - 1) / self.FADE_FRAMES
+        end = 1.0 - self.run / self.FADE_FRAMES
+        ramp = np.linspace(start, end, self.frame_size, endpoint=False, dtype=np.float32)
+        return (self.last * ramp).astype(np.int16)
+
+
+class JitterBuffer:
+    """Reorders frames by sequence number and releases them at a steady 20 ms pace.
+
+    The target depth follows the spread of recent transit times (arrival
+    clock minus sender timestamp): the 95th percentile above the fastest
+    packet, rounded up to whole frames, plus one. Playback starts once the
+    target is buffered. A missing frame is concealed; it is only given up
+    once a full target of newer audio is buffered, and until then the buffer
+    waits for it, which is how underruns deepen the buffer. A frame that
+    arrives after it was given up is dropped as late, and a buffer holding
+    more than it turns out to need drops a frame to catch up. After IDLE_FRAMES empty ticks in a row the
+    stream counts as stopped and pop() returns None until it resumes; a
+    SILENCE passed to end() stops it as soon as the talkspurt has played out.
+    """
+
+    WINDOW = 100  # Transit samples the target is computed from (2 s of audio)
+    IDLE_FRAMES = 10
+    CATCHUP_FRAMES = 25  # Frames per catch-up check (0.5 s)
+
+    def __init__(self, min_frames: int = 1, max_frames: int = 10, frame_size: int = FRAME_SIZE,
+                 sample_rate: int = SAMPLE_RATE):
+        self.min_frames = min_frames
+        self.max_frames = max_frames
+        self.frame_size = frame_size
+        self.sample_rate = sample_rate
+        self.frame_seconds = frame_size / sample_rate
+        self.target = min_frames
+        self.slots: Dict[int, Tuple[bytes, float]] = {}  # seq -> (payload, arrival)
+        self.next_seq: Optional[int] = None  # None while buffering (not playing)
+        self.empty_ticks = 0
+        self.waiting = False  # Concealing while the frame due next may still arrive
+        self.end_seq: Optional[int] = None  # Sequence number of the SILENCE ending this talkspurt
+        self.concealer = Concealer(frame_size)
+        self._min_wait = math.inf  # Shortest time a played frame sat in the buffer this check
+        self._waits = 0
+        self.lock = threading.Lock()
+        self._transits = collections.deque(maxlen=self.WINDOW)
+        self._since_update = 0
+
+        self.received = self.played = self.concealed = self.late = self.dropped = 0
+
+    def put(self, seq: int, timestamp: int, payload: bytes, now: Optional[float] = None) -> bool:
+        """Store one frame; False if it is late, a duplicate or malformed"""
+        if len(payload) != self.frame_size * 2:
+            return False
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            self.received += 1
+            self._transits.append(now - timestamp / self.sample_rate)
+            self._since_update += 1
+            if self._since_update >= 10:
+                self._update_target()
+
+            if self.next_seq is not None:
+                if seq < self.next_seq:
+                    if self.next_seq - seq > 4 * self.max_frames:
+                        self._reset()  # Sender restarted its sequence
+                    else:
+                        self.late += 1
+                        return False
+                elif seq - self.next_seq > 4 * self.max_frames:
+                    self._reset()  # Long gap: start over rather than conceal our way across it
+            if seq in self.slots:
+                return False
+            self.slots[seq] = (bytes(payload), now)
+            return True
+
+    def end(self, seq: int):
+        """The sender went silent after the frame before seq"""
+        with self.lock:
+            if self.next_seq is not None and seq >= self.next_seq:
+                self.end_seq = seq
+            elif self.next_seq is None:
+                # Not playing yet: a talkspurt shorter than the target still gets played out
+                self.end_seq = seq if self.slots else None
+
+    def pop(self, now: Optional[float] = None):
+        """Next frame to play (int16 array), concealed if missing; None while buffering or stopped"""
+        np = get_numpy()
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            if self.next_seq is None:
+                if not self.slots or (len(self.slots) < self.target and self.end_seq is None):
+                    return None
+                self.next_seq = min(self.slots)
+            if self.end_seq is not None and self.next_seq >= self.end_seq:
+                # Talkspurt played out: idle without concealing, keep anything of the next one
+                for seq in [seq for seq in self.slots if seq < self.end_seq]:
+                    del self.slots[seq]
+                self.next_seq = self.end_seq = None
+                self.empty_ticks = 0
+                self.waiting = False
+                self.concealer = Concealer(self.frame_size)
+                return None
+
+            slot = self.slots.pop(self.next_seq, None)
+            # Give up on a missing frame once the newest one buffered (or the SILENCE after the
+            # last) is a full target behind it
+            newest = max(self.slots) if self.slots else -1
+            if self.end_seq is not None:
+                newest = max(newest, self.end_seq)
+            if slot is None and newest >= 0 and newest - self.next_seq >= self.target - 1:
+                self.next_seq += 1
+                if not self.waiting:
+                    self.concealed += 1
+                    return self.concealer.conceal()
+                # A tick was already concealed waiting for it: play what follows in its place
+                slot = self.slots.pop(self.next_seq, None)
+
+            if slot is not None:
+                payload, arrival = slot
+                self.next_seq += 1
+                self.empty_ticks = 0
+                self.waiting = False
+                self.played += 1
+                frame = self.concealer.good(np.frombuffer(payload, dtype=np.int16))
+                if self._catch_up(now - arrival):
+                    if self.slots.pop(self.next_seq, None) is not None:
+                        self.dropped += 1
+                    self.next_seq += 1
+                return frame
+
+            if not self.slots:
+                self.empty_ticks += 1
+                # The tail of a talkspurt that ended gets a target's worth of waiting, not IDLE_FRAMES
+                if self.empty_ticks >= (self.IDLE_FRAMES if self.end_seq is None else self.target):
+                    self._reset()
+                    return None
+            # Underrun: conceal and keep waiting for the frame, which deepens the buffer by a tick
+            self.waiting = True
+            self.concealed += 1
+            return self.concealer.conceal()
+
+    def _catch_up(self, waited: float) -> bool:
+        """Should the next frame be dropped to cut delay?
+
+        At once when far over the target (after a delay spike, say); otherwise
+        when every frame played in the last CATCHUP_FRAMES waited over a frame
+        time, i.e. one frame less would have been buffered without an underrun.
+        """
+        self._min_wait = min(self._min_wait, waited)
+        self._waits += 1
+        if len(self.slots) > self.target + 2:
+            return True
+        if self._waits < self.CATCHUP_FRAMES:
+            return False
+        spare = self._min_wait > 1.25 * self.frame_seconds  # A quarter frame of margin against scheduling noise
+        self._min_wait, self._waits = math.inf, 0
+        return spare
+
+    def _update_target(self):
+        self._since_update = 0
+        transits = sorted(self._transits)
+        spread = transits[min(len(transits) - 1, int(len(transits) * 0.95))] - transits[0]
+        self.target = max(self.min_frames, min(self.max_frames, math.ceil(spread / self.frame_seconds) + 1))
+
+    def _reset(self):
+        self.slots.clear()
+        self.next_seq = self.end_seq = None
+        self.empty_ticks = 0
+        self.waiting = False
+        self._min_wait, self._waits = math.inf, 0
+        self.concealer = Concealer(self.frame_size)
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {'received': self.received, 'played': self.played, 'concealed': self.concealed,
+                    'late': self.late, 'dropped': self.dropped, 'target': self.target, 'buffered': len(self.slots)}
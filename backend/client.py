@@ -18,6 +18,10 @@ import urllib3
 
 # Import certificate manager for automatic SSL setup
 from backend.cert_manager import setup_certificates, verify_and_fix_certificates
+from backend.logger import get_logger
+from backend import swarm
+
+net_log = get_logger('client.net')
 
 # NO .env loading for client! Server IP comes from user input in login screen
 print(f"[CLIENT] Server IP will be set from login screen input")
@@ -91,18 +95,30 @@ class ClientState:
         self.connected = False
         self.files: Dict[str, Dict] = {}
         self.online_users: List[str] = []
+        self.presence_version: Optional[int] = None
         self.groups: Dict[str, Dict] = {}
         self.current_chat_type = 'global'
         self.current_chat_target = None
         self.audio_engine = None
+        self.piece_server: Optional[swarm.PieceServer] = None
 
 state = ClientState()
 
+def get_piece_server() -> Optional[swarm.PieceServer]:
+    """This client's swarm piece server, started on first use (None unless SHADOW_NEXUS_SWARM=1)"""
+    if state.piece_server is None and swarm.swarm_enabled(False):
+        try:
+            state.piece_server = swarm.PieceServer()
+            net_log.info("Serving swarm pieces on port %d", state.piece_server.port)
+        except OSError as e:
+            net_log.warning("Swarm piece server unavailable: %s", e)
+    return state.piece_server
+
 # Socket receive thread
 def receive_messages():
     """Background thread to receive messages with reconnection logic"""
     state.buffer = b""
-    print(f"[CLIENT] Starting receive thread for {state.username}")
+    net_log.info("Starting receive thread for %s", state.username)
     
     reconnect_attempts = 0
     max_reconnect_attempts = 5
@@ -111,7 +127,7 @@ def receive_messages():
     while state.running and state.connected:
         try:
             if not state.socket:
-                print("[CLIENT] No socket, breaking receive loop")
+                net_log.warning("No socket, stopping receive loop")
                 break
             
             # Set a timeout to prevent blocking forever
@@ -119,7 +135,7 @@ def receive_messages():
             try:
                 data = state.socket.recv(4096)
                 if not data:
-                    print("[CLIENT] Connection closed by server")
+                    net_log.info("Connection closed by server")
                     break
             except socket.timeout:
                 # Timeout is normal, just continue
@@ -129,7 +145,6 @@ def receive_messages():
             reconnect_attempts = 0
             
             state.buffer += data
-            print(f"[CLIENT] Received {len(data)} bytes, buffer now {len(state.buffer)} bytes")
             
             while b'\n' in state.buffer:
                 message_data, state.buffer = state.buffer.split(b'\n', 1)
@@ -146,20 +161,45 @@ def receive_messages():
                             try:
                                 pong_msg = json.dumps({'type': 'pong', 'timestamp': datetime.now().strftime("%I:%M %p")}) + '\n'
                                 state.socket.send(pong_msg.encode('utf-8'))
-                                print("[CLIENT] Responded to server ping")
+                                net_log.debug("Responded to server ping")
                             except Exception as e:
-                                print(f"[CLIENT] Failed to send pong: {e}")
+                                net_log.warning("Failed to send pong: %s", e)
                             continue  # Don't forward ping to frontend
                         
                         # Handle pong responses (if we ever send pings)
                         if msg_type == 'pong':
-                            print("[CLIENT] Received pong from server")
+                            net_log.debug("Received pong from server")
                             continue  # Don't forward pong to frontend
                         
                         if msg_type == 'chat_history':
                             state.last_chat_history = message.get('messages', [])
                         elif msg_type == 'user_list':
                             state.last_user_list = message.get('users', [])
+                            state.presence_version = message.get('version')
+                        elif msg_type == 'presence_delta':
+                            # Stale or pre-snapshot deltas are already covered by the snapshot
+                            if state.presence_version is None or message.get('version', 0) <= state.presence_version:
+                                continue
+                            # Missed a delta - ask for a fresh snapshot instead of guessing
+                            if message.get('prev_version') != state.presence_version:
+                                refresh_user_list()
+                                continue
+                            users = set(getattr(state, 'last_user_list', []))
+                            for event in message.get('events', []):
+                                if event.get('username') == state.username:
+                                    continue
+                                if event.get('type') == 'user_joined':
+                                    users.add(event.get('username'))
+                                elif event.get('type') == 'user_left':
+                                    users.discard(event.get('username'))
+                            state.last_user_list = sorted(users)
+                            state.presence_version = message.get('version')
+                            # The UI only understands full lists, so hand it the patched one
+                            message = {
+                                'type': 'user_list',
+                                'users': state.last_user_list,
+                                'version': state.presence_version
+                            }
                         
                         # Try to send to frontend (this might fail)
                         try:
@@ -167,15 +207,15 @@ def receive_messages():
                         except Exception as eel_error:
                             pass  # Silently ignore Eel errors
                     except json.JSONDecodeError as e:
-                        print(f"[CLIENT] Invalid JSON: {e}")
+                        net_log.warning("Invalid JSON: %s", e)
         
         except (ConnectionResetError, BrokenPipeError) as e:
-            print(f"[CLIENT] Connection lost: {e}")
+            net_log.warning("Connection lost: %s", e)
             # Attempt to reconnect if network is temporarily down
             if state.running and reconnect_attempts < max_reconnect_attempts:
                 reconnect_attempts += 1
-                print(f"[CLIENT] Attempting reconnection ({reconnect_attempts}/{max_reconnect_attempts})...")
-                print(f"[CLIENT] Waiting {reconnect_delay:.1f} seconds before retry...")
+                net_log.info("Attempting reconnection (%d/%d) in %.1f seconds...",
+                             reconnect_attempts, max_reconnect_attempts, reconnect_delay)
                 
                 for i in range(int(reconnect_delay)):
                     if not state.running:
@@ -184,7 +224,7 @@ def receive_messages():
                 
                 if state.running:
                     try:
-                        print(f"[CLIENT] Retrying connection to {state.server_host}:{state.server_port}...")
+                        net_log.info("Retrying connection to %s:%s...", state.server_host, state.server_port)
                         new_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                         
                         # Enable TCP keepalive on reconnection too
@@ -203,24 +243,25 @@ def receive_messages():
                         
                         state.socket = new_socket
                         state.buffer = b""
-                        print(f"[CLIENT] ✅ Reconnected successfully!")
+                        state.presence_version = None  # Wait for the welcome snapshot
+                        net_log.info("Reconnected")
                         
                         # Increase delay for next attempt (exponential backoff)
                         reconnect_delay = min(reconnect_delay * 1.5, 60)  # Max 60 second delay
                         continue  # Try receiving again
                     except Exception as retry_error:
-                        print(f"[CLIENT] Reconnection attempt {reconnect_attempts} failed: {retry_error}")
+                        net_log.warning("Reconnection attempt %d failed: %s", reconnect_attempts, retry_error)
                         reconnect_delay = min(reconnect_delay * 1.5, 60)
                 else:
                     break
             else:
                 break
         except Exception as e:
-            print(f"[CLIENT] Receive error: {e}")
+            net_log.error("Receive error: %s", e)
             if state.running:
                 break
     
-    print(f"[CLIENT] Receive thread ending for {state.username}")
+    net_log.info("Receive thread ending for %s", state.username)
     state.running = False
     state.connected = False
     eel.onDisconnected()
@@ -252,6 +293,7 @@ def connect_to_server(username: str, host: str, port: int):
         state.server_port = port
         state.running = False
         state.connected = False
+        state.presence_version = None
         
         print(f"[CLIENT] Connecting to {host}:{port} as {username}")
         print(f"[CLIENT] This IP will be used for video/audio calls: {host}")
@@ -292,6 +334,7 @@ def connect_to_server(username: str, host: str, port: int):
         # Set the global audio_engine reference
         from backend import audio_module
         audio_module.audio_engine = state.audio_engine
+        audio_module.send_voice_message = send_audio_message
         
         # Start receive thread
         thread = threading.Thread(target=receive_messages, daemon=True)
@@ -467,6 +510,14 @@ def upload_file(file_name: str, file_size: int, file_data):
         # Send file data
         sock.sendall(file_bytes)
         
+        # Big files: offer our copy to the swarm so the server isn't the only source
+        piece_server = get_piece_server() if len(file_bytes) >= swarm.SWARM_MIN_SIZE else None
+        if piece_server is not None:
+            piece_server.seed(file_id, file_bytes)
+            threading.Thread(target=swarm.announce, daemon=True,
+                             args=(state.server_host, state.file_port, file_id, piece_server.port,
+                                   state.username, 'all')).start()
+        
         print(f"[CLIENT] File upload complete: {file_name}")
         print(f"[CLIENT] File uploaded successfully: {file_name}")
         return {'success': True, 'file_id': file_id, 'file_name': file_name}
@@ -483,6 +534,18 @@ def download_file(file_id: str):
     if not state.connected:
         return {'success': False, 'message': 'Not connected'}
     
+    piece_server = get_piece_server()
+    if piece_server is not None:
+        try:
+            fetched = swarm.swarm_download(state.server_host, state.file_port, file_id, state.username, piece_server)
+            if fetched is not None:
+                file_name, file_data = fetched
+                file_path = _save_download(file_name, file_data)
+                print(f"[CLIENT] File downloaded via swarm: {file_name}")
+                return {'success': True, 'file_path': file_path}
+        except Exception as e:
+            net_log.warning("Swarm download of %s failed, fetching from the server: %s", file_id, e)
+    
     try:
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.settimeout(300.0)  # 5 minutes timeout to match server for large files
@@ -517,11 +580,7 @@ def download_file(file_id: str):
             file_data += chunk
             bytes_received += len(chunk)
         
-        # Save file
-        downloads_dir = os.path.expanduser('~/Downloads')
-        file_path = os.path.join(downloads_dir, file_name)
-        with open(file_path, 'wb') as f:
-            f.write(file_data)
+        file_path = _save_download(file_name, file_data)
         
         sock.close()
         print(f"[CLIENT] File downloaded: {file_name}")
@@ -531,6 +590,14 @@ def download_file(file_id: str):
         print(f"Download error: {e}")
         return {'success': False, 'message': str(e)}
 
+def _save_download(file_name: str, file_data) -> str:
+    """Write a downloaded file to ~/Downloads and return its path"""
+    downloads_dir = os.path.expanduser('~/Downloads')
+    file_path = os.path.join(downloads_dir, file_name)
+    with open(file_path, 'wb') as f:
+        f.write(file_data)
+    return file_path
+
 @eel.expose
 def set_current_chat(chat_type: str, chat_target: str = None):
     """Set the current chat context for sending messages"""
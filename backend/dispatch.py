@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""
+dispatch.py - Message dispatch with per-type timing, rate limiting and slow-handler tracing
+The handler table is built once per server. Every dispatch is timed per
+message type, and a handler that runs past the slow threshold is logged with
+its payload size, the time it spent blocked on server locks and the stack it
+was stuck in. Each connection gets token buckets per message type and overall;
+messages over the limit are dropped before any handler work is done
+"""
+
+import os
+import sys
+import threading
+import time
+import traceback
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from backend.logger import get_logger
+from backend.metrics import registry
+
+log = get_logger('dispatch')
+slow_log = get_logger('slow')
+
+DEFAULT_SLOW_MS = 100.0
+SLOW_LOG_INTERVAL = 5.0  # seconds between slow reports for one message type
+
+# Message type -> (tokens per second, burst). '*' is the whole connection;
+# types without an entry are only held to that. Clients resend history and list
+# requests on every view switch, so a short burst is normal but a loop is not
+DEFAULT_RATE_LIMITS = 'flood=500,*=100/400,request_chat_history=1/5,request_private_history=4/20,' \
+                      'request_group_history=4/20,request_groups=2/10,get_users=2/10,group_create=1/5,' \
+                      'delete_user_chat=1/5'
+# Dispatch results
+UNKNOWN, HANDLED, THROTTLED = 0, 1, 2
+
+messages_received = registry.counter('chat_messages', "Chat messages received, by type", labels=('type',))
+handler_seconds = registry.histogram('chat_handler_seconds', "Time spent handling one chat message", labels=('type',))
+handler_errors = registry.counter('chat_handler_errors', "Chat handlers that raised, by type", labels=('type',))
+slow_handlers = registry.counter('chat_slow_handlers', "Handlers that ran past the slow threshold", labels=('type',))
+throttled_messages = registry.counter('chat_throttled', "Messages dropped by rate limiting", labels=('type',))
+flood_disconnects = registry.counter('chat_flood_disconnects', "Connections closed for ignoring rate limits")
+lock_wait_seconds = registry.counter('chat_lock_wait_seconds', "Time threads spent blocked on server locks",
+                                     labels=('lock',))
+
+# Lock wait charged to whatever the current thread is handling
+_wait = threading.local()
+
+
+def default_slow_threshold() -> float:
+    """SHADOW_NEXUS_SLOW_HANDLER_MS from the environment, in seconds"""
+    try:
+        return float(os.environ.get('SHADOW_NEXUS_SLOW_HANDLER_MS', DEFAULT_SLOW_MS)) / 1000.0
+    except ValueError:
+        return DEFAULT_SLOW_MS / 1000.0
+
+
+def parse_rate_limits(spec: str) -> Dict[str, Tuple[float, float]]:
+    """'*=100/400,type=rate/burst,...' -> {type: (rate, burst)}.
+
+    A rate without a burst gets one second's worth (at least one token).
+    """
+    limits: Dict[str, Tuple[float, float]] = {}
+    for part in spec.split(','):
+        name, _, value = part.strip().partition('=')
+        if not name or not value:
+            continue
+        rate, _, burst = value.partition('/')
+        try:
+            rate = float(rate)
+            limits[name] = (rate, float(burst) if burst else max(rate, 1.0))
+        except ValueError:
+            log.warning("Ignoring bad rate limit %r", part)
+    return limits
+
+
+def default_rate_limits() -> Tuple[Dict[str, Tuple[float, float]], int]:
+    """(limits, flood drops): defaults overlaid with SHADOW_NEXUS_RATE_LIMITS; 'off' disables"""
+    spec = os.environ.get('SHADOW_NEXUS_RATE_LIMITS', '')
+    if spec.strip().lower() == 'off':
+        return {}, 0
+    limits = parse_rate_limits(DEFAULT_RATE_LIMITS)
+    limits.update(parse_rate_limits(spec))
+    flood = int(limits.pop('flood', (0, 0))[0])
+    # A zero rate lifts the limit for that type
+    return {name: limit for name, limit in limits.items() if limit[0] > 0}, flood
+
+
+class TokenBucket:
+    """Refills at `rate` tokens per second up to `burst`; one token per message"""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def take(self, now: float) -> float:
+        """0.0 if a token was taken, otherwise seconds until one is available"""
+        tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if tokens >= 1.0:
+            self.tokens = tokens - 1.0
+            return 0.0
+        self.tokens = tokens
+        return (1.0 - tokens) / self.rate
+
+
+class RateLimiter:
+    """Token buckets for one connection.
+
+    Only that connection's receive thread calls check(), so nothing here is
+    locked. Buckets for a type are created on its first message.
+    """
+
+    __slots__ = ('limits', 'flood', 'buckets', 'overall', 'drops', 'retry_after', 'notified')
+
+    def __init__(self, limits: Dict[str, Tuple[float, float]], flood: int = 0):
+        self.limits = limits
+        self.flood = flood
+        self.buckets: Dict[str, Optional[TokenBucket]] = {}
+        overall = limits.get('*')
+        self.overall = TokenBucket(*overall) if overall else None
+        self.drops = 0  # Consecutive rejections
+        self.retry_after = 0.0  # Wait returned by the last check()
+        self.notified: Dict[str, float] = {}  # type -> monotonic time the last rejection reply covers
+
+    def check(self, msg_type: str) -> float:
+        """0.0 to admit the message, otherwise seconds the client should wait"""
+        now = time.monotonic()
+        bucket = self.buckets.get(msg_type, False)
+        if bucket is False:
+            limit = self.limits.get(msg_type)
+            bucket = self.buckets[msg_type] = TokenBucket(*limit) if limit else None
+        wait = bucket.take(now) if bucket is not None else 0.0
+        if not wait and self.overall is not None:
+            wait = self.overall.take(now)
+            if wait and bucket is not None:
+                bucket.tokens += 1.0  # Not spent after all
+        self.drops = self.drops + 1 if wait else 0
+        self.retry_after = wait
+        return wait
+
+    @property
+    def flooding(self) -> bool:
+        """True once the client has ignored enough rejections in a row to be cut off"""
+        return 0 < self.flood <= self.drops
+
+    def should_notify(self, msg_type: str) -> bool:
+        """One rejection reply per type per wait period; the rest are dropped silently"""
+        now = time.monotonic()
+        if now < self.notified.get(msg_type, 0.0):
+            return False
+        self.notified[msg_type] = now + self.retry_after
+        return True
+
+
+class TimedLock:
+    """Lock/RLock wrapper that records how long callers block on it.
+
+    An uncontended acquire costs one extra non-blocking attempt; only a
+    blocking acquire is timed.
+    """
+
+    def __init__(self, name: str, lock: Any = None):
+        self._lock = lock if lock is not None else threading.Lock()
+        self._wait_counter = lock_wait_seconds.labels(name)
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        if self._lock.acquire(False):
+            return True
+        if not blocking:
+            return False
+        started = time.perf_counter()
+        try:
+            return self._lock.acquire(True, timeout)
+        finally:
+            waited = time.perf_counter() - started
+            self._wait_counter.inc(waited)
+            _wait.seconds = getattr(_wait, 'seconds', 0.0) + waited
+
+    def release(self) -> None:
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def _handler_stack(frame) -> str:
+    """Formatted stack from the handler call down, without the thread/receive-loop frames above it"""
+    stack = traceback.extract_stack(frame)
+    for i, summary in enumerate(stack):
+        if summary.filename == __file__ and summary.name == 'dispatch':
+            stack = stack[i + 1:]
+            break
+    return ''.join(traceback.format_list(stack))
+
+
+class Dispatcher:
+    """Routes messages by type through a fixed handler table.
+
+    Handlers still running past slow_threshold have their stack sampled by a
+    watchdog thread while they are stuck, so the report shows where the time
+    went rather than where the handler returned from.
+    """
+
+    def __init__(self, handlers: Dict[str, Callable], slow_threshold: Optional[float] = None,
+                 rate_limits: Optional[Tuple[Dict[str, Tuple[float, float]], int]] = None):
+        self.slow_threshold = default_slow_threshold() if slow_threshold is None else slow_threshold
+        self.rate_limits, self.flood_drops = default_rate_limits() if rate_limits is None else rate_limits
+        # type -> (handler, count, timer, errors, throttled): label lookups happen here, not per message
+        self.table = {
+            msg_type: (handler, messages_received.labels(msg_type), handler_seconds.labels(msg_type),
+                       handler_errors.labels(msg_type), throttled_messages.labels(msg_type))
+            for msg_type, handler in handlers.items()
+        }
+        self._unknown = messages_received.labels('unknown')
+        self._unknown_throttled = throttled_messages.labels('unknown')
+
+        self._inflight: Dict[int, list] = {}  # thread id -> [type, started, stack]
+        self._last_report: Dict[str, float] = {}
+        self._suppressed: Dict[str, int] = {}
+        self.running = True
+        if self.slow_threshold > 0:
+            threading.Thread(target=self._watchdog, daemon=True, name='slow-handler-watchdog').start()
+
+    def limiter(self) -> Optional[RateLimiter]:
+        """Fresh rate limiter for a new connection (None when limiting is off)"""
+        if not self.rate_limits:
+            return None
+        return RateLimiter(self.rate_limits, self.flood_drops)
+
+    def dispatch(self, msg_type: str, size: int, *args, limiter: Optional[RateLimiter] = None) -> int:
+        """Run the handler for msg_type.
+
+        Returns HANDLED, UNKNOWN if there is no handler, or THROTTLED if the
+        connection's limiter rejected it (limiter.retry_after says for how long).
+        """
+        entry = self.table.get(msg_type)
+        if limiter is not None and limiter.check(msg_type if entry is not None else 'unknown'):
+            (entry[4] if entry is not None else self._unknown_throttled).inc()
+            if limiter.drops == limiter.flood:
+                flood_disconnects.inc()
+            return THROTTLED
+        if entry is None:
+            # One label for every unknown type keeps clients from inflating the registry
+            self._unknown.inc()
+            return UNKNOWN
+        handler, count, timer, errors, _ = entry
+
+        count.inc()
+        ident = threading.get_ident()
+        _wait.seconds = 0.0
+        started = time.perf_counter()
+        self._inflight[ident] = [msg_type, started, None]
+        try:
+            handler(*args)
+        except Exception:
+            errors.inc()
+            log.exception("Error in handler for %s", msg_type)
+        finally:
+            elapsed = time.perf_counter() - started
+            stack = self._inflight.pop(ident, (None, None, None))[2]
+            timer.observe(elapsed)
+            if self.slow_threshold > 0 and elapsed >= self.slow_threshold:
+                self._report_slow(msg_type, size, elapsed, _wait.seconds, stack)
+        return HANDLED
+
+    def stop(self) -> None:
+        self.running = False
+
+    def _watchdog(self):
+        interval = max(self.slow_threshold / 2, 0.01)
+        while self.running:
+            time.sleep(interval)
+            if not self._inflight:
+                continue
+            deadline = time.perf_counter() - self.slow_threshold
+            frames = None
+            for ident, entry in list(self._inflight.items()):
+                if entry[2] is not None or entry[1] > deadline:
+                    continue
+                if frames is None:
+                    frames = sys._current_frames()
+                frame = frames.get(ident)
+                if frame is not None:
+                    entry[2] = _handler_stack(frame)
+
+    def _report_slow(self, msg_type: str, size: int, elapsed: float, lock_wait: float, stack: Optional[str]):
+        slow_handlers.labels(msg_type).inc()
+        now = time.monotonic()
+        if now - self._last_report.get(msg_type, float('-inf')) < SLOW_LOG_INTERVAL:
+            self._suppressed[msg_type] = self._suppressed.get(msg_type, 0) + 1
+            return
+        self._last_report[msg_type] = now
+        suppressed = self._suppressed.pop(msg_type, 0)
+
+        slow_log.warning(
+            "Slow handler %s: %.1f ms (payload %d bytes, lock wait %.1f ms%s)%s",
+            msg_type, elapsed * 1000, size, lock_wait * 1000,
+            f", {suppressed} more since last report" if suppressed else '',
+            f"\nStack after {self.slow_threshold * 1000:.0f} ms:\n{stack.rstrip()}" if stack else '')
@@ -0,0 +1,474 @@
+#!/usr/bin/env python3
+"""
+file_service.py - File port transfers on one event loop with admission control
+Every upload and download is a small state machine driven by a selector
+thread, so a hundred people pulling the same video cost sockets, not threads.
+Transfers are admitted up to a global cap and a per-user cap (small files have
+a few reserved slots of their own and jump the queue), and the bandwidth is
+shared out in equal slices per round, so a voice clip finishes in one round
+even while multi-GB downloads are running. Swarm control requests (see
+backend/swarm.py) are short and answered on a small worker pool
+"""
+
+import heapq
+import json
+import os
+import selectors
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from backend.logger import get_logger
+from backend.metrics import registry
+from backend.swarm import SwarmTracker, piece_range, swarm_enabled
+
+log = get_logger('files')
+
+# active: transfers moving bytes at once; per_user: of those, per user;
+# small_slots: extra slots only files up to `small` bytes may use;
+# bandwidth: bytes per second across every transfer (0 = unlimited)
+DEFAULT_FILE_LIMITS = 'active=32,per_user=4,small=1M,small_slots=8,bandwidth=0'
+SLICE = 256 * 1024  # Most bytes one transfer moves per round
+MIN_SLICE = 16 * 1024  # Smallest slice worth a syscall when bandwidth is capped
+HEADER_LIMIT = 4096
+IDLE_TIMEOUT = 300.0  # seconds without progress before an admitted transfer is dropped
+UNITS = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+
+file_bytes = registry.counter('file_bytes', "Bytes moved on the file port", labels=('direction',))
+file_transfers = registry.counter('file_transfers', "Finished file transfers", labels=('kind', 'result'))
+file_transfer_seconds = registry.histogram('file_transfer_seconds', "Duration of one file transfer", labels=('kind',))
+file_queue_seconds = registry.histogram('file_queue_seconds', "Time a transfer waited for a slot", labels=('kind',))
+
+# Transfer states
+HEADER, QUEUED, REPLY, RECEIVING, ACK, SENDING = range(6)
+
+
+def parse_size(text: str) -> int:
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def default_file_limits() -> Dict[str, int]:
+    """Defaults overlaid with SHADOW_NEXUS_FILE_LIMITS from the environment"""
+    limits = {}
+    for spec in (DEFAULT_FILE_LIMITS, os.environ.get('SHADOW_NEXUS_FILE_LIMITS', '')):
+        for part in spec.split(','):
+            name, _, value = part.strip().partition('=')
+            if not name or not value:
+                continue
+            try:
+                limits[name] = parse_size(value)
+            except ValueError:
+                log.warning("Ignoring bad file limit %r", part)
+    return limits
+
+
+class Transfer:
+    """One connection on the file port"""
+
+    __slots__ = ('sock', 'address', 'state', 'kind', 'user', 'size', 'offset', 'small', 'header', 'file_id',
+                 'file_name', 'data', 'done', 'out', 'after', 'started', 'queued_at', 'last_io', 'result')
+
+    def __init__(self, sock: socket.socket, address: Tuple):
+        self.sock = sock
+        self.address = address
+        self.state = HEADER
+        self.kind = 'unknown'
+        self.user = address[0]
+        self.size = 0
+        self.offset = 0  # Where a piece download starts in the file
+        self.small = False
+        self.header = bytearray()
+        self.file_id: Optional[str] = None
+        self.file_name = ''
+        self.data: Any = None  # Upload: bytearray being filled; download: memoryview being sent
+        self.done = 0  # Payload bytes moved so far
+        self.out: Optional[memoryview] = None  # Control reply still to write
+        self.after = None  # State to enter once the reply is out (None = close)
+        self.started = self.last_io = time.monotonic()
+        self.queued_at = 0.0
+        self.result = 'error'
+
+
+class FileTransferService:
+    """Runs the file port for a CollaborationServer.
+
+    Uploads are registered with server.register_upload() once they are
+    admitted and their bytes land in server.file_data; downloads are served
+    from server.file_data. Only the loop thread touches transfer state.
+    """
+
+    def __init__(self, server, limits: Optional[Dict[str, int]] = None):
+        self.server = server
+        limits = {**default_file_limits(), **(limits or {})}
+        self.max_active = max(1, limits['active'])
+        self.per_user = max(1, limits['per_user'])
+        self.small = limits['small']
+        self.small_slots = limits['small_slots']
+        self.bandwidth = limits['bandwidth']
+
+        self.selector = selectors.DefaultSelector()
+        self.transfers: Dict[socket.socket, Transfer] = {}
+        self.active = 0
+        self.active_by_user: Dict[str, int] = {}
+        self._queue: List[Tuple[int, int, Transfer]] = []  # (large?, arrival, transfer)
+        self._arrivals = 0
+        self._tokens = float(self.bandwidth)
+        self._refilled = time.monotonic()
+        self._scratch = memoryview(bytearray(SLICE))
+        self._rounds = 0
+        # Manifests and piece announcements; off with SHADOW_NEXUS_SWARM=0
+        self.swarm = SwarmTracker() if swarm_enabled(True) else None
+        self._control = ThreadPoolExecutor(max_workers=2, thread_name_prefix='file-control')
+        self.running = False
+        self._thread: Optional[threading.Thread] = None
+
+        registry.gauge('file_transfers_active', "File transfers moving bytes", fn=lambda: self.active)
+        registry.gauge('file_transfers_queued', "File transfers waiting for a slot", fn=lambda: len(self._queue))
+        registry.gauge('file_connections', "Open file port connections", fn=lambda: len(self.transfers))
+
+    def start(self, listen_socket: socket.socket) -> None:
+        listen_socket.setblocking(False)
+        self.selector.register(listen_socket, selectors.EVENT_READ, None)
+        self.running = True
+        self._thread = threading.Thread(target=self._loop, daemon=True, name='file-transfers')
+        self._thread.start()
+
+    def stop(self) -> None:
+        self.running = False
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=2.0)
+        self._control.shutdown(wait=False)
+
+    # ----- event loop -----
+
+    def _loop(self):
+        next_sweep = time.monotonic() + 1.0
+        while self.running:
+            try:
+                events = self.selector.select(timeout=0.5)
+            except OSError:
+                break  # Listening socket closed under us during shutdown
+            budget = self._refill()
+            ready = []
+            for key, mask in events:
+                transfer = key.data
+                if transfer is None:
+                    self._accept(key.fileobj)
+                elif transfer.state in (RECEIVING, SENDING):
+                    ready.append(transfer)  # Payload moves below, in fair slices
+                else:
+                    self._guarded(self._step, transfer, mask)
+
+            if ready:
+                # Rotate who goes first, so a short budget is not always spent on the same transfers
+                self._rounds += 1
+                first = self._rounds % len(ready)
+                ready = ready[first:] + ready[:first]
+                share = SLICE if budget is None else max(MIN_SLICE, min(SLICE, int(budget) // len(ready)))
+                for transfer in ready:
+                    if budget is not None and self._tokens < MIN_SLICE:
+                        break  # The rest wait for the next round's refill
+                    moved = self._guarded(self._move, transfer, share) or 0
+                    if budget is not None:
+                        self._tokens -= moved
+                if budget is not None and self._tokens < MIN_SLICE:
+                    # Out of budget: sleep until one slice is back rather than spin on ready sockets
+                    time.sleep(min(0.05, (MIN_SLICE - self._tokens) / self.bandwidth))
+
+            now = time.monotonic()
+            if now >= next_sweep:
+                next_sweep = now + 1.0
+                self._sweep(now)
+
+        for transfer in list(self.transfers.values()):
+            self._finish(transfer, 'aborted')
+        self.selector.close()
+
+    def _refill(self) -> Optional[float]:
+        """Bandwidth tokens available this round (None when unlimited)"""
+        if not self.bandwidth:
+            return None
+        now = time.monotonic()
+        # Allow at most a quarter second of burst after an idle spell
+        self._tokens = min(self.bandwidth / 4 + SLICE, self._tokens + (now - self._refilled) * self.bandwidth)
+        self._refilled = now
+        return self._tokens
+
+    def _accept(self, listen_socket: socket.socket):
+        try:
+            sock, address = listen_socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            if self.running:
+                log.error("Error accepting file connection: %s", e)
+            return
+        log.debug("File transfer connection from %s", address)
+        sock.setblocking(False)
+        transfer = Transfer(sock, address)
+        self.transfers[sock] = transfer
+        self.selector.register(sock, selectors.EVENT_READ, transfer)
+
+    def _guarded(self, action, transfer: Transfer, *args):
+        """Run one transfer's step; a bug or bad input ends that transfer, never the loop"""
+        try:
+            return action(transfer, *args)
+        except Exception:
+            log.exception("File transfer from %s failed", transfer.address)
+            self._finish(transfer, 'error')
+            return None
+
+    def _step(self, transfer: Transfer, mask: int):
+        """Advance a transfer that is not moving payload"""
+        try:
+            if transfer.state == REPLY:
+                sent = transfer.sock.send(transfer.out)
+                transfer.out = transfer.out[sent:]
+                if not transfer.out:
+                    self._enter(transfer, transfer.after)
+                return
+
+            chunk = transfer.sock.recv(HEADER_LIMIT)
+            if not chunk:
+                self._finish(transfer, 'aborted' if transfer.state != HEADER else 'error')
+                return
+            transfer.last_io = time.monotonic()
+            if transfer.state == HEADER:
+                transfer.header += chunk
+                self._parse_header(transfer)
+            elif transfer.state == ACK:
+                # Any bytes are the client's go-ahead
+                self._enter(transfer, SENDING)
+            # QUEUED: a client has nothing to say while it waits; ignore it
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError as e:
+            log.warning("File transfer from %s failed: %s", transfer.address, e)
+            self._finish(transfer, 'error')
+
+    def _parse_header(self, transfer: Transfer):
+        try:
+            request = json.loads(transfer.header.decode('utf-8'))
+        except (UnicodeDecodeError, ValueError) as e:
+            if len(transfer.header) >= HEADER_LIMIT:
+                log.warning("Invalid file transfer JSON from %s: %s", transfer.address, e)
+                self._finish(transfer, 'error')
+            return  # Header split across packets - wait for the rest
+
+        if not isinstance(request, dict):
+            log.warning("File transfer header from %s is not an object", transfer.address)
+            self._reply(transfer, {'status': 'error', 'message': 'Invalid request'}, None)
+            return
+        if request.get('swarm'):
+            self._hand_off(transfer, request)
+            return
+        if 'file_name' in request:
+            transfer.kind = 'upload'
+            transfer.file_name = request.get('file_name')
+            try:
+                transfer.size = int(request.get('file_size') or 0)
+            except (TypeError, ValueError):
+                transfer.size = -1
+            if transfer.size < 0:
+                log.warning("Invalid file size from %s: %r", transfer.address, request.get('file_size'))
+                self._reply(transfer, {'status': 'error', 'message': 'Invalid file size'}, None)
+                return
+            transfer.user = str(request.get('sender') or transfer.user)
+        elif 'file_id' in request:
+            transfer.kind = 'download'
+            transfer.file_id = request.get('file_id')
+            transfer.user = str(request.get('requester') or transfer.user)
+            info = self.server.file_metadata.get(transfer.file_id)
+            if info is None:
+                self._reply(transfer, {'status': 'error', 'message': 'File not found'}, None)
+                transfer.result = 'error'
+                return
+            transfer.file_name = info['file_name']
+            transfer.size = info['size']
+            if 'piece' in request:
+                piece = request['piece']
+                valid = isinstance(piece, int) and not isinstance(piece, bool)
+                span = piece_range(transfer.size, piece) if valid else None
+                if span is None:
+                    self._reply(transfer, {'status': 'error', 'message': 'No such piece'}, None)
+                    return
+                transfer.kind = 'piece'
+                transfer.offset, transfer.size = span
+        else:
+            log.warning("File transfer from %s is neither upload nor download", transfer.address)
+            self._finish(transfer, 'error')
+            return
+
+        transfer.small = transfer.size <= self.small
+        transfer.state = QUEUED
+        transfer.queued_at = time.monotonic()
+        self._arrivals += 1
+        heapq.heappush(self._queue, (0 if transfer.small else 1, self._arrivals, transfer))
+        self._admit()
+
+    def _admit(self):
+        """Start queued transfers while there are slots; small files first, then arrival order"""
+        deferred = []
+        while self._queue:
+            entry = heapq.heappop(self._queue)
+            transfer = entry[2]
+            if transfer.state != QUEUED:
+                continue  # Hung up while waiting
+            if self.active >= self.max_active + (self.small_slots if transfer.small else 0):
+                deferred.append(entry)
+                break  # Everything behind it is the same size class or larger
+            if self.active_by_user.get(transfer.user, 0) >= self.per_user:
+                deferred.append(entry)
+                continue
+            self._start(transfer)
+        for entry in deferred:
+            heapq.heappush(self._queue, entry)
+
+    def _start(self, transfer: Transfer):
+        self.active += 1
+        self.active_by_user[transfer.user] = self.active_by_user.get(transfer.user, 0) + 1
+        file_queue_seconds.labels(transfer.kind).observe(time.monotonic() - transfer.queued_at)
+        transfer.last_io = time.monotonic()
+
+        if transfer.kind == 'upload':
+            transfer.file_id = self.server.register_upload(transfer.file_name, transfer.size, transfer.user)
+            transfer.data = bytearray()
+            log.info("Receiving %s (%s) from %s", transfer.file_name, self.server._format_bytes(transfer.size),
+                     transfer.user)
+            self._reply(transfer, {'status': 'ready', 'file_id': transfer.file_id}, RECEIVING)
+        else:
+            transfer.data = memoryview(self.server.file_data.get(transfer.file_id, b''))
+            if transfer.kind == 'piece':
+                transfer.data = transfer.data[transfer.offset:transfer.offset + transfer.size]
+            self._reply(transfer, {'status': 'sending', 'file_name': transfer.file_name,
+                                   'file_size': transfer.size}, ACK)
+
+    def _hand_off(self, transfer: Transfer, request: Dict):
+        """Answer a swarm request on the control pool; it may hash a whole file"""
+        self.transfers.pop(transfer.sock, None)
+        self.selector.unregister(transfer.sock)
+        transfer.kind = 'swarm'
+        self._control.submit(self._answer_swarm, transfer, request)
+
+    def _answer_swarm(self, transfer: Transfer, request: Dict):
+        result = 'error'
+        try:
+            transfer.sock.setblocking(True)
+            transfer.sock.settimeout(30.0)
+            if self.swarm is None:
+                transfer.sock.sendall(json.dumps({'status': 'error', 'message': 'Swarm mode is off'}).encode('utf-8'))
+            else:
+                file_id = request.get('file_id')
+                info = self.server.file_metadata.get(file_id, {})
+                result = self.swarm.handle(transfer.sock, transfer.address, request,
+                                           self.server.file_data.get(file_id), info.get('file_name', ''))
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log.warning("Swarm request from %s failed: %s", transfer.address, e)
+        finally:
+            try:
+                transfer.sock.close()
+            except OSError:
+                pass
+            file_transfers.labels('swarm', result).inc()
+            file_transfer_seconds.labels('swarm').observe(time.monotonic() - transfer.started)
+
+    def _reply(self, transfer: Transfer, message: Dict, after: Optional[int]):
+        transfer.out = memoryview(json.dumps(message).encode('utf-8'))
+        transfer.after = after
+        transfer.state = REPLY
+        self.selector.modify(transfer.sock, selectors.EVENT_WRITE, transfer)
+
+    def _enter(self, transfer: Transfer, state: Optional[int]):
+        if state is None:
+            self._finish(transfer, transfer.result)
+            return
+        transfer.state = state
+        if state == RECEIVING and transfer.done >= transfer.size:
+            self._complete_upload(transfer)  # Empty file
+            return
+        self.selector.modify(transfer.sock, selectors.EVENT_WRITE if state == SENDING else selectors.EVENT_READ,
+                             transfer)
+
+    def _move(self, transfer: Transfer, share: int) -> int:
+        """Move up to `share` payload bytes for one transfer; returns how many moved"""
+        try:
+            if transfer.state == SENDING:
+                n = transfer.sock.send(transfer.data[transfer.done:transfer.done + share])
+                file_bytes.labels('out').inc(n)
+            else:
+                n = transfer.sock.recv_into(self._scratch, min(share, SLICE, transfer.size - transfer.done))
+                if not n:
+                    log.warning("Incomplete file transfer: %s/%s bytes of %s", transfer.done, transfer.size,
+                                transfer.file_name)
+                    self._store_upload(transfer)
+                    self._finish(transfer, 'incomplete')
+                    return 0
+                transfer.data += self._scratch[:n]
+                file_bytes.labels('in').inc(n)
+        except (BlockingIOError, InterruptedError):
+            return 0
+        except OSError as e:
+            log.error("Error %s %s: %s", 'sending' if transfer.state == SENDING else 'receiving',
+                      transfer.file_name, e)
+            if transfer.state == RECEIVING:
+                self._store_upload(transfer)
+            self._finish(transfer, 'error')
+            return 0
+
+        transfer.done += n
+        transfer.last_io = time.monotonic()
+        if transfer.state == SENDING and transfer.done >= len(transfer.data):
+            log.info("File sent: %s to %s", transfer.file_name, transfer.user)
+            self._finish(transfer, 'ok')
+        elif transfer.state == RECEIVING and transfer.done >= transfer.size:
+            self._complete_upload(transfer)
+        return n
+
+    def _complete_upload(self, transfer: Transfer):
+        self._store_upload(transfer)
+        log.info("File received: %s (%s)", transfer.file_name, self.server._format_bytes(transfer.done))
+        self._finish(transfer, 'ok')
+
+    def _store_upload(self, transfer: Transfer):
+        # Partial uploads are kept too, as before; downloads get whatever arrived
+        self.server.file_data[transfer.file_id] = transfer.data
+
+    def _sweep(self, now: float):
+        """Drop admitted transfers that stopped making progress"""
+        for transfer in list(self.transfers.values()):
+            if transfer.state != QUEUED and now - transfer.last_io > IDLE_TIMEOUT:
+                log.warning("File transfer timeout from %s", transfer.address)
+                if transfer.state == RECEIVING:
+                    self._store_upload(transfer)
+                self._finish(transfer, 'timeout')
+
+    def _finish(self, transfer: Transfer, result: str):
+        if self.transfers.pop(transfer.sock, None) is None:
+            return
+        try:
+            self.selector.unregister(transfer.sock)
+        except (KeyError, ValueError):
+            pass
+        try:
+            transfer.sock.close()
+        except OSError:
+            pass
+
+        was_active = transfer.state in (ACK, RECEIVING, SENDING) or (
+            transfer.state == REPLY and transfer.after is not None)
+        transfer.state = None
+        file_transfers.labels(transfer.kind, result).inc()
+        file_transfer_seconds.labels(transfer.kind).observe(time.monotonic() - transfer.started)
+        if was_active:
+            self.active -= 1
+            remaining = self.active_by_user.get(transfer.user, 1) - 1
+            if remaining:
+                self.active_by_user[transfer.user] = remaining
+            else:
+                self.active_by_user.pop(transfer.user, None)
+            self._admit()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+logger.py - Leveled, queue-backed logging for Shadow Nexus
+Call sites only put a record on a queue; formatting and console I/O happen on
+one background thread, so a slow or redirected stdout never stalls a handler
+
+Levels come from SHADOW_NEXUS_LOG, e.g. "info" or "warning,groups=debug,files=info"
+"""
+
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+from typing import Optional
+
+ROOT_LOGGER = 'shadow_nexus'
+DEFAULT_LEVEL = 'INFO'
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_queue: Optional[queue.SimpleQueue] = None
+_spec: Optional[str] = None
+_setup_lock = threading.Lock()
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves message formatting to the listener thread.
+
+    The stock handler formats in the caller to make records picklable, which
+    we don't need - records never leave the process.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def setup_logging(spec: Optional[str] = None) -> None:
+    """Install the queue handler and start the writer thread (idempotent)"""
+    global _listener, _queue, _spec
+    with _setup_lock:
+        if _listener is not None:
+            return
+
+        spec = _spec = spec or os.environ.get('SHADOW_NEXUS_LOG', DEFAULT_LEVEL)
+        root = logging.getLogger(ROOT_LOGGER)
+        root.propagate = False
+        root.setLevel(DEFAULT_LEVEL)  # Subsystem entries override only their own loggers
+        ignored = []
+        for part in spec.split(','):
+            part = part.strip()
+            if not part:
+                continue
+            name, _, level = part.rpartition('=')
+            target = logging.getLogger(f"{ROOT_LOGGER}.{name}") if name else root
+            try:
+                target.setLevel(level.strip().upper())
+            except ValueError:
+                ignored.append(part)  # Unknown level: keep the default rather than fail at import
+
+        console = logging.StreamHandler(sys.stdout)
+        console.setFormatter(logging.Formatter(
+            '%(asctime)s %(levelname)-7s [%(name)s] %(message)s', '%H:%M:%S'))
+
+        _queue = queue.SimpleQueue()
+        root.addHandler(_DeferredQueueHandler(_queue))
+        _listener = logging.handlers.QueueListener(_queue, console)
+        _listener.start()
+        atexit.register(_listener.stop)  # Flush what is queued on exit
+        for part in ignored:
+            root.warning("Ignoring bad SHADOW_NEXUS_LOG entry %r", part)
+
+
+def _restart_after_fork():
+    """The writer thread does not survive fork; give the child its own queue and thread"""
+    global _listener, _setup_lock
+    _setup_lock = threading.Lock()
+    if _listener is None:
+        return
+    root = logging.getLogger(ROOT_LOGGER)
+    for handler in list(root.handlers):
+        if isinstance(handler, _DeferredQueueHandler):
+            root.removeHandler(handler)
+    _listener = None
+    setup_logging(_spec)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_after_fork)
+
+
+def queue_depth() -> int:
+    """Records waiting for the writer thread"""
+    return _queue.qsize() if _queue is not None else 0
+
+
+def get_logger(subsystem: str) -> logging.Logger:
+    """Logger for one subsystem (server, groups, files, ...)"""
+    setup_logging()
+    return logging.getLogger(f"{ROOT_LOGGER}.{subsystem}")
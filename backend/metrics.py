@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+"""
+metrics.py - In-process counters, gauges and latency histograms
+Metrics live in one registry per process and are exported in Prometheus text
+format, either on an existing web app or on a local-only admin HTTP port
+
+Histograms keep HDR-style log-linear buckets: recording is a couple of integer
+operations, memory stays bounded, and any percentile is within ~3% of the truth
+"""
+
+import os
+import threading
+from time import perf_counter as _perf_counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from backend.logger import get_logger
+
+log = get_logger('metrics')
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_ADMIN_PORT = 9555
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+# 2**5 linear sub-buckets per power of two -> worst-case relative error 1/32
+_SUB_BITS = 5
+_SUB_COUNT = 1 << _SUB_BITS
+
+
+def _bucket_index(value: int) -> int:
+    if value < _SUB_COUNT:
+        return value
+    shift = value.bit_length() - _SUB_BITS - 1
+    return (shift + 1) * _SUB_COUNT + (value >> shift) - _SUB_COUNT
+
+
+def _bucket_midpoint(index: int) -> float:
+    if index < _SUB_COUNT:
+        return float(index)
+    shift = index // _SUB_COUNT - 1
+    mantissa = index % _SUB_COUNT + _SUB_COUNT
+    return ((mantissa << shift) + ((mantissa + 1) << shift)) / 2
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter:
+    """Monotonically increasing count"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+    def samples(self, name: str, labels: str) -> Iterable[str]:
+        yield f"{name}_total{labels} {_format_value(self.value)}"
+
+
+class Gauge:
+    """Value that goes up and down, or is read from a callback at export time"""
+
+    def __init__(self, fn: Optional[Callable[[], float]] = None):
+        self._lock = threading.Lock()
+        self.value = 0
+        self.fn = fn
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value -= amount
+
+    def get(self) -> float:
+        if self.fn is not None:
+            try:
+                return self.fn()
+            except Exception:
+                return float('nan')
+        return self.value
+
+    def samples(self, name: str, labels: str) -> Iterable[str]:
+        value = self.get()
+        yield f"{name}{labels} {'NaN' if value != value else _format_value(value)}"
+
+
+class Histogram:
+    """Log-linear latency histogram, exported as a Prometheus summary.
+
+    Values are observed in seconds and bucketed in whole `unit`s
+    (microseconds by default), so anything from 1us to hours fits in a few
+    hundred sparse buckets.
+    """
+
+    def __init__(self, unit: float = 1e-6):
+        self.unit = unit
+        self._lock = threading.Lock()
+        self._buckets: Dict[int, int] = {}
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        index = _bucket_index(max(0, int(value / self.unit)))
+        with self._lock:
+            self._buckets[index] = self._buckets.get(index, 0) + 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def snapshot(self) -> Dict:
+        """Plain-data copy of the histogram (picklable, e.g. to send between processes)"""
+        with self._lock:
+            return {'unit': self.unit, 'buckets': dict(self._buckets),
+                    'count': self.count, 'sum': self.sum, 'max': self.max}
+
+    def merge(self, snapshot: Dict) -> None:
+        """Add a snapshot() from a histogram with the same unit"""
+        if snapshot['unit'] != self.unit:
+            raise ValueError("Cannot merge histograms with different units")
+        with self._lock:
+            for index, n in snapshot['buckets'].items():
+                self._buckets[index] = self._buckets.get(index, 0) + n
+            self.count += snapshot['count']
+            self.sum += snapshot['sum']
+            self.max = max(self.max, snapshot['max'])
+
+    def time(self) -> '_Timer':
+        """Context manager that observes the time spent inside it"""
+        return _Timer(self)
+
+    def percentiles(self, quantiles: Iterable[float] = QUANTILES) -> List[float]:
+        """Estimated value at each quantile (0 when nothing was recorded)"""
+        with self._lock:
+            buckets = sorted(self._buckets.items())
+            count, largest = self.count, self.max
+        results = []
+        for q in quantiles:
+            if not count:
+                results.append(0.0)
+                continue
+            rank = max(1, int(q * count + 0.5))
+            seen = 0
+            for index, n in buckets:
+                seen += n
+                if seen >= rank:
+                    results.append(min(_bucket_midpoint(index) * self.unit, largest))
+                    break
+        return results
+
+    def samples(self, name: str, labels: str) -> Iterable[str]:
+        inner = labels[1:-1]
+        for q, value in zip(QUANTILES, self.percentiles()):
+            quantile = f'quantile="{q}"'
+            yield f"{name}{{{inner + ',' if inner else ''}{quantile}}} {value:.9g}"
+        yield f"{name}_sum{labels} {self.sum:.9g}"
+        yield f"{name}_count{labels} {self.count}"
+
+
+class _Timer:
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = _perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(_perf_counter() - self.start)
+
+
+class MetricFamily:
+    """One named metric, optionally split by label values"""
+
+    PROMETHEUS_TYPES = {Counter: 'counter', Gauge: 'gauge', Histogram: 'summary'}
+
+    def __init__(self, name: str, help_text: str, kind: type, label_names: Tuple[str, ...] = (), **options):
+        self.name = name
+        self.help = help_text
+        self.kind = kind
+        self.label_names = label_names
+        self.options = options
+        self._children: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+        if not label_names:
+            self._default = self._children[()] = kind(**options)
+
+    def labels(self, *values: str):
+        """Child metric for one combination of label values"""
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._children[values] = self.kind(**self.options)
+        return child
+
+    def __getattr__(self, name: str):
+        # An unlabeled family behaves like its single metric
+        if name.startswith('_') or self.label_names:
+            raise AttributeError(name)
+        return getattr(self._default, name)
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.PROMETHEUS_TYPES[self.kind]}"
+        for values, child in list(self._children.items()):
+            yield from child.samples(self.name, _format_labels(self.label_names, values))
+
+
+class MetricsRegistry:
+    """Named metric families for one process.
+
+    Asking for a name that already exists returns the existing family, so
+    modules can declare their metrics at import time without coordinating.
+    """
+
+    def __init__(self, prefix: str = 'shadow_nexus'):
+        self.prefix = prefix
+        self._families: Dict[str, MetricFamily] = {}
+        self._lock = threading.Lock()
+
+    def _family(self, name: str, help_text: str, kind: type, labels: Iterable[str], **options) -> MetricFamily:
+        full_name = f"{self.prefix}_{name}"
+        with self._lock:
+            family = self._families.get(full_name)
+            if family is None:
+                family = self._families[full_name] = MetricFamily(
+                    full_name, help_text, kind, tuple(labels), **options)
+            elif family.kind is not kind:
+                raise ValueError(f"Metric {full_name} is already registered as a {family.kind.__name__}")
+        return family
+
+    def counter(self, name: str, help_text: str, labels: Iterable[str] = ()) -> MetricFamily:
+        return self._family(name, help_text, Counter, labels)
+
+    def gauge(self, name: str, help_text: str, fn: Optional[Callable[[], float]] = None) -> MetricFamily:
+        """Gauge; with fn, its value is read at export time (re-registering replaces fn)"""
+        family = self._family(name, help_text, Gauge, ())
+        if fn is not None:
+            family.labels().fn = fn
+        return family
+
+    def gauge_family(self, name: str, help_text: str, labels: Iterable[str]) -> MetricFamily:
+        return self._family(name, help_text, Gauge, labels)
+
+    def histogram(self, name: str, help_text: str, labels: Iterable[str] = (), unit: float = 1e-6) -> MetricFamily:
+        return self._family(name, help_text, Histogram, labels, unit=unit)
+
+    def render_prometheus(self) -> str:
+        """Every metric in Prometheus text exposition format"""
+        with self._lock:
+            families = list(self._families.values())
+        lines: List[str] = []
+        for family in families:
+            lines.extend(family.render())
+        return '\n'.join(lines) + '\n'
+
+
+# The process-wide registry every module records into
+registry = MetricsRegistry()
+
+
+def default_admin_port() -> Optional[int]:
+    """SHADOW_NEXUS_METRICS_PORT from the environment; 'off' disables the admin port"""
+    value = os.environ.get('SHADOW_NEXUS_METRICS_PORT', str(DEFAULT_ADMIN_PORT))
+    if value.lower() in ('off', 'none', ''):
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return DEFAULT_ADMIN_PORT
+
+
+class _AdminHandler(BaseHTTPRequestHandler):
+    registry: MetricsRegistry = registry
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.registry.render_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug("admin %s - %s", self.address_string(), format % args)
+
+
+def start_admin_server(port: int, host: str = '127.0.0.1',
+                       metrics: MetricsRegistry = registry) -> Optional[ThreadingHTTPServer]:
+    """Serve GET /metrics on a loopback-only port from a daemon thread.
+
+    Returns None (and logs) if the port can't be bound, so a busy admin port
+    never keeps a server from starting.
+    """
+    handler = type('AdminHandler', (_AdminHandler,), {'registry': metrics})
+    try:
+        httpd = ThreadingHTTPServer((host, port), handler)
+    except OSError as e:
+        log.warning("Metrics admin port %s:%s unavailable: %s", host, port, e)
+        return None
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True, name='metrics-admin').start()
+    log.info("Metrics on http://%s:%s/metrics", host, httpd.server_address[1])
+    return httpd
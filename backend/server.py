@@ -22,44 +22,120 @@ from typing import Dict, List, Optional, Tuple, Any
 
 # Import storage
 from backend.storage import storage
+from backend.timer_wheel import TimerWheel
+from backend.server_state import ConnectionRegistry, HistoryCache, RecentChats
+from backend.logger import get_logger, queue_depth
+from backend.dispatch import THROTTLED, UNKNOWN, Dispatcher, TimedLock
+from backend.file_service import FileTransferService
+from backend.metrics import default_admin_port, registry, start_admin_server
+
+log = get_logger('server')
+groups_log = get_logger('groups')
+files_log = get_logger('files')
+calls_log = get_logger('calls')
+presence_log = get_logger('presence')
+heartbeat_log = get_logger('heartbeat')
+
+broadcast_seconds = registry.histogram('chat_broadcast_seconds', "Time to fan one broadcast out to local clients")
+broadcast_deliveries = registry.counter('chat_broadcast_deliveries', "Broadcast copies written to clients")
+broadcast_failures = registry.counter('chat_broadcast_failures', "Broadcast sends that failed")
+history_lookups = registry.counter('history_cache_lookups', "History pages served, by cache result", labels=('result',))
 
 class CollaborationServer:
     """Main server class for handling chat, files, and groups"""
     
-    def __init__(self, host='0.0.0.0', port=5555, file_port=5556):
+    def __init__(self, host='0.0.0.0', port=5555, file_port=5556, shard=None, listen_socket=None,
+                 metrics_port=None):
         self.host = host
         self.port = port
         self.file_port = file_port
-        
-        self.server_socket = self._create_socket()
-        self.file_server_socket = self._create_socket()
-        
-        self.clients: Dict[socket.socket, Dict[str, Any]] = {}
-        self.groups: Dict[str, Dict[str, Any]] = storage.get_groups()  # Load from persistent storage
+        # Local-only admin port serving /metrics (None = don't serve)
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        
+        # Sharded mode (see backend/sharding.py): storage lives in the coordinator
+        # process and deliveries to users on other workers go over the shard link.
+        # A worker gets an already-listening chat socket and no file port
+        self.shard = shard
+        self.storage = shard.storage if shard is not None else storage
+        self.listen_socket = listen_socket
+        
+        self.server_socket = listen_socket or self._create_socket()
+        self.file_server_socket = self._create_socket() if file_port is not None else None
+        
+        # Shared state is split into independently locked components:
+        #   clients      - copy-on-write registry, lock-free reads
+        #   groups       - groups_lock; member lists are replaced, never mutated in place
+        #   recent_chats - its own lock
+        #   presence     - presence_lock (see below)
+        # No component lock is held while sending to a socket
+        self.clients = ConnectionRegistry()
+        self.groups: Dict[str, Dict[str, Any]] = self.storage.get_groups()  # Load from persistent storage
+        self.groups_lock = TimedLock('groups', threading.RLock())
+        # Bumped on every group change so clients can ask "what changed since v?"
+        self.groups_version = max((g.get('version', 0) for g in self.groups.values()), default=0)
         # Load chat history from storage instead of starting empty
-        self.chat_history: List[Dict] = storage.get_global_chat(1000)
+        self.chat_history: List[Dict] = self.storage.get_global_chat(1000)
         self.private_messages: Dict[Tuple[str, str], List[Dict]] = {}
-        self.group_messages: Dict[str, List[Dict]] = storage.group_chats  # Load from storage
-        self.file_metadata: Dict[str, Dict[str, Any]] = storage.get_files()
-        self.recent_chats: Dict[str, List[str]] = {}
+        self.file_metadata: Dict[str, Dict[str, Any]] = self.storage.get_files()
+        # Uploaded bytes stay in this process, out of the persisted metadata
+        self.file_data: Dict[str, bytes] = {}
+        self.file_service: Optional[FileTransferService] = None
+        self.recent_chats = RecentChats(limit=5)
         
-        self.lock = threading.Lock()
         self.running = True
+        self._broadcast_failures: Dict[socket.socket, int] = {}
         
-        # Heartbeat tracking to detect inactive clients gracefully
+        # Heartbeat tracking to detect inactive clients gracefully.
+        # Activity stamps are plain monotonic floats written without the lock
+        # (a single dict store is atomic); deadlines live in a timer wheel
         self.last_activity: Dict[socket.socket, float] = {}
-        self.heartbeat_interval = 30  # Send ping every 30 seconds
+        self.heartbeat_interval = 30  # Ping a client after 30 seconds of silence
         self.client_timeout = 180  # Disconnect after 3 minutes of no activity
-        
-        # Cache for history requests to prevent duplicates
-        self.history_request_cache: Dict[str, float] = {}
-        self.HISTORY_CACHE_DURATION = 2  # seconds - don't send same history within this timeframe
-        
-        print(f"Server initializing on {host}:{port} (chat) and {host}:{file_port} (files)")
-        print(f"Loaded {len(self.chat_history)} historical global messages")
-        print(f"Loaded {len(self.file_metadata)} historical files")
-
-    def _create_socket(self) -> socket.socket:
+        self.heartbeat_wheel = TimerWheel(tick=1.0)
+        
+        # Serialized history pages, reused until storage reports a change to the conversation
+        self.history_cache = HistoryCache()
+        self._history_hit = history_lookups.labels('hit')
+        self._history_miss = history_lookups.labels('miss')
+        
+        # Presence tracking - a versioned set of online users. Joins/leaves are
+        # coalesced into one delta per window instead of a full list per connect
+        self.presence_lock = TimedLock('presence')
+        self.presence_send_lock = TimedLock('presence_send')  # Keeps deltas in version order
+        self.presence_sessions: Dict[str, int] = {}  # username -> open connections
+        self.presence_version = 0
+        self.pending_presence: List[Tuple[str, str]] = []
+        self.presence_timer: Optional[threading.Timer] = None
+        self.PRESENCE_COALESCE_WINDOW = 0.25  # seconds
+        
+        log.info("Server initializing on %s:%s (chat) and %s:%s (files)", host, port, host, file_port)
+        log.info("Loaded %d historical global messages", len(self.chat_history))
+        log.info("Loaded %d historical files", len(self.file_metadata))
+        
+        # Read at scrape time, so they cost nothing between scrapes
+        registry.gauge('chat_connections', "Open chat connections", fn=lambda: len(self.clients))
+        registry.gauge('chat_online_users', "Users with at least one connection",
+                       fn=lambda: len(self.presence_sessions))
+        registry.gauge('chat_groups', "Known groups", fn=lambda: len(self.groups))
+        registry.gauge('chat_heartbeat_timers', "Pending heartbeat deadlines", fn=lambda: len(self.heartbeat_wheel))
+        registry.gauge('chat_presence_pending', "Presence changes waiting for the next delta",
+                       fn=lambda: len(self.pending_presence))
+        registry.gauge('history_cache_bytes', "Bytes of serialized history held in the cache",
+                       fn=lambda: self.history_cache.bytes)
+        registry.gauge('history_cache_entries', "History pages held in the cache", fn=lambda: len(self.history_cache))
+        registry.gauge('log_queue_depth', "Log records waiting for the writer thread", fn=queue_depth)
+        
+        # Built once; handlers slower than SHADOW_NEXUS_SLOW_HANDLER_MS are traced and
+        # each connection is held to SHADOW_NEXUS_RATE_LIMITS
+        self.dispatcher = Dispatcher(self._message_handlers())
+        
+        if shard is not None:
+            # Replays anything the coordinator sent while we were loading
+            shard.attach(self)
+
+    @staticmethod
+    def _create_socket() -> socket.socket:
     
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -78,40 +154,52 @@ class CollaborationServer:
     def start(self):
         """Start the server and listen for connections"""
         try:
-            self.server_socket.bind((self.host, self.port))
-            self.server_socket.listen(10)
-            print(f"✓ Chat server started on {self.host}:{self.port}")
+            if self.listen_socket is None:
+                self.server_socket.bind((self.host, self.port))
+                self.server_socket.listen(10)
+            log.info("Chat server started on %s:%s", self.host, self.port)
             
-            self.file_server_socket.bind((self.host, self.file_port))
-            self.file_server_socket.listen(10)
-            print(f"✓ File server started on {self.host}:{self.file_port}")
-            
-            file_thread = threading.Thread(target=self.accept_file_connections, daemon=True)
-            file_thread.start()
+            if self.file_server_socket is not None:
+                self.serve_files()
+            self.serve_metrics()
             
             # Start heartbeat monitor thread
             heartbeat_thread = threading.Thread(target=self._heartbeat_monitor, daemon=True)
             heartbeat_thread.start()
-            print(f"✓ Heartbeat monitor started")
             
             self.accept_connections()
             
         except OSError as e:
-            print(f"❌ Error starting server (port may be in use): {e}")
-        except Exception as e:
-            print(f"❌ Unexpected error: {e}")
+            log.error("Error starting server (port may be in use): %s", e)
+        except Exception:
+            log.exception("Unexpected error")
         finally:
             self.cleanup()
 
+    def serve_files(self):
+        """Bind the file port and run transfers on the file service's event loop"""
+        self.file_server_socket.bind((self.host, self.file_port))
+        self.file_server_socket.listen(128)
+        files_log.info("File server started on %s:%s", self.host, self.file_port)
+        
+        # Caps and bandwidth come from SHADOW_NEXUS_FILE_LIMITS
+        self.file_service = FileTransferService(self)
+        self.file_service.start(self.file_server_socket)
+
+    def serve_metrics(self):
+        """Start the loopback admin port for /metrics, if one is configured"""
+        if self.metrics_port is not None and self.metrics_server is None:
+            self.metrics_server = start_admin_server(self.metrics_port)
+
     def accept_connections(self):
         """Accept incoming client connections for chat"""
-        print("✓ Waiting for connections... (Press Ctrl+C to stop)\n")
+        log.info("Waiting for connections... (Press Ctrl+C to stop)")
         while self.running:
             try:
                 self.server_socket.settimeout(1.0)
                 try:
                     client_socket, address = self.server_socket.accept()
-                    print(f"📥 New connection from {address}")
+                    log.debug("New connection from %s", address)
                     
                     thread = threading.Thread(
                         target=self.handle_client,
@@ -123,28 +211,7 @@ class CollaborationServer:
                     continue
             except Exception as e:
                 if self.running:
-                    print(f"❌ Error accepting connection: {e}")
-
-    def accept_file_connections(self):
-        """Accept incoming file transfer connections"""
-        while self.running:
-            try:
-                self.file_server_socket.settimeout(1.0)
-                try:
-                    client_socket, address = self.file_server_socket.accept()
-                    print(f"📁 File transfer connection from {address}")
-                    
-                    thread = threading.Thread(
-                        target=self.handle_file_transfer,
-                        args=(client_socket, address),
-                        daemon=True
-                    )
-                    thread.start()
-                except socket.timeout:
-                    continue
-            except Exception as e:
-                if self.running:
-                    print(f"❌ Error accepting file connection: {e}")
+                    log.error("Error accepting connection: %s", e)
 
     def handle_client(self, client_socket: socket.socket, address: Tuple):
         """Handle communication with a connected client"""
@@ -163,7 +230,7 @@ class CollaborationServer:
             is_system_connection = username.startswith('_') and username.endswith('_System_')
             
             if is_system_connection:
-                print(f"[SERVER] System connection from {username} - handling separately")
+                log.info("System connection from %s - handling separately", username)
                 # Handle system connection without adding to clients list
                 recv_buffer = leftover or ""
                 client_socket.settimeout(None)
@@ -181,11 +248,11 @@ class CollaborationServer:
                     except ConnectionResetError:
                         break
                     except Exception as e:
-                        print(f"❌ Error handling system message from {username}: {e}")
+                        log.error("Error handling system message from %s: %s", username, e)
                         break
                 
                 # Close system connection without broadcasting
-                print(f"[SERVER] System connection {username} closed")
+                log.info("System connection %s closed", username)
                 try:
                     client_socket.close()
                 except:
@@ -193,21 +260,23 @@ class CollaborationServer:
                 return
             
             # Regular user connection handling
-            with self.lock:
-                self.clients[client_socket] = {
-                    'username': username,
-                    'address': address,
-                    'connected_at': datetime.now()
-                }
-                # Track activity for heartbeat monitoring
-                self.last_activity[client_socket] = time.time()
-                if username not in self.recent_chats:
-                    self.recent_chats[username] = []
+            self.clients.add(client_socket, {
+                'username': username,
+                'address': address,
+                'connected_at': datetime.now(),
+                # Only this thread reads it; system connections are never limited
+                'rate_limiter': self.dispatcher.limiter()
+            })
+            # Track activity for heartbeat monitoring
+            self.last_activity[client_socket] = time.monotonic()
+            self.recent_chats.ensure(username)
+            self.heartbeat_wheel.schedule(client_socket, time.monotonic() + self.heartbeat_interval)
             
-            print(f"✓ User '{username}' connected from {address}")
+            log.info("User '%s' connected from %s", username, address)
+            self._queue_presence_change('user_joined', username)
             
             # Update in storage
-            storage.update_user(username, str(address[0]))
+            self.storage.update_user(username, str(address[0]))
             
             # Prime buffer with any leftover data that arrived alongside the username
             recv_buffer = leftover or ""
@@ -218,33 +287,33 @@ class CollaborationServer:
             try:
                 self._send_welcome_messages(client_socket, username)
             except Exception as e:
-                print(f"❌ Error sending welcome messages to {username}: {e}")
-                import traceback
-                traceback.print_exc()
+                log.exception("Error sending welcome messages to %s", username)
             
             client_socket.settimeout(None)
+            # Messages pipelined behind the username would otherwise wait for the next recv
+            if recv_buffer:
+                recv_buffer = self._process_messages(client_socket, recv_buffer)
             
             while self.running:
                 try:
                     data = client_socket.recv(4096)
                     if not data:
-                        print(f"[SERVER] Client {username} closed connection gracefully")
+                        log.debug("Client %s closed connection gracefully", username)
                         break
                     
-                    # Update activity timestamp
-                    with self.lock:
-                        self.last_activity[client_socket] = time.time()
+                    # Update activity timestamp (lock-free, read by the heartbeat monitor)
+                    self.last_activity[client_socket] = time.monotonic()
                     
                     recv_buffer += data.decode('utf-8')
                     recv_buffer = self._process_messages(client_socket, recv_buffer)
                     
                 except ConnectionResetError:
-                    print(f"[SERVER] Connection reset by {username}")
+                    log.debug("Connection reset by %s", username)
                     break
                 except socket.timeout:
                     # Timeout occurred - this shouldn't happen with settimeout(None)
                     # but Windows can still trigger it on network issues
-                    print(f"[SERVER] Socket timeout for {username} - this may indicate network issues")
+                    log.warning("Socket timeout for %s - this may indicate network issues", username)
                     # Re-apply settimeout(None) in case it was reset
                     try:
                         client_socket.settimeout(None)
@@ -254,18 +323,16 @@ class CollaborationServer:
                     continue
                 except UnicodeDecodeError as e:
                     # Handle corrupted data gracefully without disconnecting
-                    print(f"⚠️ Unicode decode error from {username}: {e} - skipping corrupted data")
+                    log.warning("Unicode decode error from %s: %s - skipping corrupted data", username, e)
                     recv_buffer = ""  # Clear buffer and continue
                     continue
                 except Exception as e:
                     # Log error but try to continue unless it's a critical socket error
-                    import traceback
-                    print(f"⚠️ Error handling message from {username}: {e}")
-                    traceback.print_exc()
+                    log.warning("Error handling message from %s: %s", username, e, exc_info=True)
                     
                     # Only break on critical errors
                     if isinstance(e, (BrokenPipeError, ConnectionAbortedError, OSError)):
-                        print(f"[SERVER] Critical socket error for {username} - disconnecting")
+                        log.warning("Critical socket error for %s - disconnecting", username)
                         break
                     else:
                         # For non-critical errors, clear buffer and continue
@@ -273,17 +340,13 @@ class CollaborationServer:
                         continue
                     
         except socket.timeout:
-            print(f"⏱️ Connection timeout for {username or address}")
-        except Exception as e:
-            import traceback
-            print(f"❌ Error handling client {username or address}: {e}")
-            traceback.print_exc()
+            log.warning("Connection timeout for %s", username or address)
+        except Exception:
+            log.exception("Error handling client %s", username or address)
         finally:
             if not is_system_connection:
-                # Clean up activity tracking
-                with self.lock:
-                    if client_socket in self.last_activity:
-                        del self.last_activity[client_socket]
+                # Clean up activity tracking - a pending wheel entry is dropped when it fires
+                self.last_activity.pop(client_socket, None)
                 self.handle_disconnect(client_socket, username)
 
     def _receive_username_with_buffer(self, client_socket: socket.socket) -> Tuple[Optional[str], str]:
@@ -312,43 +375,22 @@ class CollaborationServer:
         
         # Send any private chat histories involving this user so the client can populate local state
         try:
-            # storage.private_chats keys are tuples (user1, user2)
-            for key, msgs in getattr(storage, 'private_chats', {}).items():
-                try:
-                    userA, userB = key
-                except Exception:
-                    # If keys are serialized strings like 'a_b', handle that
-                    if isinstance(key, str) and '_' in key:
-                        parts = key.split('_')
-                        userA, userB = parts[0], parts[1]
-                    else:
-                        continue
-                if username == userA or username == userB:
-                    other = userB if username == userA else userA
-                    messages = storage.get_private_chat(username, other, 200)
-                    history_msg = {
-                        'type': 'private_history',
-                        'target_user': other,
-                        'messages': messages
-                    }
-                    self._send_to_client(client_socket, history_msg)
+            for other in self.storage.get_private_partners(username):
+                self._send_history(client_socket, ('private_welcome', username, other), ('private', username, other),
+                                   lambda: {
+                                       'type': 'private_history',
+                                       'target_user': other,
+                                       'messages': self.storage.get_private_chat(username, other, 200)
+                                   })
         except Exception as e:
-            print(f"[SERVER] Error sending private histories: {e}")
+            log.error("Error sending private histories: %s", e)
 
         # Group histories are sent on-demand when user clicks on a group
         # No need to send all group histories on login
-        
-        # NOW broadcast to all OTHER clients that someone joined
-        welcome_msg = {
-            'type': 'system',
-            'sender': 'Server',
-            'content': f"{username} joined the chat",
-            'timestamp': self._timestamp()
-        }
-        self.broadcast(json.dumps(welcome_msg), exclude=client_socket)
+        # The "joined the chat" notice goes out with the next presence delta
         
         # Check if this is the user's first time
-        is_first_time = username not in storage.users or not storage.users.get(username)
+        is_first_time = not self.storage.get_user(username)
         
         # Send welcome message to the new user themselves
         if is_first_time:
@@ -366,9 +408,6 @@ class CollaborationServer:
                 'timestamp': self._timestamp()
             }
         self._send_to_client(client_socket, welcome_msg_self)
-        
-        # Broadcast updated user list to EVERYONE (including new user)
-        self.broadcast_user_list()
 
     def _process_messages(self, client_socket: socket.socket, buffer: str) -> str:
         """Process received messages from buffer"""
@@ -381,35 +420,18 @@ class CollaborationServer:
             
             try:
                 message = json.loads(part)
-                self._route_message(client_socket, message)
+                self._route_message(client_socket, message, len(part))
             except json.JSONDecodeError as e:
                 username = self.clients.get(client_socket, {}).get('username', 'Unknown')
-                print(f"⚠️ Invalid JSON from {username}: {e}")
+                log.warning("Invalid JSON from %s: %s", username, e)
         
         return remaining
 
-    def _route_message(self, client_socket: socket.socket, message: Dict):
-        """Route message to appropriate handler"""
-        # Update activity on any message received
-        with self.lock:
-            if client_socket in self.last_activity:
-                self.last_activity[client_socket] = time.time()
-        
-        if 'timestamp' not in message:
-            message['timestamp'] = self._timestamp()
-        msg_type = message.get('type', 'chat')
-        
-        # Handle heartbeat/ping messages
-        if msg_type == 'ping':
-            self._send_to_client(client_socket, {'type': 'pong', 'timestamp': self._timestamp()})
-            return
-        
-        # Handle pong responses from clients
-        if msg_type == 'pong':
-            # Client is alive and responding - activity already updated above
-            return
-        
-        handlers = {
+    def _message_handlers(self) -> Dict[str, Any]:
+        """Message type -> handler, for the dispatcher"""
+        return {
+            'ping': self._handle_ping,
+            'pong': self._handle_pong,
             'chat': self._handle_chat_message,
             'private': self._handle_private_message,
             'private_file': self._handle_private_file,
@@ -444,68 +466,92 @@ class CollaborationServer:
             'delete_message': self._handle_delete_message,
             'delete_user_chat': self._handle_delete_user_chat,
         }
-        handler = handlers.get(msg_type)
-        if handler:
+
+    def _route_message(self, client_socket: socket.socket, message: Dict, size: int = 0):
+        """Route message to appropriate handler"""
+        # Activity was already stamped by the receive loop
+        if 'timestamp' not in message:
+            message['timestamp'] = self._timestamp()
+        msg_type = message.get('type', 'chat')
+        info = self.clients.get(client_socket)
+        limiter = info.get('rate_limiter') if info else None
+        
+        result = self.dispatcher.dispatch(msg_type, size, client_socket, message, limiter=limiter)
+        if result == THROTTLED:
+            self._handle_throttled(client_socket, info, msg_type, limiter)
+        elif result == UNKNOWN:
+            log.warning("No handler for message type: %s", msg_type)
+
+    def _handle_throttled(self, client_socket: socket.socket, info: Dict[str, Any], msg_type: str, limiter):
+        """Tell the client once per wait period; cut it off if it keeps going regardless"""
+        if limiter.flooding:
+            if limiter.drops > limiter.flood:
+                return  # Already shut down; the rest of this read is discarded
+            log.warning("Disconnecting %s: %d messages in a row over the rate limit",
+                        info['username'], limiter.drops)
+            # The receive loop sees the closed socket and finishes the cleanup
             try:
-                if 'video_invite' in msg_type:
-                    print(f"[SERVER] Found handler for {msg_type}, calling it")
-                handler(client_socket, message)
-            except Exception as e:
-                import traceback
-                print(f"❌ Error in handler for {msg_type}: {e}")
-                traceback.print_exc()
-        else:
-            if 'video_invite' in msg_type:
-                print(f"[SERVER] ERROR: No handler found for {msg_type}")
-            else:
-                print(f"[SERVER] No handler for message type: {msg_type}")
+                client_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            return
+        if limiter.should_notify(msg_type):
+            log.debug("Rate limited %s from %s for %.2fs", msg_type, info['username'], limiter.retry_after)
+            self._send_to_client(client_socket, {
+                'type': 'rate_limited',
+                'request_type': msg_type,
+                'retry_after': round(limiter.retry_after, 3),
+                'timestamp': self._timestamp()
+            })
+
+    def _handle_ping(self, client_socket: socket.socket, message: Dict):
+        """Answer a client heartbeat"""
+        self._send_to_client(client_socket, {'type': 'pong', 'timestamp': self._timestamp()})
+
+    def _handle_pong(self, client_socket: socket.socket, message: Dict):
+        """Client is alive and responding - activity was already stamped by the receive loop"""
 
     def _heartbeat_monitor(self):
-        """Monitor client activity and send periodic pings"""
-        print("[SERVER] Heartbeat monitor thread started")
+        """Ping idle clients and disconnect dead ones as their deadlines come due"""
+        heartbeat_log.info("Heartbeat monitor started")
         while self.running:
             try:
-                time.sleep(self.heartbeat_interval)
-                
-                current_time = time.time()
-                inactive_clients = []
-                
-                # Check for inactive clients
-                with self.lock:
-                    for sock, last_time in list(self.last_activity.items()):
-                        if current_time - last_time > self.client_timeout:
-                            inactive_clients.append(sock)
-                
-                # Disconnect inactive clients
-                for sock in inactive_clients:
-                    username = self.clients.get(sock, {}).get('username', 'Unknown')
-                    print(f"[HEARTBEAT] Disconnecting inactive client: {username} (no activity for {self.client_timeout}s)")
-                    self.handle_disconnect(sock, username)
+                time.sleep(self.heartbeat_wheel.tick)
                 
-                # Send ping to all active clients (optional - helps keep connection alive)
-                with self.lock:
-                    for sock in list(self.clients.keys()):
-                        try:
-                            self._send_to_client(sock, {'type': 'ping', 'timestamp': self._timestamp()})
-                        except Exception as e:
-                            # Don't disconnect on ping failure - will be caught by next heartbeat check
-                            pass
+                now = time.monotonic()
+                for sock in self.heartbeat_wheel.advance(now):
+                    last_time = self.last_activity.get(sock)
+                    if last_time is None:
+                        continue  # Already disconnected
+                    
+                    idle = now - last_time
+                    if idle >= self.client_timeout:
+                        username = self.clients.get(sock, {}).get('username', 'Unknown')
+                        heartbeat_log.info("Disconnecting inactive client: %s (no activity for %ss)", username, self.client_timeout)
+                        self.last_activity.pop(sock, None)
+                        self.handle_disconnect(sock, username)
+                    elif idle >= self.heartbeat_interval:
+                        # Only connections that actually went quiet get a ping
+                        self._send_to_client(sock, {'type': 'ping', 'timestamp': self._timestamp()})
+                        self.heartbeat_wheel.schedule(
+                            sock, min(now + self.heartbeat_interval, last_time + self.client_timeout))
+                    else:
+                        # Traffic arrived since this deadline was set - push it back
+                        self.heartbeat_wheel.schedule(sock, last_time + self.heartbeat_interval)
                             
             except Exception as e:
                 if self.running:
-                    print(f"[HEARTBEAT] Error in heartbeat monitor: {e}")
+                    heartbeat_log.error("Error in heartbeat monitor: %s", e)
         
-        print("[SERVER] Heartbeat monitor thread stopped")
+        heartbeat_log.info("Heartbeat monitor stopped")
 
     def _handle_get_users(self, client_socket: socket.socket, message: Dict):
         """Handle explicit request for user list"""
-        print(f"[SERVER] Received get_users request")
         self.send_user_list_to_client(client_socket)
 
     def _handle_request_groups(self, client_socket: socket.socket, message: Dict):
         """Handle explicit request for groups list"""
-        print(f"[SERVER] Received request_groups request")
-        self.send_group_list(client_socket)
+        self.send_group_list(client_socket, since_version=message.get('version'))
 
     def _handle_global_file_share(self, client_socket: socket.socket, message: Dict):
         """Handle global file sharing"""
@@ -517,7 +563,7 @@ class CollaborationServer:
         if not file_id:
             return
         
-        print(f"📨 Global file share from {sender}: {file_name}")
+        files_log.debug("Global file share from %s: %s", sender, file_name)
         
         # Create message object for storage
         file_notification = {
@@ -532,13 +578,12 @@ class CollaborationServer:
         
         # Add to global chat history
         self.chat_history.append(file_notification)
-        storage.add_global_message(file_notification)
+        self.storage.add_global_message(file_notification)
         
         if len(self.chat_history) > 1000:
             self.chat_history = self.chat_history[-1000:]
         
         # Broadcast to ALL clients
-        print(f"📢 Broadcasting file notification to all clients")
         self.broadcast(json.dumps(file_notification))
         
     def _handle_global_audio_share(self, client_socket: socket.socket, message: Dict):
@@ -550,7 +595,7 @@ class CollaborationServer:
         if not audio_data:
             return
         
-        print(f"🎵 Global audio message from {sender} ({duration}s)")
+        log.debug("Global audio message from %s (%ss)", sender, duration)
         
         # Create message object for storage - strip audio data to save space in chat history
         audio_message = {
@@ -564,13 +609,12 @@ class CollaborationServer:
         
         # Add to global chat history
         self.chat_history.append(audio_message)
-        storage.add_global_message(audio_message)
+        self.storage.add_global_message(audio_message)
         
         if len(self.chat_history) > 1000:
             self.chat_history = self.chat_history[-1000:]
         
         # Broadcast to ALL clients
-        print(f"📢 Broadcasting audio message to all clients")
         self.broadcast(json.dumps(audio_message))
         
     def _handle_private_audio(self, client_socket: socket.socket, message: Dict):
@@ -583,7 +627,7 @@ class CollaborationServer:
         if not receiver or not audio_data:
             return
         
-        print(f"🎵 Private audio from {sender} to {receiver} ({duration}s)")
+        log.debug("Private audio from %s to %s (%ss)", sender, receiver, duration)
         
         # Create audio message for private chat
         audio_message = {
@@ -597,32 +641,17 @@ class CollaborationServer:
         }
         
         # Store in private chat history
-        storage.add_private_message(sender, receiver, audio_message)
+        self.storage.add_private_message(sender, receiver, audio_message)
         
         # Update recent chats
-        with self.lock:
-            if sender not in self.recent_chats:
-                self.recent_chats[sender] = []
-            if receiver not in self.recent_chats:
-                self.recent_chats[receiver] = []
-                
-            if receiver not in self.recent_chats[sender]:
-                self.recent_chats[sender].insert(0, receiver)
-                if len(self.recent_chats[sender]) > 5:
-                    self.recent_chats[sender].pop()
-            
-            if sender not in self.recent_chats[receiver]:
-                self.recent_chats[receiver].insert(0, sender)
-                if len(self.recent_chats[receiver]) > 5:
-                    self.recent_chats[receiver].pop()
+        self.recent_chats.add(sender, receiver)
+        self.recent_chats.add(receiver, sender)
         
         # Send to receiver if online
-        receiver_socket = self._find_client_socket(receiver)
-        if receiver_socket:
-            self._send_to_client(receiver_socket, audio_message)
-            print(f"   ✓ Sent audio to {receiver}")
+        if self._send_to_user(receiver, audio_message):
+            log.debug("Sent audio to %s", receiver)
         else:
-            print(f"   ℹ️  {receiver} is offline, audio saved to history")
+            log.debug("%s is offline, audio saved to history", receiver)
         
         # Send back to sender for confirmation
         self._send_to_client(client_socket, audio_message)
@@ -640,7 +669,7 @@ class CollaborationServer:
         if sender not in self.groups[group_id]['members']:
             return
         
-        print(f"🎵 Group audio from {sender} in group {group_id} ({duration}s)")
+        groups_log.debug("Group audio from %s in group %s (%ss)", sender, group_id, duration)
         
         # Create audio message for group
         audio_message = {
@@ -654,18 +683,13 @@ class CollaborationServer:
         }
         
         # Store in group chat history
-        self.group_messages[group_id].append(audio_message)
-        storage.add_group_message(group_id, audio_message)
+        self.storage.add_group_message(group_id, audio_message)
         
         # Send to all group members (including sender for confirmation)
-        with self.lock:
-            for sock, info in self.clients.items():
-                if info['username'] in self.groups[group_id]['members']:
-                    self._send_to_client(sock, audio_message)
+        self._notify_group_members(group_id, audio_message)
         
     def _handle_chat_history_request(self, client_socket: socket.socket, message: Dict):
         """Handle request for global chat history"""
-        print(f"[SERVER] Received request for chat history")
         self.send_chat_history(client_socket)
 
     def _handle_chat_message(self, client_socket: socket.socket, message: Dict):
@@ -674,22 +698,19 @@ class CollaborationServer:
         content = message.get('content', '')
         metadata = message.get('metadata')
         
-        print(f" Global message from {sender}: {content[:50]}")
-        if metadata and isinstance(metadata, dict) and metadata.get('replyTo'):
-            print(f"   Reply to: {metadata['replyTo'].get('sender')} - {metadata['replyTo'].get('text', '')[:30]}")
+        log.debug("Global message from %s: %.50s", sender, content)
         
         # Preserve metadata in the message if it exists
         if metadata and isinstance(metadata, dict):
             message['metadata'] = metadata
         
         self.chat_history.append(message)
-        storage.add_global_message(message)
+        self.storage.add_global_message(message)
         
         if len(self.chat_history) > 1000:
             self.chat_history = self.chat_history[-1000:]
         
         # Broadcast to ALL clients (no exclude)
-        print(f" Broadcasting to all {len(self.clients)} connected clients")
         self.broadcast(json.dumps(message))
 
     def _handle_private_message(self, client_socket: socket.socket, message: Dict):
@@ -704,8 +725,6 @@ class CollaborationServer:
         # Preserve metadata in the message if it exists
         if metadata and isinstance(metadata, dict):
             message['metadata'] = metadata
-            if metadata.get('replyTo'):
-                print(f"   Reply to: {metadata['replyTo'].get('sender')} - {metadata['replyTo'].get('text', '')[:30]}")
         
         key = tuple(sorted([sender, receiver]))
         if key not in self.private_messages:
@@ -713,24 +732,15 @@ class CollaborationServer:
         self.private_messages[key].append(message)
         
         # PERSIST TO STORAGE
-        storage.add_private_message(sender, receiver, message)
+        self.storage.add_private_message(sender, receiver, message)
         
-        with self.lock:
-            if sender in self.recent_chats and receiver not in self.recent_chats[sender]:
-                self.recent_chats[sender].insert(0, receiver)
-                if len(self.recent_chats[sender]) > 5:
-                    self.recent_chats[sender].pop()
-            
-            if receiver in self.recent_chats and sender not in self.recent_chats[receiver]:
-                self.recent_chats[receiver].insert(0, sender)
-                if len(self.recent_chats[receiver]) > 5:
-                    self.recent_chats[receiver].pop()
+        if sender in self.recent_chats:
+            self.recent_chats.add(sender, receiver)
+        if receiver in self.recent_chats:
+            self.recent_chats.add(receiver, sender)
         
         # Send to receiver
-        receiver_socket = self._find_client_socket(receiver)
-        if receiver_socket:
-            self._send_to_client(receiver_socket, message)
-        else:
+        if not self._send_to_user(receiver, message):
             error_msg = {
                 'type': 'system',
                 'sender': 'Server',
@@ -753,7 +763,7 @@ class CollaborationServer:
         if not receiver or not file_id:
             return
         
-        print(f"📨 Private file from {sender} to {receiver}: {file_name}")
+        files_log.debug("Private file from %s to %s: %s", sender, receiver, file_name)
         
         # Create message object for storage - PRIVATE ONLY, don't broadcast
         file_message = {
@@ -768,36 +778,20 @@ class CollaborationServer:
         }
         
         # Store in private chat history ONLY
-        storage.add_private_message(sender, receiver, file_message)
+        self.storage.add_private_message(sender, receiver, file_message)
         
         # Update recent chats
-        with self.lock:
-            if sender not in self.recent_chats:
-                self.recent_chats[sender] = []
-            if receiver not in self.recent_chats:
-                self.recent_chats[receiver] = []
-                
-            if receiver not in self.recent_chats[sender]:
-                self.recent_chats[sender].insert(0, receiver)
-                if len(self.recent_chats[sender]) > 5:
-                    self.recent_chats[sender].pop()
-            
-            if sender not in self.recent_chats[receiver]:
-                self.recent_chats[receiver].insert(0, sender)
-                if len(self.recent_chats[receiver]) > 5:
-                    self.recent_chats[receiver].pop()
+        self.recent_chats.add(sender, receiver)
+        self.recent_chats.add(receiver, sender)
         
         # Send ONLY to receiver if online - don't broadcast to everyone
-        receiver_socket = self._find_client_socket(receiver)
-        if receiver_socket:
-            self._send_to_client(receiver_socket, file_message)
-            print(f"   ✓ Sent file to {receiver}")
+        if self._send_to_user(receiver, file_message):
+            files_log.debug("Sent file to %s", receiver)
         else:
-            print(f"   ℹ️  {receiver} is offline, file saved to history")
+            files_log.debug("%s is offline, file saved to history", receiver)
         
         # Send acknowledgment back to sender
         self._send_to_client(client_socket, file_message)
-        print(f"   ✓ Sent file acknowledgment to {sender}")
 
     def _handle_group_create(self, client_socket: socket.socket, message: Dict):
         """Handle group creation"""
@@ -810,7 +804,7 @@ class CollaborationServer:
         
         group_id = f"group_{int(time.time() * 1000)}"
         
-        with self.lock:
+        with self.groups_lock:
             members_set = set(members)
             members_set.add(creator)
             
@@ -823,10 +817,10 @@ class CollaborationServer:
                 'created_at': self._timestamp()
             }
             self.groups[group_id] = group_data
-            self.group_messages[group_id] = []
+            version = self._bump_group_version(group_id)
         
         # Persist group to storage
-        storage.add_group(group_id, group_data)
+        self.storage.add_group(group_id, group_data)
         
         notification = {
             'type': 'group_created',
@@ -835,14 +829,13 @@ class CollaborationServer:
             'members': list(members_set),
             'created_by': creator,
             'admin': creator,
+            'version': version,
             'timestamp': self._timestamp()
         }
         
         self._notify_group_members(group_id, notification)
-        self.broadcast_group_list()
         
-        print(f"✓ Group '{group_name}' created by {creator} ({len(members_set)} members)")
-        print(f"✓ Group persisted to storage with ID: {group_id}")
+        groups_log.info("Group '%s' (%s) created by %s (%d members)", group_name, group_id, creator, len(members_set))
 
     def _handle_group_message(self, client_socket: socket.socket, message: Dict):
         """Handle group message"""
@@ -850,41 +843,24 @@ class CollaborationServer:
         sender = message.get('sender')
         metadata = message.get('metadata', {})
         
-        print(f"\n🔍 [DEBUG] _handle_group_message called")
-        print(f"   Group ID: {group_id}")
-        print(f"   Sender: {sender}")
-        print(f"   Content: {message.get('content', '')[:50]}")
-        
         if group_id not in self.groups:
-            print(f"   ❌ Group not found: {group_id}")
-            print(f"   Available groups: {list(self.groups.keys())}")
+            groups_log.warning("Group message from %s for unknown group %s", sender, group_id)
             self._send_error(client_socket, "Group not found")
             return
         
         if sender not in self.groups[group_id]['members']:
-            print(f"   ❌ Sender not in group members")
+            groups_log.debug("Dropped group message from non-member %s in %s", sender, group_id)
             return
         
         # Preserve metadata in the message
         if metadata:
             message['metadata'] = metadata
-            if metadata.get('replyTo'):
-                print(f"   ↩️ Reply to: {metadata['replyTo'].get('sender')} - {metadata['replyTo'].get('text', '')[:30]}")
         
-        self.group_messages[group_id].append(message)
-        storage.add_group_message(group_id, message)  # PERSIST TO STORAGE
+        self.storage.add_group_message(group_id, message)  # PERSIST TO STORAGE
         
-        print(f"   📤 Sending to group members...")
         # Send to ALL group members INCLUDING the sender (so sender sees confirmation)
-        sent_count = 0
-        with self.lock:
-            for sock, info in self.clients.items():
-                if info['username'] in self.groups[group_id]['members']:
-                    self._send_to_client(sock, message)
-                    sent_count += 1
-                    print(f"      → Sent to {info['username']}")
-        
-        print(f"   ✅ Sent to {sent_count} members\n")
+        sent_count = self._notify_group_members(group_id, message)
+        groups_log.debug("Group message from %s in %s sent to %d connections", sender, group_id, sent_count)
 
     def _handle_group_file(self, client_socket: socket.socket, message: Dict):
         """Handle group file sharing"""
@@ -900,7 +876,7 @@ class CollaborationServer:
         if sender not in self.groups[group_id]['members']:
             return
         
-        print(f"📨 Group file from {sender} in group {group_id}: {file_name}")
+        files_log.debug("Group file from %s in group %s: %s", sender, group_id, file_name)
         
         # Create file message for group
         file_message = {
@@ -915,14 +891,10 @@ class CollaborationServer:
         }
         
         # Store in group chat history
-        self.group_messages[group_id].append(file_message)
-        storage.add_group_message(group_id, file_message)
+        self.storage.add_group_message(group_id, file_message)
         
         # Send to all group members INCLUDING the sender (for confirmation)
-        with self.lock:
-            for sock, info in self.clients.items():
-                if info['username'] in self.groups[group_id]['members']:
-                    self._send_to_client(sock, file_message)
+        self._notify_group_members(group_id, file_message)
 
     def _handle_group_add_member(self, client_socket: socket.socket, message: Dict):
         """Handle adding member to group"""
@@ -933,24 +905,31 @@ class CollaborationServer:
         if not self._validate_group_operation(client_socket, group_id, requester, require_membership=True):
             return
         
-        with self.lock:
-            if username not in self.groups[group_id]['members']:
-                self.groups[group_id]['members'].append(username)
-                
-                notification = {
-                    'type': 'group_member_added',
-                    'group_id': group_id,
-                    'group_name': self.groups[group_id]['name'],
-                    'username': username,
-                    'added_by': requester,
-                    'timestamp': self._timestamp()
-                }
-                
-                # Persist the updated group to storage
-                storage.update_group(group_id, {'members': self.groups[group_id]['members']})
-                
-                self._notify_group_members(group_id, notification)
-                self.broadcast_group_list()
+        with self.groups_lock:
+            group = self.groups.get(group_id)
+            if group is None or username in group['members']:
+                return  # Deleted since validation, or already a member
+            # Replace rather than mutate so lock-free readers never see a list mid-change
+            members = group['members'] + [username]
+            group['members'] = members
+            version = self._bump_group_version(group_id)
+            
+            notification = {
+                'type': 'group_member_added',
+                'group_id': group_id,
+                'group_name': group['name'],
+                'username': username,
+                'added_by': requester,
+                # The new member has never seen this group, so ship its summary along
+                'group': self._group_summary(group_id),
+                'version': version,
+                'timestamp': self._timestamp()
+            }
+        
+        # Persist the updated group to storage
+        self.storage.update_group(group_id, {'members': members, 'version': version})
+        
+        self._notify_group_members(group_id, notification)
 
     def _handle_group_remove_member(self, client_socket: socket.socket, message: Dict):
         """Handle removing member from group"""
@@ -965,24 +944,28 @@ class CollaborationServer:
             self._send_error(client_socket, "Only the group creator can remove members")
             return
         
-        with self.lock:
-            if username in self.groups[group_id]['members']:
-                self.groups[group_id]['members'].remove(username)
-                
-                notification = {
-                    'type': 'group_member_removed',
-                    'group_id': group_id,
-                    'group_name': self.groups[group_id]['name'],
-                    'username': username,
-                    'removed_by': requester,
-                    'timestamp': self._timestamp()
-                }
-                
-                # Persist the updated group to storage
-                storage.update_group(group_id, {'members': self.groups[group_id]['members']})
-                
-                self._notify_group_members(group_id, notification, include_removed=username)
-                self.broadcast_group_list()
+        with self.groups_lock:
+            group = self.groups.get(group_id)
+            if group is None or username not in group['members']:
+                return  # Deleted meanwhile, or not a member
+            members = [m for m in group['members'] if m != username]
+            group['members'] = members
+            version = self._bump_group_version(group_id)
+            
+            notification = {
+                'type': 'group_member_removed',
+                'group_id': group_id,
+                'group_name': group['name'],
+                'username': username,
+                'removed_by': requester,
+                'version': version,
+                'timestamp': self._timestamp()
+            }
+        
+        # Persist the updated group to storage
+        self.storage.update_group(group_id, {'members': members, 'version': version})
+        
+        self._notify_group_members(group_id, notification, include_removed=username)
 
     def _handle_group_update_name(self, client_socket: socket.socket, message: Dict):
         """Handle updating group name"""
@@ -999,24 +982,25 @@ class CollaborationServer:
             self._send_error(client_socket, "Only admin can change group name")
             return
         
-        with self.lock:
+        with self.groups_lock:
             self.groups[group_id]['name'] = new_name
-            
-            # Persist to storage
-            storage.update_group(group_id, {'name': new_name})
-            
-            notification = {
-                'type': 'group_name_changed',
-                'group_id': group_id,
-                'new_name': new_name,
-                'changed_by': requester,
-                'timestamp': self._timestamp()
-            }
-            
-            self._notify_group_members(group_id, notification)
-            self.broadcast_group_list()
-            
-            print(f"✓ Group '{group_id}' name changed to '{new_name}' by {requester}")
+            version = self._bump_group_version(group_id)
+        
+        # Persist to storage
+        self.storage.update_group(group_id, {'name': new_name, 'version': version})
+        
+        notification = {
+            'type': 'group_name_changed',
+            'group_id': group_id,
+            'new_name': new_name,
+            'changed_by': requester,
+            'version': version,
+            'timestamp': self._timestamp()
+        }
+        
+        self._notify_group_members(group_id, notification)
+        
+        groups_log.info("Group '%s' name changed to '%s' by %s", group_id, new_name, requester)
 
     def _handle_group_change_admin(self, client_socket: socket.socket, message: Dict):
         """Handle changing group admin"""
@@ -1038,26 +1022,27 @@ class CollaborationServer:
             self._send_error(client_socket, "New admin must be a group member")
             return
         
-        with self.lock:
+        with self.groups_lock:
             old_admin = self.groups[group_id].get('admin', self.groups[group_id].get('created_by'))
             self.groups[group_id]['admin'] = new_admin
-            
-            # Persist to storage
-            storage.update_group(group_id, {'admin': new_admin})
-            
-            notification = {
-                'type': 'group_admin_changed',
-                'group_id': group_id,
-                'old_admin': old_admin,
-                'new_admin': new_admin,
-                'changed_by': requester,
-                'timestamp': self._timestamp()
-            }
-            
-            self._notify_group_members(group_id, notification)
-            self.broadcast_group_list()
-            
-            print(f"✓ Group '{group_id}' admin changed from {old_admin} to {new_admin}")
+            version = self._bump_group_version(group_id)
+        
+        # Persist to storage
+        self.storage.update_group(group_id, {'admin': new_admin, 'version': version})
+        
+        notification = {
+            'type': 'group_admin_changed',
+            'group_id': group_id,
+            'old_admin': old_admin,
+            'new_admin': new_admin,
+            'changed_by': requester,
+            'version': version,
+            'timestamp': self._timestamp()
+        }
+        
+        self._notify_group_members(group_id, notification)
+        
+        groups_log.info("Group '%s' admin changed from %s to %s", group_id, old_admin, new_admin)
 
     def _handle_group_delete(self, client_socket: socket.socket, message: Dict):
         """Handle deleting a group"""
@@ -1075,27 +1060,26 @@ class CollaborationServer:
         
         group_name = self.groups[group_id]['name']
         
-        with self.lock:
-            del self.groups[group_id]
-            if group_id in self.group_messages:
-                del self.group_messages[group_id]
-            
-            # Remove from persistent storage
-            storage.remove_group(group_id)
-            
+        with self.groups_lock:
             notification = {
                 'type': 'group_deleted',
                 'group_id': group_id,
                 'group_name': group_name,
                 'deleted_by': requester,
+                'version': self._next_groups_version(),
                 'timestamp': self._timestamp()
             }
-            
-            # Notify members before deleting (though they won't find group after)
-            self.broadcast(json.dumps(notification))
-            self.broadcast_group_list()
-            
-            print(f"✓ Group '{group_name}' deleted by {requester}")
+        
+        # Notify members while the group still exists so the member list can be resolved
+        self._notify_group_members(group_id, notification)
+        
+        # Storage drops the group's history too. In a single process self.groups
+        # is storage's own dict, so the pop is a no-op there
+        with self.groups_lock:
+            self.storage.remove_group(group_id)
+            self.groups.pop(group_id, None)
+        
+        groups_log.info("Group '%s' deleted by %s", group_name, requester)
 
     def _handle_private_history_request(self, client_socket: socket.socket, message: Dict):
         """Handle request for private message history"""
@@ -1105,57 +1089,30 @@ class CollaborationServer:
         if not username or not receiver:
             return
         
-        # GET FROM STORAGE FIRST
-        messages = storage.get_private_chat(username, receiver, 100)
-        
-        response = {
-            'type': 'private_history',
-            'receiver': receiver,
-            'messages': messages
-        }
-        self._send_to_client(client_socket, response)
+        self._send_history(client_socket, ('private_history', username, receiver), ('private', username, receiver),
+                           lambda: {
+                               'type': 'private_history',
+                               'receiver': receiver,
+                               'messages': self.storage.get_private_chat(username, receiver, 100)
+                           })
 
     def _handle_group_history_request(self, client_socket: socket.socket, message: Dict):
         """Handle request for group message history"""
         username = self.clients.get(client_socket, {}).get('username')
         group_id = message.get('group_id')
         
-        print(f"\n📜 [DEBUG] Group history request")
-        print(f"   User: {username}")
-        print(f"   Group ID: {group_id}")
-        
         if not self._validate_group_operation(client_socket, group_id, username, require_membership=True):
-            print(f"   ❌ Validation failed")
+            groups_log.debug("Group history request from %s for %s rejected", username, group_id)
             return
         
-        # Check cache to prevent duplicate sends
-        cache_key = f"{username}:{group_id}"
-        current_time = time.time()
-        
-        if cache_key in self.history_request_cache:
-            last_send_time = self.history_request_cache[cache_key]
-            time_since_last_send = current_time - last_send_time
-            
-            if time_since_last_send < self.HISTORY_CACHE_DURATION:
-                print(f"   ⏭️ Skipping duplicate history send to {username}")
-                print(f"      Last sent {time_since_last_send:.2f}s ago (threshold: {self.HISTORY_CACHE_DURATION}s)\n")
-                return
-        
-        # Update cache
-        self.history_request_cache[cache_key] = current_time
-        
-        # GET FROM STORAGE FIRST
-        messages = storage.get_group_chat(group_id, 100)
-        
-        print(f"   📨 Sending {len(messages)} messages to {username}")
-        
-        response = {
-            'type': 'group_history',
-            'group_id': group_id,
-            'messages': messages
-        }
-        self._send_to_client(client_socket, response)
-        print(f"   ✅ History sent\n")
+        # Same page for every member; repeated requests are held back by the rate limiter
+        self._send_history(client_socket, ('group_history', group_id), ('group', group_id),
+                           lambda: {
+                               'type': 'group_history',
+                               'group_id': group_id,
+                               'messages': self.storage.get_group_chat(group_id, 100)
+                           })
+        groups_log.debug("Sent history for %s to %s", group_id, username)
 
     def _handle_screen_share(self, client_socket: socket.socket, message: Dict):
         """Handle screen sharing message"""
@@ -1167,13 +1124,7 @@ class CollaborationServer:
         target = message.get('target')
         
         if username and target:
-            with self.lock:
-                if username in self.recent_chats:
-                    if target in self.recent_chats[username]:
-                        self.recent_chats[username].remove(target)
-                    self.recent_chats[username].insert(0, target)
-                    if len(self.recent_chats[username]) > 5:
-                        self.recent_chats[username].pop()
+            self.recent_chats.promote(username, target)
 
     def _handle_video_invite(self, client_socket: socket.socket, message: Dict):
         """Handle global video call invite"""
@@ -1181,15 +1132,11 @@ class CollaborationServer:
         session_id = message.get('session_id')
         link = message.get('link')
         
-        print(f"[SERVER] Received global video invite from {sender}")
-        print(f"[SERVER] Session ID: {session_id}")
-        print(f"[SERVER] Link: {link}")
-        
         if not session_id or not link:
-            print(f"[SERVER] ERROR: Missing session_id or link in video invite")
+            calls_log.warning("Global video invite from %s is missing session_id or link", sender)
             return
         
-        print(f"📹 Global video invite from {sender}")
+        calls_log.info("Global video invite from %s (session %s)", sender, session_id)
 
         # Create video invite message
         video_invite = {
@@ -1203,13 +1150,10 @@ class CollaborationServer:
 
         # Persist to global chat history
         self.chat_history.append(video_invite)
-        storage.add_global_message(video_invite)
+        self.storage.add_global_message(video_invite)
         if len(self.chat_history) > 1000:
             self.chat_history = self.chat_history[-1000:]
 
-        print(f"[SERVER] Broadcasting global video invite to all clients")
-        print(f"[SERVER] Connected clients count: {len(self.clients)}")
-
         # Broadcast to all clients including sender (so sender can see join button)
         self.broadcast(json.dumps(video_invite), exclude=None)
 
@@ -1221,10 +1165,10 @@ class CollaborationServer:
         link = message.get('link')
 
         if not receiver or not session_id or not link:
-            print(f"[SERVER] ERROR: Missing receiver, session_id or link in private video invite")
+            calls_log.warning("Private video invite from %s is missing receiver, session_id or link", sender)
             return
 
-        print(f"📹 Private video invite from {sender} to {receiver}")
+        calls_log.info("Private video invite from %s to %s (session %s)", sender, receiver, session_id)
 
         # Create the primary video invite message
         video_invite_message = {
@@ -1238,21 +1182,16 @@ class CollaborationServer:
         }
 
         # Persist the single invite message to the shared private history
-        storage.add_private_message(sender, receiver, video_invite_message)
+        self.storage.add_private_message(sender, receiver, video_invite_message)
 
         # Send the full invite to the receiver if they are online
-        receiver_socket = self._find_client_socket(receiver)
-        if receiver_socket:
-            print(f"[SERVER] Found receiver socket, sending video invite to {receiver}")
-            self._send_to_client(receiver_socket, video_invite_message)
-            print(f"   ✓ Sent video invite to {receiver}")
+        if self._send_to_user(receiver, video_invite_message):
+            calls_log.debug("Sent video invite to %s", receiver)
         else:
-            print(f"   ℹ️  {receiver} is offline - message will be in history.")
+            calls_log.debug("%s is offline - invite will be in history", receiver)
 
         # Send the full invite to the sender as well (so they can see the join button)
-        print(f"[SERVER] Sending full video invite to sender {sender}")
         self._send_to_client(client_socket, video_invite_message)
-        print(f"[SERVER] Sent video invite to sender {sender}")
 
     def _handle_video_invite_group(self, client_socket: socket.socket, message: Dict):
         """Handle group video call invite"""
@@ -1261,15 +1200,9 @@ class CollaborationServer:
         session_id = message.get('session_id')
         link = message.get('link')
         
-        print(f"[SERVER] ========== GROUP VIDEO INVITE ==========")
-        print(f"[SERVER] Received group video invite from {sender} for group {group_id}")
-        print(f"[SERVER] Session ID: {session_id}")
-        print(f"[SERVER] Link: {link}")
-        print(f"[SERVER] Available groups: {list(self.groups.keys())}")
-        
         # Validate group_id
         if not group_id:
-            print(f"[SERVER] ERROR: group_id is None or empty!")
+            calls_log.warning("Group video invite from %s has no group_id", sender)
             self._send_to_client(client_socket, {
                 'type': 'system',
                 'content': 'Error: Invalid group ID for video call'
@@ -1277,8 +1210,7 @@ class CollaborationServer:
             return
             
         if group_id not in self.groups:
-            print(f"[SERVER] ERROR: Group {group_id} does not exist!")
-            print(f"[SERVER] Available groups: {list(self.groups.keys())}")
+            calls_log.warning("Group video invite from %s for unknown group %s", sender, group_id)
             self._send_to_client(client_socket, {
                 'type': 'system',
                 'content': f'Error: Group {group_id} not found'
@@ -1286,7 +1218,7 @@ class CollaborationServer:
             return
         
         if not session_id or not link:
-            print(f"[SERVER] ERROR: Missing session_id or link in group video invite")
+            calls_log.warning("Group video invite from %s is missing session_id or link", sender)
             self._send_to_client(client_socket, {
                 'type': 'system',
                 'content': 'Error: Invalid video session data'
@@ -1294,16 +1226,14 @@ class CollaborationServer:
             return
         
         if sender not in self.groups[group_id]['members']:
-            print(f"[SERVER] ERROR: Sender {sender} is not a member of group {group_id}")
-            print(f"[SERVER] Group members: {self.groups[group_id]['members']}")
+            calls_log.warning("Group video invite from non-member %s in %s", sender, group_id)
             self._send_to_client(client_socket, {
                 'type': 'system',
                 'content': 'Error: You are not a member of this group'
             })
             return
         
-        print(f"📹 Group video invite from {sender} in group {group_id}")
-        print(f"[SERVER] Group has {len(self.groups[group_id]['members'])} members")
+        calls_log.info("Group video invite from %s in %s (session %s)", sender, group_id, session_id)
         
         # Create the primary video invite message
         video_invite_message = {
@@ -1316,23 +1246,12 @@ class CollaborationServer:
             'timestamp': message.get('timestamp', self._timestamp())
         }
         
-        print(f"[SERVER] Sending group video invite to {len(self.groups[group_id]['members'])} members")
-        
         # Persist to group history (single message for all)
-        storage.add_group_message(group_id, video_invite_message)
-        print(f"[SERVER] Persisted video invite to group history")
+        self.storage.add_group_message(group_id, video_invite_message)
 
         # Send to all group members including sender
-        sent_count = 0
-        with self.lock:
-            for sock, info in self.clients.items():
-                if info['username'] in self.groups[group_id]['members']:
-                    print(f"[SERVER] Sending video invite to group member: {info['username']}")
-                    self._send_to_client(sock, video_invite_message)
-                    sent_count += 1
-        
-        print(f"[SERVER] Successfully sent video invite to {sent_count} members")
-        print(f"[SERVER] ========================================")
+        sent_count = self._notify_group_members(group_id, video_invite_message)
+        calls_log.debug("Sent group video invite to %d connections", sent_count)
 
     def _handle_video_missed(self, client_socket: socket.socket, message: Dict):
         """Handle missed video call notifications - DO NOT STORE, just update UI"""
@@ -1366,10 +1285,7 @@ class CollaborationServer:
                 return
 
             # Send to both if online (but don't store)
-            with self.lock:
-                for sock, info in self.clients.items():
-                    if info['username'] in [sender, other]:
-                        self._send_to_client(sock, missed_msg)
+            self._send_to_users({sender, other}, missed_msg)
 
         elif session_type == 'group':
             group_id = chat_id
@@ -1386,11 +1302,7 @@ class CollaborationServer:
         link = message.get('link')
         timestamp = message.get('timestamp', self._timestamp())
 
-        print(f"[SERVER] ========================================")
-        print(f"[SERVER] GLOBAL AUDIO INVITE from {sender}")
-        print(f"[SERVER] Session ID: {session_id}")
-        print(f"[SERVER] Link: {link}")
-        print(f"[SERVER] ========================================")
+        calls_log.info("Global audio invite from %s (session %s)", sender, session_id)
 
         # Create audio invite message
         audio_invite = {
@@ -1404,7 +1316,7 @@ class CollaborationServer:
 
         # Add to global chat history
         self.chat_history.append(audio_invite)
-        storage.add_global_message(audio_invite)
+        self.storage.add_global_message(audio_invite)
         if len(self.chat_history) > 1000:
             self.chat_history = self.chat_history[-1000:]
 
@@ -1419,11 +1331,7 @@ class CollaborationServer:
         link = message.get('link')
         timestamp = message.get('timestamp', self._timestamp())
 
-        print(f"[SERVER] ========================================")
-        print(f"[SERVER] PRIVATE AUDIO INVITE from {sender} to {receiver}")
-        print(f"[SERVER] Session ID: {session_id}")
-        print(f"[SERVER] Link: {link}")
-        print(f"[SERVER] ========================================")
+        calls_log.info("Private audio invite from %s to %s (session %s)", sender, receiver, session_id)
 
         # Create audio invite message
         audio_invite_message = {
@@ -1437,19 +1345,10 @@ class CollaborationServer:
         }
 
         # Store in private chat history
-        storage.add_private_message(sender, receiver, audio_invite_message)
+        self.storage.add_private_message(sender, receiver, audio_invite_message)
 
         # Send to both sender and receiver if they're online
-        with self.lock:
-            for sock, info in self.clients.items():
-                if info['username'] == receiver:
-                    print(f"[SERVER] Sending audio invite to receiver: {receiver}")
-                    self._send_to_client(sock, audio_invite_message)
-                elif info['username'] == sender:
-                    print(f"[SERVER] Sending audio invite confirmation to sender: {sender}")
-                    self._send_to_client(sock, audio_invite_message)
-
-        print(f"[SERVER] Sent audio invite to sender {sender}")
+        self._send_to_users({sender, receiver}, audio_invite_message)
 
     def _handle_audio_invite_group(self, client_socket: socket.socket, message: Dict):
         """Handle group audio call invite"""
@@ -1459,15 +1358,9 @@ class CollaborationServer:
         link = message.get('link')
         timestamp = message.get('timestamp', self._timestamp())
 
-        print(f"[SERVER] ========================================")
-        print(f"[SERVER] GROUP AUDIO INVITE from {sender} to group {group_id}")
-        print(f"[SERVER] Session ID: {session_id}")
-        print(f"[SERVER] Link: {link}")
-        print(f"[SERVER] ========================================")
-
         # Validate group exists
         if group_id not in self.groups:
-            print(f"[SERVER] ERROR: Group {group_id} not found")
+            calls_log.warning("Group audio invite from %s for unknown group %s", sender, group_id)
             self._send_to_client(client_socket, {
                 'type': 'system',
                 'content': 'Error: Invalid group ID for audio call'
@@ -1486,22 +1379,12 @@ class CollaborationServer:
         }
 
         # Store in group history
-        if group_id not in self.group_messages:
-            self.group_messages[group_id] = []
-        self.group_messages[group_id].append(audio_invite_message)
-        storage.add_group_message(group_id, audio_invite_message)
+        self.storage.add_group_message(group_id, audio_invite_message)
 
         # Send to all group members
-        sent_count = 0
-        with self.lock:
-            for sock, info in self.clients.items():
-                if info['username'] in self.groups[group_id]['members']:
-                    print(f"[SERVER] Sending audio invite to group member: {info['username']}")
-                    self._send_to_client(sock, audio_invite_message)
-                    sent_count += 1
-        
-        print(f"[SERVER] Successfully sent audio invite to {sent_count} members")
-        print(f"[SERVER] ========================================")
+        calls_log.info("Group audio invite from %s in %s (session %s)", sender, group_id, session_id)
+        sent_count = self._notify_group_members(group_id, audio_invite_message)
+        calls_log.debug("Sent group audio invite to %d connections", sent_count)
 
     def _handle_audio_missed(self, client_socket: socket.socket, message: Dict):
         """Handle missed audio call notifications"""
@@ -1535,10 +1418,7 @@ class CollaborationServer:
                 return
 
             # Send to both if online (but don't store)
-            with self.lock:
-                for sock, info in self.clients.items():
-                    if info['username'] in [sender, other]:
-                        self._send_to_client(sock, missed_msg)
+            self._send_to_users({sender, other}, missed_msg)
 
         elif session_type == 'group':
             group_id = chat_id
@@ -1548,41 +1428,9 @@ class CollaborationServer:
             # Notify group members (but don't store)
             self._notify_group_members(group_id, missed_msg)
 
-    def handle_file_transfer(self, client_socket: socket.socket, address: Tuple):
-        """Handle file upload or download"""
-        try:
-            # Increased timeout for large file transfers - 5 minutes
-            client_socket.settimeout(300.0)
-            
-            first_data = client_socket.recv(4096).decode('utf-8')
-            first_msg = json.loads(first_data)
-            
-            if 'file_name' in first_msg:
-                self._handle_file_upload(client_socket, first_msg)
-            elif 'file_id' in first_msg:
-                self._handle_file_download(client_socket, first_msg)
-            
-        except socket.timeout:
-            print(f"⏱️ File transfer timeout from {address}")
-        except json.JSONDecodeError as e:
-            print(f"⚠️ Invalid file transfer JSON: {e}")
-        except Exception as e:
-            print(f"❌ File transfer error: {e}")
-        finally:
-            try:
-                client_socket.close()
-            except:
-                pass
-
-    def _handle_file_upload(self, client_socket: socket.socket, metadata: Dict):
-        """Handle file upload"""
-        file_name = metadata.get('file_name')
-        file_size = metadata.get('file_size')
-        sender = metadata.get('sender')
+    def register_upload(self, file_name: str, file_size: int, sender: str) -> str:
+        """Record an upload that is about to start and return its file_id"""
         file_id = f"{int(time.time() * 1000)}_{file_name}"
-        
-        print(f"📤 Receiving: {file_name} ({self._format_bytes(file_size)}) from {sender}")
-        
         self.file_metadata[file_id] = {
             'file_id': file_id,
             'file_name': file_name,
@@ -1594,88 +1442,45 @@ class CollaborationServer:
         }
         
         # PERSIST TO STORAGE
-        storage.add_file(file_id, self.file_metadata[file_id])
-        
-        client_socket.send(json.dumps({
-            'status': 'ready',
-            'file_id': file_id
-        }).encode('utf-8'))
-        
-        file_data = b''
-        bytes_received = 0
-        
-        while bytes_received < file_size:
-            remaining = file_size - bytes_received
-            chunk_size = min(4096, remaining)
-            chunk = client_socket.recv(chunk_size)
-            if not chunk:
-                break
-            file_data += chunk
-            bytes_received += len(chunk)
-        
-        self.file_metadata[file_id]['data'] = file_data
-        
-        if bytes_received == file_size:
-            print(f"✓ File received: {file_name} ({self._format_bytes(bytes_received)})")
-            
-            # Don't broadcast file_notification here anymore
-            # Let the client send private_file, group_file, or explicit global broadcast
-            # This prevents files from appearing in wrong chat contexts
-            
-        else:
-            print(f"⚠️ Incomplete file transfer: {bytes_received}/{file_size} bytes")
-
-    def _handle_file_download(self, client_socket: socket.socket, request: Dict):
-        """Handle file download"""
-        file_id = request.get('file_id')
-        requester = request.get('requester')
-        
-        if file_id not in self.file_metadata:
-            client_socket.send(json.dumps({
-                'status': 'error',
-                'message': 'File not found'
-            }).encode('utf-8'))
-            return
-        
-        file_info = self.file_metadata[file_id]
-        
-        client_socket.send(json.dumps({
-            'status': 'sending',
-            'file_name': file_info['file_name'],
-            'file_size': file_info['size']
-        }).encode('utf-8'))
-        
-        try:
-            client_socket.recv(1024)
-        except:
-            pass
-        
-        file_data = file_info.get('data', b'')
-        try:
-            client_socket.sendall(file_data)
-            print(f"✓ File sent: {file_info['file_name']} to {requester}")
-        except Exception as e:
-            print(f"❌ Error sending file: {e}")
+        self.storage.add_file(file_id, self.file_metadata[file_id])
+        # Don't broadcast a file_notification when the bytes arrive; the client
+        # sends private_file, group_file or a global share so the file shows up
+        # in the right chat
+        return file_id
 
     def send_chat_history(self, client_socket: socket.socket):
         """Send recent chat history to client"""
         try:
-            # GET FROM STORAGE (send a larger slice to feel buffered even after idle)
-            messages = storage.get_global_chat(300)
-            
-            history_msg = {
-                'type': 'chat_history',
-                'messages': messages
-            }
-            self._send_to_client(client_socket, history_msg)
+            # A larger slice, so the chat feels buffered even after being idle
+            self._send_history(client_socket, ('chat_history',), ('global',),
+                               lambda: {'type': 'chat_history', 'messages': self.storage.get_global_chat(300)})
         except Exception as e:
-            print(f"❌ Error sending chat history: {e}")
+            log.error("Error sending chat history: %s", e)
+
+    def _send_history(self, client_socket: socket.socket, cache_key: Tuple, conversation: Tuple,
+                      build: Any):
+        """Send a history page, serializing it only if the conversation changed since it was cached"""
+        # Read the version before building: a write in between leaves a page newer
+        # than its version, which the next lookup simply misses
+        version = self.storage.history_version(*conversation)
+        data = self.history_cache.get(cache_key, version)
+        if data is None:
+            self._history_miss.inc()
+            data = (json.dumps(build()) + '\n').encode('utf-8')
+            self.history_cache.put(cache_key, version, data)
+        else:
+            self._history_hit.inc()
+        try:
+            self._send_raw(client_socket, data)
+        except Exception as e:
+            username = self.clients.get(client_socket, {}).get('username', 'Unknown')
+            log.warning("Error sending %s to %s: %s", cache_key[0], username, e)
 
     def send_file_metadata(self, client_socket: socket.socket):
         """Send file metadata to client"""
         try:
             # GET FROM STORAGE
-            all_files = storage.get_files()
+            all_files = self.storage.get_files()
             
             files = [
                 {
@@ -1695,184 +1500,270 @@ class CollaborationServer:
                 'files': files
             })
         except Exception as e:
-            print(f"❌ Error sending file metadata: {e}")
+            files_log.error("Error sending file metadata: %s", e)
 
-    def send_group_list(self, client_socket: socket.socket):
-        """Send group list to client"""
+    def send_group_list(self, client_socket: socket.socket, since_version: Optional[int] = None):
+        """Send the groups the client belongs to (nothing if it is already at since_version)"""
         try:
-            with self.lock:
-                groups = [
-                    {
-                        'id': gid,
-                        'name': ginfo['name'],
-                        'members': ginfo['members'],
-                        'created_by': ginfo['created_by']
-                    }
-                    for gid, ginfo in self.groups.items()
-                ]
+            username = self.clients.get(client_socket, {}).get('username')
+            with self.groups_lock:
+                version = self.groups_version
+                if since_version == version:
+                    groups = []
+                else:
+                    groups = [
+                        self._group_summary(gid)
+                        for gid, ginfo in self.groups.items()
+                        if username in ginfo['members']
+                    ]
             
             self._send_to_client(client_socket, {
                 'type': 'group_list',
-                'groups': groups
+                'groups': groups,
+                'version': version,
+                'unchanged': since_version == version
             })
         except Exception as e:
-            print(f"❌ Error sending group list: {e}")
+            groups_log.error("Error sending group list: %s", e)
+
+    def _group_summary(self, group_id: str) -> Dict[str, Any]:
+        """Client-facing view of a group (call with self.groups_lock held)"""
+        ginfo = self.groups[group_id]
+        return {
+            'id': group_id,
+            'name': ginfo['name'],
+            'members': list(ginfo['members']),
+            'created_by': ginfo['created_by'],
+            'admin': ginfo.get('admin', ginfo['created_by']),
+            'version': ginfo.get('version', 0)
+        }
+
+    def _bump_group_version(self, group_id: str) -> int:
+        """Record a change to a group and return its new version (call with self.groups_lock held)"""
+        self.groups[group_id]['version'] = self._next_groups_version()
+        return self.groups_version
+
+    def _next_groups_version(self) -> int:
+        """Advance groups_version (call with self.groups_lock held)"""
+        if self.shard is not None:
+            # Shard workers draw from one shared counter so versions stay comparable
+            self.groups_version = self.shard.next_groups_version()
+        else:
+            self.groups_version += 1
+        return self.groups_version
 
     def send_user_list_to_client(self, client_socket: socket.socket):
-        """Send user list to a specific client"""
+        """Send a full presence snapshot to a specific client"""
         try:
-            with self.lock:
-                requester = self.clients.get(client_socket, {}).get('username')
-                # Filter out system users and the requester themselves
-                users = [info['username'] for info in self.clients.values()
-                         if not (info['username'].startswith('_') and info['username'].endswith('_System_'))
-                         and info['username'] != requester]
-
-            # Send outside the lock to avoid deadlock
+            requester = self.clients.get(client_socket, {}).get('username')
+            
+            # Snapshot and version are read together so the client can tell
+            # which presence deltas it still needs to apply
+            with self.presence_lock:
+                users = [u for u in self.presence_sessions if u != requester]
+                version = self.presence_version
+
             self._send_to_client(client_socket, {
                 'type': 'user_list',
-                'users': sorted(users)
+                'users': sorted(users),
+                'version': version
             })
-            print(f"📋 Sent user list to client '{requester}': {users}")
+            presence_log.debug("Sent user list to '%s': %d users (v%d)", requester, len(users), version)
         except Exception as e:
-            print(f"❌ Error sending user list: {e}")
+            presence_log.error("Error sending user list: %s", e)
 
-    def broadcast(self, message: str, exclude: Optional[socket.socket] = None):
+    def broadcast(self, message: str, exclude: Optional[socket.socket] = None, local_only: bool = False):
         """Broadcast message to all clients except excluded one"""
-        # Track failed attempts per socket (class-level to persist across calls)
-        if not hasattr(self, '_broadcast_failures'):
-            self._broadcast_failures = {}
-        
-        with self.lock:
-            total_clients = len(self.clients)
-            excluded_str = "excluding 1" if exclude else "to all"
-            print(f"📤 Broadcasting {excluded_str} {total_clients} client(s)")
-            
-            disconnected = []
-            sent_count = 0
-            
-            for sock in list(self.clients.keys()):
-                if sock != exclude:
-                    try:
-                        sock.send((message + '\n').encode('utf-8'))
-                        sent_count += 1
-                        username = self.clients[sock].get('username', 'Unknown')
-                        print(f"   ✓ Sent to {username}")
-                        # Reset failed attempts on success
-                        if sock in self._broadcast_failures:
-                            del self._broadcast_failures[sock]
-                    except (BrokenPipeError, ConnectionResetError, ConnectionAbortedError) as e:
-                        # Critical errors - disconnect immediately
-                        print(f"   ❌ Critical error sending to {self.clients.get(sock, {}).get('username', 'Unknown')}: {e}")
-                        disconnected.append(sock)
-                    except Exception as e:
-                        # Non-critical errors - log but don't disconnect immediately
-                        username = self.clients.get(sock, {}).get('username', 'Unknown')
-                        print(f"   ⚠️ Temporary error sending to {username}: {e}")
-                        
-                        # Track failed attempts
-                        if sock not in self._broadcast_failures:
-                            self._broadcast_failures[sock] = 0
-                        self._broadcast_failures[sock] += 1
-                        
-                        # Only disconnect after multiple consecutive failures (3+)
-                        if self._broadcast_failures[sock] >= 3:
-                            print(f"   ❌ Too many failures for {username} - marking for disconnect")
-                            disconnected.append(sock)
-                            if sock in self._broadcast_failures:
-                                del self._broadcast_failures[sock]
-            
-            print(f"   Total sent: {sent_count}/{total_clients}")
+        data = (message + '\n').encode('utf-8')
+        if self.shard is not None and not local_only:
+            self.shard.publish('broadcast', data)
+        self._deliver_to_all(data, exclude)
+
+    def _deliver_to_all(self, data: bytes, exclude: Optional[socket.socket] = None):
+        """Write pre-encoded bytes to every client connected to this process"""
+        # Iterate a copy-on-write snapshot - no lock is held while sending
+        started = time.perf_counter()
+        clients = self.clients.snapshot()
+        
+        total_clients = len(clients)
+        # Checked once per broadcast, so per-recipient logging costs nothing when off
+        debug = log.isEnabledFor(logging.DEBUG)
+        
+        disconnected = []
+        sent_count = failed = 0
+        
+        for sock, info in clients.items():
+            if sock is exclude:
+                continue
+            username = info.get('username', 'Unknown')
+            try:
+                self._send_raw(sock, data, info)
+                sent_count += 1
+                if debug:
+                    log.debug("Broadcast sent to %s", username)
+                # Reset failed attempts on success
+                self._broadcast_failures.pop(sock, None)
+            except (BrokenPipeError, ConnectionResetError, ConnectionAbortedError) as e:
+                # Critical errors - disconnect immediately
+                failed += 1
+                log.warning("Critical error sending to %s: %s", username, e)
+                disconnected.append(sock)
+            except Exception as e:
+                # Non-critical errors - log but don't disconnect immediately
+                failed += 1
+                log.warning("Temporary error sending to %s: %s", username, e)
+                
+                # Track failed attempts
+                failures = self._broadcast_failures.get(sock, 0) + 1
+                self._broadcast_failures[sock] = failures
+                
+                # Only disconnect after multiple consecutive failures (3+)
+                if failures >= 3:
+                    log.warning("Too many failures for %s - marking for disconnect", username)
+                    disconnected.append(sock)
+                    self._broadcast_failures.pop(sock, None)
+        
+        if debug:
+            log.debug("Broadcast sent to %d/%d clients", sent_count, total_clients)
+        broadcast_seconds.observe(time.perf_counter() - started)
+        broadcast_deliveries.inc(sent_count)
+        if failed:
+            broadcast_failures.inc(failed)
         
-        # Handle disconnections outside the lock to avoid deadlock
         for sock in disconnected:
             username = self.clients.get(sock, {}).get('username', 'Unknown')
             self.handle_disconnect(sock, username)
 
-    def broadcast_user_list(self):
-        """Broadcast current user list to all clients"""
-        with self.lock:
-            # Prepare a base set of non-system users
-            non_system_users = [info['username'] for info in self.clients.values()
-                                if not (info['username'].startswith('_') and info['username'].endswith('_System_'))]
-
-            # Send a tailored list to each client (exclude themselves)
-            for sock, info in list(self.clients.items()):
-                requester = info.get('username')
-                users_for_client = sorted([u for u in non_system_users if u != requester])
-                try:
-                    sock.send((json.dumps({
-                        'type': 'user_list',
-                        'users': users_for_client
-                    }) + '\n').encode('utf-8'))
-                except Exception as e:
-                    print(f"   ❌ Failed to send user list to {requester}: {e}")
-
-    def broadcast_group_list(self):
-        """Broadcast group list to all clients"""
-        with self.lock:
-            groups = [
-                {
-                    'id': gid,
-                    'name': ginfo['name'],
-                    'members': ginfo['members'],
-                    'created_by': ginfo['created_by']
-                }
-                for gid, ginfo in self.groups.items()
-            ]
-        
-        self.broadcast(json.dumps({
-            'type': 'group_list',
-            'groups': groups
-        }))
-
-    def handle_disconnect(self, client_socket: socket.socket, username: Optional[str] = None):
-        """Handle client disconnection"""
-        print(f"[SERVER] Handling disconnect for socket: {client_socket}")
+    def _queue_presence_change(self, event: str, username: str, remote: bool = False):
+        """Record a user_joined/user_left event and schedule a coalesced presence delta"""
+        if username.startswith('_') and username.endswith('_System_'):
+            return
         
-        # First, remove from clients list
-        with self.lock:
-            if client_socket in self.clients:
-                if username is None:
-                    username = self.clients[client_socket]['username']
-                del self.clients[client_socket]
-                print(f"👋 User '{username}' disconnected")
+        # Every shard worker keeps the full session count and sends its own deltas
+        if self.shard is not None and not remote:
+            self.shard.publish('presence', event, username)
+        
+        with self.presence_lock:
+            # Only the first connection in and the last connection out change presence
+            sessions = self.presence_sessions.get(username, 0)
+            if event == 'user_joined':
+                self.presence_sessions[username] = sessions + 1
+                if sessions > 0:
+                    return
             else:
-                print(f"[SERVER] Socket not found in clients list")
+                if sessions == 0:
+                    return
+                if sessions > 1:
+                    self.presence_sessions[username] = sessions - 1
+                    return
+                del self.presence_sessions[username]
+            
+            self.pending_presence.append((event, username))
+            if self.presence_timer is None:
+                self.presence_timer = threading.Timer(self.PRESENCE_COALESCE_WINDOW, self._flush_presence)
+                self.presence_timer.daemon = True
+                self.presence_timer.start()
+
+    def _flush_presence(self):
+        """Send every presence change queued during the window as a single delta"""
+        with self.presence_lock:
+            pending = self.pending_presence
+            self.pending_presence = []
+            self.presence_timer = None
+            
+            # Events for a user alternate, so a join and a leave inside one window cancel out
+            net: Dict[str, str] = {}
+            for event, username in pending:
+                if username in net:
+                    del net[username]
+                else:
+                    net[username] = event
+            if not net:
                 return
-        
-        # Then handle broadcasts outside the lock to avoid deadlock
-        if username and not (username.startswith('_') and username.endswith('_System_')):
-            # Send disconnect message to remaining clients
-            disconnect_msg = {
-                'type': 'system',
-                'sender': 'Server',
-                'content': f"{username} left the chat",
+            
+            prev_version = self.presence_version
+            self.presence_version += 1
+            joined = sorted(u for u, e in net.items() if e == 'user_joined')
+            left = sorted(u for u, e in net.items() if e == 'user_left')
+            
+            delta = {
+                'type': 'presence_delta',
+                'version': self.presence_version,
+                'prev_version': prev_version,
+                'events': [{'type': 'user_joined', 'username': u} for u in joined] +
+                          [{'type': 'user_left', 'username': u} for u in left],
                 'timestamp': self._timestamp()
             }
-            self.broadcast(json.dumps(disconnect_msg))
             
-            # Update user list for all remaining clients
-            print(f"[SERVER] Broadcasting updated user list after {username} disconnect")
-            self.broadcast_user_list()
+            # Take the send lock before releasing presence_lock so deltas reach
+            # clients in version order without blocking connects during the fan-out
+            self.presence_send_lock.acquire()
         
-        print(f"[SERVER] Disconnect handling complete for {username}")
+        try:
+            self.broadcast(json.dumps(delta), local_only=True)
+            for names, action in ((joined, 'joined'), (left, 'left')):
+                if names:
+                    self.broadcast(json.dumps({
+                        'type': 'system',
+                        'sender': 'Server',
+                        'content': f"{self._summarize_names(names)} {action} the chat",
+                        'timestamp': self._timestamp()
+                    }), local_only=True)
+        finally:
+            self.presence_send_lock.release()
+        
+        presence_log.info("Presence v%d: +%d -%d", delta['version'], len(joined), len(left))
+
+    def _summarize_names(self, names: List[str]) -> str:
+        """Format a list of usernames for a system notice"""
+        if len(names) == 1:
+            return names[0]
+        if len(names) <= 3:
+            return f"{', '.join(names[:-1])} and {names[-1]}"
+        return f"{', '.join(names[:2])} and {len(names) - 2} others"
+
+    def handle_disconnect(self, client_socket: socket.socket, username: Optional[str] = None):
+        """Handle client disconnection"""
+        # First, remove from clients list
+        info = self.clients.remove(client_socket)
+        if info is None:
+            log.debug("Disconnect for unknown socket %s", client_socket)
+            return
+        if username is None:
+            username = info['username']
+        self._broadcast_failures.pop(client_socket, None)
+        log.info("User '%s' disconnected", username)
+        
+        # Remaining clients learn about it from the next presence delta
+        if username:
+            self._queue_presence_change('user_left', username)
         
         try:
             client_socket.close()
-            print(f"[SERVER] Closed socket for {username}")
         except Exception as e:
-            print(f"[SERVER] Error closing socket for {username}: {e}")
+            log.warning("Error closing socket for %s: %s", username, e)
+
+    def _send_raw(self, client_socket: socket.socket, data: bytes, info: Optional[Dict[str, Any]] = None):
+        """Write pre-encoded bytes to a client; concurrent writers to one socket are serialized"""
+        if info is None:
+            info = self.clients.get(client_socket)
+        send_lock = info.get('send_lock') if info else None
+        if send_lock is None:
+            # Not registered (handshake or system connection) - only one thread talks to it
+            client_socket.sendall(data)
+            return
+        with send_lock:
+            client_socket.sendall(data)
 
     def _send_to_client(self, client_socket: socket.socket, message: Dict):
         """Send message to a specific client"""
         try:
             message_str = json.dumps(message) + '\n'
-            client_socket.send(message_str.encode('utf-8'))
+            self._send_raw(client_socket, message_str.encode('utf-8'))
         except Exception as e:
             msg_type = message.get('type', 'unknown')
             username = self.clients.get(client_socket, {}).get('username', 'Unknown')
-            print(f"❌ Error sending {msg_type} to {username}: {e}")
+            log.warning("Error sending %s to %s: %s", msg_type, username, e)
 
     def _send_error(self, client_socket: socket.socket, error_message: str):
         """Send error message to client"""
@@ -1883,27 +1774,63 @@ class CollaborationServer:
             'timestamp': self._timestamp()
         })
 
-    def _find_client_socket(self, username: str) -> Optional[socket.socket]:
-        """Find socket for given username"""
-        with self.lock:
-            for sock, info in self.clients.items():
-                if info['username'] == username:
-                    return sock
-        return None
+    def _send_to_users(self, usernames, message: Dict) -> int:
+        """Serialize once and send to every connection of the given users"""
+        data = (json.dumps(message) + '\n').encode('utf-8')
+        if self.shard is not None:
+            usernames = list(usernames)
+            self.shard.publish('users', usernames, data)
+        return self._deliver_to_users(usernames, data)
 
-    def _notify_group_members(self, group_id: str, message: Dict, include_removed: Optional[str] = None):
+    def _deliver_to_users(self, usernames, data: bytes) -> int:
+        """Write pre-encoded bytes to the given users' connections on this process"""
+        sent_count = 0
+        for username in usernames:
+            for sock in self.clients.sockets_for(username):
+                try:
+                    self._send_raw(sock, data)
+                    sent_count += 1
+                except Exception as e:
+                    log.warning("Error sending to %s: %s", username, e)
+        return sent_count
+
+    def _send_to_user(self, username: str, message: Dict) -> bool:
+        """Send to every connection of one user; False if they are not online"""
+        if self._send_to_users((username,), message):
+            return True
+        # Sharded: presence covers users connected to other workers too
+        return username in self.presence_sessions
+
+    def _on_shard_event(self, event: Tuple):
+        """Apply an event relayed from another shard worker (shard reader thread)"""
+        kind = event[0]
+        if kind == 'broadcast':
+            self._deliver_to_all(event[1])
+        elif kind == 'users':
+            self._deliver_to_users(event[1], event[2])
+        elif kind == 'presence':
+            self._queue_presence_change(event[1], event[2], remote=True)
+        elif kind == 'group':
+            group_id, group = event[1], event[2]
+            with self.groups_lock:
+                if group is None:
+                    self.groups.pop(group_id, None)
+                else:
+                    self.groups[group_id] = group
+                self.groups_version = max(self.groups_version, self.shard.groups_version())
+
+    def _notify_group_members(self, group_id: str, message: Dict, include_removed: Optional[str] = None) -> int:
         """Send notification to all group members"""
-        if group_id not in self.groups:
-            return
+        group = self.groups.get(group_id)
+        if group is None:
+            return 0
         
-        members = set(self.groups[group_id]['members'])
+        # Member lists are replaced on change, so this reference is a stable snapshot
+        members = set(group['members'])
         if include_removed:
             members.add(include_removed)
         
-        with self.lock:
-            for sock, info in self.clients.items():
-                if info['username'] in members:
-                    self._send_to_client(sock, message)
+        return self._send_to_users(members, message)
 
     def _validate_group_operation(self, client_socket: socket.socket, group_id: str, 
                                    username: str, require_membership: bool = False) -> bool:
@@ -1937,17 +1864,17 @@ class CollaborationServer:
         chat_target = message.get('chat_target')
         sender = message.get('sender')
         
-        print(f"🗑️ Delete message request from {sender}: {message_id} in {chat_type}")
+        log.info("Delete message request from %s: %s in %s", sender, message_id, chat_type)
         
         success = False
         
         # Delete from storage based on chat type
         if chat_type == 'global':
-            success = storage.delete_global_message(message_id)
+            success = self.storage.delete_global_message(message_id)
         elif chat_type == 'private' and chat_target:
-            success = storage.delete_private_message(sender, chat_target, message_id)
+            success = self.storage.delete_private_message(sender, chat_target, message_id)
         elif chat_type == 'group' and chat_target:
-            success = storage.delete_group_message(chat_target, message_id)
+            success = self.storage.delete_group_message(chat_target, message_id)
         
         if success:
             # Broadcast delete notification to all relevant clients
@@ -1964,37 +1891,31 @@ class CollaborationServer:
                 self.broadcast(json.dumps(delete_notification))
             elif chat_type == 'private' and chat_target:
                 # Send to both sender and receiver
-                receiver_socket = self._find_client_socket(chat_target)
-                if receiver_socket:
-                    self._send_to_client(receiver_socket, delete_notification)
+                self._send_to_user(chat_target, delete_notification)
                 self._send_to_client(client_socket, delete_notification)
             elif chat_type == 'group' and chat_target:
                 # Send to all group members
-                if chat_target in self.groups:
-                    with self.lock:
-                        for sock, info in self.clients.items():
-                            if info['username'] in self.groups[chat_target]['members']:
-                                self._send_to_client(sock, delete_notification)
+                self._notify_group_members(chat_target, delete_notification)
             
-            print(f"   ✓ Message deleted successfully")
+            log.debug("Message %s deleted", message_id)
         else:
-            print(f"   ❌ Failed to delete message")
+            log.warning("Failed to delete message %s", message_id)
 
     def _handle_delete_user_chat(self, client_socket: socket.socket, message: Dict):
         """Handle request to delete entire private chat with a user"""
         sender = message.get('sender')
         target_user = message.get('target_user')
         
-        print(f"🗑️ Delete user chat request from {sender} for user {target_user}")
+        log.info("Delete user chat request from %s for user %s", sender, target_user)
         
         if not target_user or not sender:
-            print(f"   ❌ Missing sender or target_user")
+            log.warning("Delete user chat request is missing sender or target_user")
             return
         
         # Delete the private chat from storage
         # Create chat key in the format used by storage
         chat_key = f"{sender}_{target_user}"
-        success = storage.delete_private_chat(chat_key)
+        success = self.storage.delete_private_chat(chat_key)
         
         if success:
             # Notify the requesting client that chat was deleted
@@ -2005,7 +1926,7 @@ class CollaborationServer:
                 'timestamp': self._timestamp()
             }
             self._send_to_client(client_socket, response)
-            print(f"   ✓ Chat with {target_user} deleted for {sender}")
+            log.debug("Chat with %s deleted for %s", target_user, sender)
         else:
             # Send failure response
             response = {
@@ -2015,17 +1936,18 @@ class CollaborationServer:
                 'timestamp': self._timestamp()
             }
             self._send_to_client(client_socket, response)
-            print(f"   ❌ Failed to delete chat with {target_user}")
+            log.warning("Failed to delete chat with %s for %s", target_user, sender)
 
     def cleanup(self):
         """Clean up server resources"""
-        with self.lock:
-            for client_socket in list(self.clients.keys()):
-                try:
-                    client_socket.close()
-                except:
-                    pass
-            self.clients.clear()
+        self.dispatcher.stop()
+        if self.file_service is not None:
+            self.file_service.stop()
+        for client_socket in self.clients.clear():
+            try:
+                client_socket.close()
+            except:
+                pass
         
         try:
             self.server_socket.close()
@@ -2039,7 +1961,7 @@ class CollaborationServer:
 
     def shutdown(self):
         """Gracefully shutdown the server"""
-        print("\n🛑 Shutting down server...")
+        log.info("Shutting down server...")
         self.running = False
         
         shutdown_msg = {
@@ -2048,10 +1970,10 @@ class CollaborationServer:
             'content': 'Server is shutting down',
             'timestamp': self._timestamp()
         }
-        self.broadcast(json.dumps(shutdown_msg))
+        self.broadcast(json.dumps(shutdown_msg), local_only=True)
         
         self.cleanup()
-        print("✅ Server stopped successfully")
+        log.info("Server stopped")
 
 
 def signal_handler(sig, frame):
@@ -2069,7 +1991,7 @@ if __name__ == "__main__":
     print("="*60)
     print("Press Ctrl+C to stop the server\n")
     
-    server = CollaborationServer()
+    server = CollaborationServer(metrics_port=default_admin_port())
     try:
         server.start()
     except KeyboardInterrupt:
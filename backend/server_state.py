@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+server_state.py - Independently synchronized pieces of CollaborationServer state
+Each component owns its own lock so handler threads only contend when they
+touch the same thing, and no component lock is ever held while sending
+"""
+
+import socket
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterator, List, Optional, Tuple
+
+from backend.dispatch import TimedLock
+
+
+class ConnectionRegistry:
+    """Connected clients, published copy-on-write.
+
+    Writers copy the dict under a lock and swap the reference in, so every
+    reader (broadcasts, lookups, group fan-outs) iterates a stable snapshot
+    without taking any lock. Connects and disconnects are rare compared to
+    messages, which makes the copy cheap overall.
+    """
+
+    def __init__(self):
+        self._write_lock = TimedLock('clients')
+        self._clients: Dict[socket.socket, Dict[str, Any]] = {}
+        self._by_username: Dict[str, Tuple[socket.socket, ...]] = {}
+
+    def add(self, sock: socket.socket, info: Dict[str, Any]) -> None:
+        """Register a connection; info gets a per-socket send lock"""
+        info.setdefault('send_lock', TimedLock('send'))
+        with self._write_lock:
+            clients = dict(self._clients)
+            clients[sock] = info
+            by_username = dict(self._by_username)
+            by_username[info['username']] = by_username.get(info['username'], ()) + (sock,)
+            self._clients, self._by_username = clients, by_username
+
+    def remove(self, sock: socket.socket) -> Optional[Dict[str, Any]]:
+        """Unregister a connection and return its info (None if unknown)"""
+        with self._write_lock:
+            if sock not in self._clients:
+                return None
+            clients = dict(self._clients)
+            info = clients.pop(sock)
+            by_username = dict(self._by_username)
+            remaining = tuple(s for s in by_username.get(info['username'], ()) if s is not sock)
+            if remaining:
+                by_username[info['username']] = remaining
+            else:
+                by_username.pop(info['username'], None)
+            self._clients, self._by_username = clients, by_username
+            return info
+
+    def clear(self) -> List[socket.socket]:
+        """Drop every connection and return the sockets that were registered"""
+        with self._write_lock:
+            sockets = list(self._clients)
+            self._clients, self._by_username = {}, {}
+            return sockets
+
+    def snapshot(self) -> Dict[socket.socket, Dict[str, Any]]:
+        """Current clients; the returned dict is never mutated afterwards"""
+        return self._clients
+
+    def sockets_for(self, username: str) -> Tuple[socket.socket, ...]:
+        """All open connections for a username"""
+        return self._by_username.get(username, ())
+
+    # Read-only mapping interface over the current snapshot
+    def get(self, sock: socket.socket, default: Any = None) -> Any:
+        return self._clients.get(sock, default)
+
+    def __getitem__(self, sock: socket.socket) -> Dict[str, Any]:
+        return self._clients[sock]
+
+    def __contains__(self, sock: object) -> bool:
+        return sock in self._clients
+
+    def __len__(self) -> int:
+        return len(self._clients)
+
+    def __iter__(self) -> Iterator[socket.socket]:
+        return iter(self._clients)
+
+    def items(self):
+        return self._clients.items()
+
+    def keys(self):
+        return self._clients.keys()
+
+    def values(self):
+        return self._clients.values()
+
+
+class RecentChats:
+    """Per-user most-recent conversation partners"""
+
+    def __init__(self, limit: int = 5):
+        self.limit = limit
+        self._lock = TimedLock('recent_chats')
+        self._chats: Dict[str, List[str]] = {}
+
+    def ensure(self, username: str) -> None:
+        """Make sure a user has a (possibly empty) list"""
+        with self._lock:
+            self._chats.setdefault(username, [])
+
+    def add(self, owner: str, other: str) -> None:
+        """Put other at the front of owner's list unless it is already there"""
+        with self._lock:
+            chats = self._chats.setdefault(owner, [])
+            if other not in chats:
+                chats.insert(0, other)
+                del chats[self.limit:]
+
+    def promote(self, owner: str, other: str) -> None:
+        """Move other to the front of owner's list (known users only)"""
+        with self._lock:
+            chats = self._chats.get(owner)
+            if chats is None:
+                return
+            if other in chats:
+                chats.remove(other)
+            chats.insert(0, other)
+            del chats[self.limit:]
+
+    def get(self, username: str) -> List[str]:
+        """Copy of a user's recent chats"""
+        with self._lock:
+            return list(self._chats.get(username, []))
+
+    def __contains__(self, username: object) -> bool:
+        return username in self._chats
+
+
+class HistoryCache:
+    """Serialized history responses, checked against the conversation's version.
+
+    Entries are keyed by the request (the response shape depends on who asked)
+    and hold the storage version they were built from; a lookup with any other
+    version is a miss. Least recently used pages go first once either bound is
+    reached, and a page bigger than a quarter of max_bytes is never kept.
+    """
+
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 64 << 20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = TimedLock('history_cache')
+        self._entries: 'OrderedDict[Hashable, Tuple[Any, bytes]]' = OrderedDict()
+        self.bytes = 0
+
+    def get(self, key: Hashable, version: Any) -> Optional[bytes]:
+        """The cached page if it was built from this version"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key: Hashable, version: Any, data: bytes) -> None:
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old[1])
+            if len(data) > self.max_bytes // 4:
+                return
+            self._entries[key] = (version, data)
+            self.bytes += len(data)
+            while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.bytes -= len(evicted)
+
+    def __len__(self) -> int:
+        return len(self._entries)
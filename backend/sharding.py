@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+"""
+sharding.py - Run the chat server as several worker processes
+A coordinator process owns storage and the file port; chat workers share the
+chat port and reach the coordinator over a local multiprocessing connection
+(Unix socket / named pipe) that carries storage calls and cross-worker events
+"""
+
+import itertools
+import multiprocessing
+import os
+import queue
+import socket
+import threading
+import time
+from multiprocessing.connection import Client, Connection, Listener
+from multiprocessing.reduction import ForkingPickler
+from typing import Any, Dict, List, Optional, Tuple
+
+from backend.logger import get_logger
+from backend.metrics import registry
+
+log = get_logger('shard')
+
+# Storage calls that change a group; the coordinator mirrors the result to other workers
+GROUP_MUTATIONS = {'add_group', 'update_group', 'remove_group'}
+WORKER_START_TIMEOUT = 60.0  # seconds for a worker to import, bind and connect back
+
+
+def create_chat_socket(host: str, port: int, reuse_port: bool) -> socket.socket:
+    """Bind and listen on the chat port, optionally with SO_REUSEPORT"""
+    from backend.server import CollaborationServer
+
+    sock = CollaborationServer._create_socket()
+    if reuse_port:
+        # Each worker binds its own socket and the kernel spreads connections
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(128)
+    return sock
+
+
+class RemoteStorage:
+    """Stand-in for backend.storage.storage that runs every method in the coordinator"""
+
+    def __init__(self, link: 'ShardLink'):
+        self._link = link
+
+    def __getattr__(self, name: str):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            return self._link.call(name, args, kwargs)
+        call.__name__ = name
+        return call
+
+
+class ShardLink:
+    """Worker side of the coordinator connection.
+
+    Storage calls block until the coordinator replies. Everything else it
+    sends is an event for the server (deliveries, presence, group changes),
+    applied in arrival order on its own thread - so a handler waiting on a
+    reply while holding a server lock never blocks the reply itself.
+    """
+
+    def __init__(self, address: Any, authkey: bytes, groups_counter):
+        self.conn = Client(address, authkey=authkey)
+        self.send_lock = threading.Lock()
+        self.groups_counter = groups_counter
+        self.storage = RemoteStorage(self)
+        self.server = None
+
+        self._ids = itertools.count(1)
+        self._waiters: Dict[int, list] = {}  # request id -> [Event, result, error]
+        self._waiters_lock = threading.Lock()
+        # Events queue up until the server has finished loading
+        self._events: queue.Queue = queue.Queue()
+        self._attached = threading.Event()
+        registry.gauge('shard_event_queue', "Coordinator events waiting to be applied", fn=self._events.qsize)
+        self.calls = registry.histogram('shard_call_seconds', "Round trip of one storage call to the coordinator")
+
+        threading.Thread(target=self._read_loop, daemon=True).start()
+        threading.Thread(target=self._event_loop, daemon=True).start()
+
+    def attach(self, server) -> None:
+        """Start delivering events to server, including any that arrived early"""
+        self.server = server
+        self._attached.set()
+
+    def call(self, method: str, args: tuple, kwargs: dict) -> Any:
+        """Run a storage method in the coordinator and return its result"""
+        waiter = [threading.Event(), None, None]
+        with self._waiters_lock:
+            req_id = next(self._ids)
+            self._waiters[req_id] = waiter
+        started = time.perf_counter()
+        self._send(('call', req_id, method, args, kwargs))
+        waiter[0].wait()
+        self.calls.observe(time.perf_counter() - started)
+        if waiter[2] is not None:
+            raise waiter[2]
+        return waiter[1]
+
+    def publish(self, *event) -> None:
+        """Hand an event to the coordinator for the other workers"""
+        try:
+            self._send(('publish', event))
+        except (OSError, ValueError):
+            pass  # Coordinator is gone; _read_loop has already stopped the server
+
+    def next_groups_version(self) -> int:
+        with self.groups_counter.get_lock():
+            self.groups_counter.value += 1
+            return self.groups_counter.value
+
+    def groups_version(self) -> int:
+        return self.groups_counter.value
+
+    def _send(self, message: Tuple) -> None:
+        with self.send_lock:
+            self.conn.send(message)
+
+    def _read_loop(self):
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                break
+
+            if message[0] == 'reply':
+                _, req_id, result, error = message
+                with self._waiters_lock:
+                    waiter = self._waiters.pop(req_id, None)
+                if waiter is not None:
+                    waiter[1], waiter[2] = result, error
+                    waiter[0].set()
+                continue
+
+            self._events.put(message)
+
+        # Without the coordinator there is no storage - stop this worker
+        log.error("Lost connection to coordinator (pid %d)", os.getpid())
+        with self._waiters_lock:
+            waiters, self._waiters = self._waiters, {}
+        for waiter in waiters.values():
+            waiter[2] = ConnectionError("Shard coordinator is gone")
+            waiter[0].set()
+        if self.server is not None:
+            self.server.running = False
+
+    def _event_loop(self):
+        self._attached.wait()
+        while True:
+            event = self._events.get()
+            try:
+                self.server._on_shard_event(event)
+            except Exception as e:
+                log.error("Error applying %s event: %s", event[0], e)
+
+
+class WorkerLink:
+    """Coordinator side of one worker connection"""
+
+    def __init__(self, index: int, conn: Connection):
+        self.index = index
+        self.conn = conn
+        self.send_lock = threading.Lock()
+        self.sessions: Dict[str, int] = {}  # username -> connections on this worker
+
+    def send_bytes(self, payload: bytes) -> None:
+        try:
+            with self.send_lock:
+                self.conn.send_bytes(payload)
+        except (OSError, ValueError) as e:
+            log.warning("Could not reach worker %d: %s", self.index, e)
+
+
+def run_worker(index: int, host: str, port: int, listen_socket: Optional[socket.socket],
+               address: Any, authkey: bytes, groups_counter, metrics_port: Optional[int] = None):
+    """Process entry point for one chat worker; it serves metrics on metrics_port, if given"""
+    from backend.server import CollaborationServer
+
+    if listen_socket is None:
+        listen_socket = create_chat_socket(host, port, reuse_port=True)
+
+    link = ShardLink(address, authkey, groups_counter)
+    server = CollaborationServer(host, port, file_port=None, shard=link, listen_socket=listen_socket,
+                                 metrics_port=metrics_port)
+    log.info("Chat worker %d ready (pid %d)", index, os.getpid())
+    server.start()
+
+
+class ShardCoordinator:
+    """Owns storage and the file port, and relays events between chat workers.
+
+    Storage calls from all workers are applied one at a time, exactly as the
+    single-process server does. Deliveries for specific users are only
+    forwarded to the workers those users are connected to.
+    """
+
+    def __init__(self, workers: int, host: str = '0.0.0.0', port: int = 5555, file_port: int = 5556,
+                 metrics_port: Optional[int] = None):
+        from backend.storage import storage
+
+        self.workers = workers
+        self.host = host
+        self.port = port
+        self.file_port = file_port
+        # Every process has its own registry: the coordinator serves metrics_port,
+        # worker i serves metrics_port + 1 + i
+        self.metrics_port = metrics_port
+        self.running = True
+
+        self.storage = storage
+        self.storage_lock = threading.Lock()
+
+        # Default family is a Unix socket on POSIX and a named pipe on Windows
+        self.authkey = os.urandom(16)
+        self.listener = Listener(authkey=self.authkey)
+        initial_version = max((g.get('version', 0) for g in storage.get_groups().values()), default=0)
+        self.groups_counter = multiprocessing.Value('q', initial_version)
+
+        # Published copy-on-write, like ConnectionRegistry
+        self.links: Tuple[WorkerLink, ...] = ()
+        self.presence_lock = threading.Lock()
+        self.processes: List[multiprocessing.Process] = []
+        self.file_server = None
+
+    def run(self):
+        """Start the workers and the file server, then block until stopped"""
+        from backend.server import CollaborationServer
+
+        reuse_port = hasattr(socket, 'SO_REUSEPORT')
+        # Without SO_REUSEPORT every worker accepts from one inherited socket
+        listen_socket = None if reuse_port else create_chat_socket(self.host, self.port, reuse_port=False)
+        mode = "SO_REUSEPORT" if reuse_port else "shared listening socket"
+        log.info("Starting %d chat workers on %s:%s (%s)", self.workers, self.host, self.port, mode)
+
+        for index in range(self.workers):
+            worker_metrics = self.metrics_port + 1 + index if self.metrics_port is not None else None
+            process = multiprocessing.Process(
+                target=run_worker,
+                args=(index, self.host, self.port, listen_socket,
+                      self.listener.address, self.authkey, self.groups_counter, worker_metrics),
+                name=f"chat-worker-{index}",
+                daemon=True
+            )
+            process.start()
+            self.processes.append(process)
+            conn = self._accept_worker(process)
+            if conn is None:
+                self.shutdown()
+                return
+            self._register(WorkerLink(index, conn))
+
+        # File transfers and their bytes stay in this process, next to storage
+        self.file_server = CollaborationServer(self.host, self.port, self.file_port,
+                                               metrics_port=self.metrics_port)
+        self.file_server.serve_files()
+        self.file_server.serve_metrics()
+
+        try:
+            while self.running and any(p.is_alive() for p in self.processes):
+                time.sleep(1.0)
+        finally:
+            self.shutdown()
+
+    def _accept_worker(self, process: multiprocessing.Process) -> Optional[Connection]:
+        """The new worker's link, or None if it died or never connected back"""
+        accepted: List[Any] = []
+
+        def accept():
+            try:
+                accepted.append(self.listener.accept())
+            except Exception as e:
+                accepted.append(e)
+
+        # Listener.accept has no timeout (and may be a named pipe), so wait for it on a thread
+        threading.Thread(target=accept, daemon=True, name='shard-accept').start()
+        deadline = time.monotonic() + WORKER_START_TIMEOUT
+        while not accepted:
+            if not process.is_alive():
+                log.error("Chat worker %s exited with code %s before connecting", process.name, process.exitcode)
+                return None
+            if time.monotonic() > deadline:
+                log.error("Chat worker %s did not connect within %.0f s", process.name, WORKER_START_TIMEOUT)
+                return None
+            time.sleep(0.05)
+        if isinstance(accepted[0], Exception):
+            log.error("Accepting chat worker %s failed: %s", process.name, accepted[0])
+            return None
+        return accepted[0]
+
+    def shutdown(self):
+        """Stop every worker and the file server"""
+        self.running = False
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            process.join(timeout=5)
+        if self.file_server is not None:
+            self.file_server.running = False
+            self.file_server.cleanup()
+        self.listener.close()
+        log.info("Chat workers stopped")
+
+    def _register(self, link: WorkerLink):
+        """Bring a new worker up to date on presence and start relaying for it"""
+        with self.presence_lock:
+            for other in self.links:
+                for username, count in other.sessions.items():
+                    for _ in range(count):
+                        link.send_bytes(ForkingPickler.dumps(('presence', 'user_joined', username)))
+            self.links = self.links + (link,)
+        threading.Thread(target=self._serve, args=(link,), daemon=True,
+                         name=f"shard-link-{link.index}").start()
+
+    def _serve(self, link: WorkerLink):
+        """Handle storage calls and published events from one worker"""
+        while self.running:
+            try:
+                message = link.conn.recv()
+            except (EOFError, OSError):
+                break
+
+            if message[0] == 'call':
+                self._handle_call(link, *message[1:])
+            elif message[0] == 'publish':
+                self._relay(link, message[1])
+
+        if self.running:
+            log.warning("Worker %d disconnected", link.index)
+        # Whoever was connected there is gone for everyone else
+        with self.presence_lock:
+            self.links = tuple(l for l in self.links if l is not link)
+            sessions, link.sessions = link.sessions, {}
+        for username, count in sessions.items():
+            for _ in range(count):
+                self._send_to_others(link, ('presence', 'user_left', username))
+
+    def _handle_call(self, link: WorkerLink, req_id: int, method: str, args: tuple, kwargs: dict):
+        target = getattr(self.storage, method, None) if not method.startswith('_') else None
+        sync = None
+        with self.storage_lock:
+            try:
+                if target is None:
+                    raise AttributeError(f"Storage has no method {method!r}")
+                result = target(*args, **kwargs)
+                # Pickle while holding the lock - results can be live storage objects
+                reply = ForkingPickler.dumps(('reply', req_id, result, None))
+                if method in GROUP_MUTATIONS:
+                    group_id = args[0] if args else kwargs.get('group_id')
+                    sync = ('group', group_id, self.storage.groups.get(group_id))
+            except Exception as e:
+                reply = ForkingPickler.dumps(('reply', req_id, None, e))
+
+            # Other workers see group changes before the caller moves on, and in storage order
+            if sync is not None:
+                self._send_to_others(link, sync)
+        link.send_bytes(reply)
+
+    def _relay(self, origin: WorkerLink, event: Tuple):
+        kind = event[0]
+        if kind == 'presence':
+            with self.presence_lock:
+                _, action, username = event
+                count = origin.sessions.get(username, 0) + (1 if action == 'user_joined' else -1)
+                if count > 0:
+                    origin.sessions[username] = count
+                else:
+                    origin.sessions.pop(username, None)
+                self._send_to_others(origin, event)
+        elif kind == 'users':
+            usernames = event[1]
+            payload = ForkingPickler.dumps(event)
+            for link in self.links:
+                if link is not origin and any(u in link.sessions for u in usernames):
+                    link.send_bytes(payload)
+        else:
+            self._send_to_others(origin, event)
+
+    def _send_to_others(self, origin: WorkerLink, event: Tuple):
+        payload = ForkingPickler.dumps(event)
+        for link in self.links:
+            if link is not origin:
+                link.send_bytes(payload)
@@ -25,6 +25,12 @@ class Storage:
         self.file_metadata: Dict[str, Dict] = {}
         self.users: Dict[str, Dict] = {}
         
+        # Bumped after every change to a conversation, so the server can tell
+        # whether a cached history page is current with one lookup. clear_all
+        # bumps the epoch, which covers every conversation at once
+        self.history_versions: Dict[Tuple, int] = {}
+        self.history_epoch = 0
+        
         # Load existing data on startup
         self.load_all()
         print("Storage initialized with persistence")
@@ -35,10 +41,21 @@ class Storage:
             os.makedirs(self.data_dir)
             print(f"Created directory: {self.data_dir}")
 
+    # ===== HISTORY VERSIONS =====
+    def history_version(self, *conversation) -> Tuple[int, int]:
+        """Version of ('global',), ('private', user1, user2) or ('group', group_id)"""
+        if conversation[0] == 'private':
+            conversation = ('private',) + tuple(sorted(conversation[1:]))
+        return self.history_epoch, self.history_versions.get(conversation, 0)
+
+    def _touch(self, *conversation) -> None:
+        self.history_versions[conversation] = self.history_versions.get(conversation, 0) + 1
+
     # ===== GLOBAL CHAT =====
     def add_global_message(self, message: Dict[str, Any]) -> None:
         """Add global message and persist"""
         self.global_chat.append(message)
+        self._touch('global')
         self.save_global_chat()
 
     def get_global_chat(self, limit: int = 100) -> List[Dict]:
@@ -64,6 +81,7 @@ class Storage:
             if deterministic_id == message_id or msg.get('id') == message_id or msg.get('timestamp') == message_id:
                 self.global_chat[i]['content'] = '🚫 This message was deleted'
                 self.global_chat[i]['deleted'] = True
+                self._touch('global')
                 self.save_global_chat()
                 return True
         return False
@@ -96,6 +114,7 @@ class Storage:
         if key not in self.private_chats:
             self.private_chats[key] = []
         self.private_chats[key].append(message)
+        self._touch('private', *key)
         self.save_private_chats()
 
     def get_private_chat(self, user1: str, user2: str, limit: int = 100) -> List[Dict]:
@@ -104,6 +123,18 @@ class Storage:
         messages = self.private_chats.get(key, [])
         return messages[-limit:]
 
+    def get_private_partners(self, username: str) -> List[str]:
+        """Get every user that has a private chat with username"""
+        partners = []
+        for key in self.private_chats:
+            if len(key) != 2:
+                continue
+            if key[0] == username:
+                partners.append(key[1])
+            elif key[1] == username:
+                partners.append(key[0])
+        return partners
+
     def delete_private_message(self, user1: str, user2: str, message_id: str) -> bool:
         """Delete a message from private chat by ID"""
         import re
@@ -121,6 +152,7 @@ class Storage:
                 if deterministic_id == message_id or msg.get('id') == message_id or msg.get('timestamp') == message_id:
                     self.private_chats[key][i]['content'] = '🚫 This message was deleted'
                     self.private_chats[key][i]['deleted'] = True
+                    self._touch('private', *key)
                     self.save_private_chats()
                     return True
         return False
@@ -140,6 +172,7 @@ class Storage:
                     for k in list(self.private_chats.keys()):
                         if chat_key in k:
                             del self.private_chats[k]
+                            self._touch('private', *k)
                             self.save_private_chats()
                             print(f"✅ Deleted private chat: {k}")
                             return True
@@ -149,6 +182,7 @@ class Storage:
                 for k in list(self.private_chats.keys()):
                     if chat_key in k:
                         del self.private_chats[k]
+                        self._touch('private', *k)
                         self.save_private_chats()
                         print(f"✅ Deleted private chat: {k}")
                         return True
@@ -157,6 +191,7 @@ class Storage:
             # Delete the chat if key exists
             if key in self.private_chats:
                 del self.private_chats[key]
+                self._touch('private', *key)
                 self.save_private_chats()
                 print(f"✅ Deleted private chat: {key}")
                 return True
@@ -200,6 +235,7 @@ class Storage:
         if group_id not in self.group_chats:
             self.group_chats[group_id] = []
         self.group_chats[group_id].append(message)
+        self._touch('group', group_id)
         self.save_group_chats()
 
     def get_group_chat(self, group_id: str, limit: int = 100) -> List[Dict]:
@@ -223,6 +259,7 @@ class Storage:
                 if deterministic_id == message_id or msg.get('id') == message_id or msg.get('timestamp') == message_id:
                     self.group_chats[group_id][i]['content'] = '🚫 This message was deleted'
                     self.group_chats[group_id][i]['deleted'] = True
+                    self._touch('group', group_id)
                     self.save_group_chats()
                     return True
         return False
@@ -268,6 +305,7 @@ class Storage:
             # Also remove group chat history when group is deleted
             if group_id in self.group_chats:
                 del self.group_chats[group_id]
+                self._touch('group', group_id)
                 self.save_group_chats()
             self.save_groups()
             return True
@@ -342,6 +380,10 @@ class Storage:
         }
         self.save_users()
 
+    def get_user(self, username: str) -> Dict:
+        """Get specific user info"""
+        return self.users.get(username, {})
+
     def get_users(self) -> Dict[str, Dict]:
         """Get all users"""
         return self.users
@@ -387,6 +429,7 @@ class Storage:
         self.group_chats = {}
         self.file_metadata = {}
         self.users = {}
+        self.history_epoch += 1
         
         for filename in ['global_chat.json', 'private_chats.json', 'groups.json', 'group_chats.json', 'files.json', 'users.json']:
             try:
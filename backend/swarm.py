@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+"""
+swarm.py - Peer-assisted distribution of large files on the LAN
+The server cuts a shared file into fixed-size pieces and publishes a manifest
+of their SHA-256 hashes. Clients that hold pieces announce them to the server
+and serve them to each other, so a popular file leaves the server's NIC a few
+times instead of once per downloader. Every piece is checked against the
+server's manifest; anything missing, slow or corrupt comes from the server.
+
+Everything goes over the file port, in its usual shape (a JSON header, then
+a reply):
+    {"swarm": "manifest", "file_id": ..., "port": p}          -> manifest + peers
+    {"swarm": "have", "file_id": ..., "port": p, "pieces": [...] or "all"}
+    {"file_id": ..., "piece": i}   -> an ordinary download of piece i only
+Peers answer piece requests exactly like the server does.
+"""
+
+import collections
+import hashlib
+import json
+import os
+import random
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from backend.logger import get_logger
+from backend.metrics import registry
+
+log = get_logger('swarm')
+
+PIECE_SIZE = 1 << 20
+SWARM_MIN_SIZE = 8 << 20  # Smaller files are cheaper to fetch whole from the server
+PEER_TTL = 600.0  # seconds an announcement stays valid without a refresh
+MAX_PEERS = 16  # Peers handed out per manifest request
+ANNOUNCE_EVERY = 8  # pieces between "have" updates while downloading
+PEER_TIMEOUT = 5.0
+HOLD_BYTES = 1 << 30  # Most file bytes a client keeps in memory for other peers
+
+manifests_served = registry.counter('swarm_manifests', "Swarm manifests handed to clients")
+announcements = registry.counter('swarm_announcements', "Piece announcements received from peers")
+pieces_fetched = registry.counter('swarm_pieces', "Pieces fetched by this process, by source and result",
+                                  labels=('source', 'result'))
+
+
+def swarm_enabled(default: bool) -> bool:
+    """SHADOW_NEXUS_SWARM from the environment (1/on/0/off), else default"""
+    value = os.environ.get('SHADOW_NEXUS_SWARM', '').strip().lower()
+    if value in ('1', 'on', 'true', 'yes'):
+        return True
+    if value in ('0', 'off', 'false', 'no'):
+        return False
+    return default
+
+
+def piece_range(size: int, index: int, piece_size: int = PIECE_SIZE) -> Optional[Tuple[int, int]]:
+    """(offset, length) of piece `index`, or None if the file has no such piece"""
+    offset = index * piece_size
+    if index < 0 or offset >= size:
+        return None
+    return offset, min(piece_size, size - offset)
+
+
+def build_manifest(file_id: str, data: Any, piece_size: int = PIECE_SIZE) -> Dict[str, Any]:
+    view = memoryview(data)
+    return {
+        'file_id': file_id,
+        'size': len(view),
+        'piece_size': piece_size,
+        'hashes': [hashlib.sha256(view[offset:offset + piece_size]).hexdigest()
+                   for offset in range(0, len(view), piece_size)],
+    }
+
+
+# ----- server side -----
+
+class SwarmTracker:
+    """Manifests and who holds which pieces, for the file service"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._manifests: Dict[str, Dict[str, Any]] = {}
+        # file_id -> (host, port) -> [username, pieces (None = all), last seen]
+        self._peers: Dict[str, Dict[Tuple[str, int], list]] = {}
+        registry.gauge('swarm_peers', "Peer announcements currently held",
+                       fn=lambda: sum(len(p) for p in self._peers.values()))
+
+    def manifest(self, file_id: str, data: Any) -> Dict[str, Any]:
+        """Manifest for a file, hashed on first request"""
+        with self._lock:
+            cached = self._manifests.get(file_id)
+        if cached is not None and cached['size'] == len(data):
+            return cached
+        # Hash outside the lock; two first requests at once just both hash
+        manifest = build_manifest(file_id, data)
+        with self._lock:
+            self._manifests[file_id] = manifest
+        return manifest
+
+    def announce(self, file_id: str, host: str, port: int, username: str, pieces: Any) -> None:
+        have = None if pieces == 'all' else {int(p) for p in pieces}
+        with self._lock:
+            self._peers.setdefault(file_id, {})[(host, int(port))] = [username, have, time.monotonic()]
+
+    def peers(self, file_id: str, exclude: Tuple[str, int]) -> List[Dict[str, Any]]:
+        """A random sample of live peers for a file, without the asker's own piece server"""
+        now = time.monotonic()
+        with self._lock:
+            holders = self._peers.get(file_id, {})
+            for address in [a for a, entry in holders.items() if now - entry[2] > PEER_TTL]:
+                del holders[address]
+            live = [(address, entry) for address, entry in holders.items() if address != exclude]
+        random.shuffle(live)
+        return [{'host': host, 'port': port, 'user': entry[0],
+                 'pieces': 'all' if entry[1] is None else sorted(entry[1])}
+                for (host, port), entry in live[:MAX_PEERS]]
+
+    @staticmethod
+    def _port(value: Any) -> Optional[int]:
+        if isinstance(value, int) and not isinstance(value, bool) and 0 < value < 65536:
+            return value
+        return None
+
+    def handle(self, sock: socket.socket, address: Tuple, request: Dict, data: Any, file_name: str) -> str:
+        """Answer one swarm control request on a blocking socket; returns the transfer result"""
+        file_id = request.get('file_id')
+        if data is None:
+            _send_json(sock, {'status': 'error', 'message': 'File not found'})
+            return 'error'
+
+        if request['swarm'] == 'manifest':
+            if len(data) < SWARM_MIN_SIZE:
+                _send_json(sock, {'status': 'error', 'message': 'File too small for swarm download'})
+                return 'small'
+            reply = dict(self.manifest(file_id, data), status='ok', file_name=file_name,
+                         peers=self.peers(file_id, (address[0], self._port(request.get('port')) or 0)))
+            _send_json(sock, reply)
+            manifests_served.inc()
+            return 'ok'
+
+        if request['swarm'] == 'have':
+            port, pieces = self._port(request.get('port')), request.get('pieces', ())
+            if port is None or not (pieces == 'all' or isinstance(pieces, list) and all(
+                    isinstance(p, int) and not isinstance(p, bool) for p in pieces)):
+                _send_json(sock, {'status': 'error', 'message': 'Invalid announcement'})
+                return 'error'
+            self.announce(file_id, address[0], port, str(request.get('peer', '')), pieces)
+            announcements.inc()
+            _send_json(sock, {'status': 'ok'})
+            return 'ok'
+
+        _send_json(sock, {'status': 'error', 'message': 'Unknown swarm request'})
+        return 'error'
+
+
+def _send_json(sock: socket.socket, message: Dict) -> None:
+    sock.sendall(json.dumps(message).encode('utf-8'))
+
+
+def _recv_json(sock: socket.socket, limit: int = 1 << 24) -> Dict:
+    """Read one JSON reply that the other side ends by closing or by pausing for us"""
+    buffer = bytearray()
+    while len(buffer) < limit:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        buffer += chunk
+        try:
+            return json.loads(buffer.decode('utf-8'))
+        except (UnicodeDecodeError, ValueError):
+            continue  # Reply split across packets
+    return json.loads(buffer.decode('utf-8'))
+
+
+# ----- client side -----
+
+def fetch_piece(host: str, port: int, file_id: str, index: int, length: int, requester: str,
+                timeout: float = PEER_TIMEOUT) -> bytes:
+    """Download one piece from the server or a peer (same protocol for both)"""
+    with socket.create_connection((host, port), timeout=timeout) as sock:
+        _send_json(sock, {'file_id': file_id, 'piece': index, 'requester': requester})
+        header = _recv_json(sock, 4096)
+        if header.get('status') != 'sending' or header.get('file_size') != length:
+            raise OSError(f"piece {index} refused: {header}")
+        sock.sendall(b'ready')
+        piece = bytearray(length)
+        view = memoryview(piece)
+        received = 0
+        while received < length:
+            n = sock.recv_into(view[received:])
+            if not n:
+                raise OSError(f"piece {index} cut short at {received}/{length} bytes")
+            received += n
+        return bytes(piece)
+
+
+class _Holding:
+    __slots__ = ('data', 'have', 'size', 'expires')
+
+    def __init__(self, data: Any, have: Optional[Set[int]], size: int):
+        self.data = data  # bytes-like, filled in as pieces arrive
+        self.have = have  # None = every piece
+        self.size = size
+        self.expires = time.monotonic() + PEER_TTL  # When the tracker forgets our announcement
+
+    def announced(self):
+        self.expires = time.monotonic() + PEER_TTL
+
+
+class _PieceHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        sock = self.request
+        sock.settimeout(PEER_TIMEOUT)
+        try:
+            request = _recv_json(sock, 4096)
+            holding = self.server.holding(request.get('file_id'))
+            index = int(request.get('piece', -1))
+            span = piece_range(holding.size, index) if holding is not None else None
+            if span is None or (holding.have is not None and index not in holding.have):
+                _send_json(sock, {'status': 'error', 'message': 'Piece not here'})
+                return
+            offset, length = span
+            _send_json(sock, {'status': 'sending', 'file_size': length})
+            sock.recv(64)  # Go-ahead
+            sock.sendall(memoryview(holding.data)[offset:offset + length])
+        except (OSError, ValueError, TypeError, AttributeError):
+            pass
+
+
+class PieceServer(socketserver.ThreadingTCPServer):
+    """Serves the pieces this client holds to other peers on the LAN.
+
+    A file is held only while the tracker still advertises it (PEER_TTL after
+    the last announcement), and at most max_bytes in total, least recently
+    served first out.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port: int = 0, max_bytes: int = HOLD_BYTES):
+        super().__init__(('0.0.0.0', port), _PieceHandler)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.holdings: 'collections.OrderedDict[str, _Holding]' = collections.OrderedDict()  # Oldest use first
+        threading.Thread(target=self.serve_forever, daemon=True, name='swarm-pieces').start()
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def _expire(self):
+        now = time.monotonic()
+        for file_id in [f for f, holding in self.holdings.items() if holding.expires < now]:
+            del self.holdings[file_id]
+
+    def hold(self, file_id: str, holding: _Holding) -> None:
+        with self._lock:
+            self._expire()
+            self.holdings.pop(file_id, None)
+            self.holdings[file_id] = holding
+            total = sum(h.size for h in self.holdings.values())
+            while total > self.max_bytes and len(self.holdings) > 1:
+                _, evicted = self.holdings.popitem(last=False)
+                total -= evicted.size
+
+    def holding(self, file_id: str) -> Optional[_Holding]:
+        with self._lock:
+            self._expire()
+            holding = self.holdings.get(file_id)
+            if holding is not None:
+                self.holdings.move_to_end(file_id)
+            return holding
+
+    def release(self, file_id: str) -> None:
+        with self._lock:
+            self.holdings.pop(file_id, None)
+
+    def seed(self, file_id: str, data: Any) -> None:
+        """Offer a whole file (e.g. one this client just uploaded)"""
+        self.hold(file_id, _Holding(data, None, len(data)))
+
+
+def announce(server_host: str, file_port: int, file_id: str, port: int, peer: str, pieces: Any) -> None:
+    """Tell the server which pieces of a file this client can serve"""
+    try:
+        with socket.create_connection((server_host, file_port), timeout=PEER_TIMEOUT) as sock:
+            _send_json(sock, {'swarm': 'have', 'file_id': file_id, 'port': port, 'peer': peer,
+                              'pieces': pieces if pieces == 'all' else sorted(pieces)})
+            _recv_json(sock, 4096)
+    except (OSError, ValueError) as e:
+        log.debug("Announcing %s failed: %s", file_id, e)
+
+
+def swarm_download(server_host: str, file_port: int, file_id: str, requester: str,
+                   piece_server: PieceServer, workers: int = 4) -> Optional[Tuple[str, bytearray]]:
+    """(file name, data) fetched with help from peers; None if the server won't swarm this file.
+
+    The data is the buffer the pieces were assembled in, which the piece
+    server keeps serving from, so it is not copied.
+    """
+    with socket.create_connection((server_host, file_port), timeout=30) as sock:
+        _send_json(sock, {'swarm': 'manifest', 'file_id': file_id, 'requester': requester,
+                          'port': piece_server.port})
+        manifest = _recv_json(sock)
+    if manifest.get('status') != 'ok':
+        return None
+
+    size, piece_size, hashes = manifest['size'], manifest['piece_size'], manifest['hashes']
+    buffer = bytearray(size)
+    have: Set[int] = set()
+    holding = _Holding(buffer, have, size)
+    piece_server.hold(file_id, holding)
+    peers = manifest.get('peers', [])
+    holders: Dict[int, List[Tuple[str, int]]] = {i: [] for i in range(len(hashes))}
+    for peer in peers:
+        pieces = range(len(hashes)) if peer['pieces'] == 'all' else peer['pieces']
+        for i in pieces:
+            if i in holders:
+                holders[i].append((peer['host'], peer['port']))
+    # Rarest first spreads pieces across the swarm fastest; ties in random order
+    order = sorted(holders, key=lambda i: (len(holders[i]), random.random()))
+    lock = threading.Lock()
+    failed_peers: Set[Tuple[str, int]] = set()
+    since_announce = [0]
+
+    def get(index: int):
+        offset, length = piece_range(size, index, piece_size)
+        sources = [p for p in holders[index] if p not in failed_peers]
+        random.shuffle(sources)
+        for host, port in sources[:2] + [(server_host, file_port)]:
+            source = 'server' if (host, port) == (server_host, file_port) else 'peer'
+            try:
+                piece = fetch_piece(host, port, file_id, index, length, requester,
+                                    timeout=30 if source == 'server' else PEER_TIMEOUT)
+            except (OSError, ValueError) as e:
+                pieces_fetched.labels(source, 'error').inc()
+                if source == 'peer':
+                    failed_peers.add((host, port))
+                log.debug("Piece %d of %s from %s:%s failed: %s", index, file_id, host, port, e)
+                continue
+            if hashlib.sha256(piece).hexdigest() != hashes[index]:
+                pieces_fetched.labels(source, 'corrupt').inc()
+                failed_peers.add((host, port))
+                log.warning("Piece %d of %s from %s:%s failed verification", index, file_id, host, port)
+                continue
+            buffer[offset:offset + length] = piece
+            pieces_fetched.labels(source, 'ok').inc()
+            with lock:
+                have.add(index)
+                since_announce[0] += 1
+                due = since_announce[0] >= ANNOUNCE_EVERY
+                if due:
+                    since_announce[0] = 0
+                    pieces = set(have)
+            if due:
+                announce(server_host, file_port, file_id, piece_server.port, requester, pieces)
+                holding.announced()
+            return
+        raise OSError(f"piece {index} of {file_id} unavailable")
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='swarm-fetch') as pool:
+            for future in [pool.submit(get, i) for i in order]:
+                future.result()
+    except BaseException:
+        piece_server.release(file_id)  # Partial: not worth its memory once the caller falls back
+        raise
+
+    holding.have = None
+    announce(server_host, file_port, file_id, piece_server.port, requester, 'all')
+    holding.announced()
+    return manifest.get('file_name', file_id), buffer
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+timer_wheel.py - Hashed timer wheel for connection deadlines
+Scheduling is O(1) and each tick only looks at the entries in one slot,
+so idle detection no longer scans every connection
+"""
+
+import math
+import threading
+import time
+from typing import Any, List, Optional, Tuple
+
+
+class TimerWheel:
+    """Hashed timer wheel keyed by arbitrary hashable objects.
+
+    Entries are one-shot: a key fires once when its slot comes round after
+    its deadline, and the caller re-schedules it if it still cares.
+    Deadlines further away than one revolution simply stay in their slot
+    until a later pass.
+    """
+
+    def __init__(self, tick: float = 1.0, slots: int = 512):
+        self.tick = tick
+        self.slots: List[List[Tuple[float, Any]]] = [[] for _ in range(slots)]
+        self.lock = threading.Lock()
+        self.current_tick = int(time.monotonic() / tick)
+
+    def schedule(self, key: Any, deadline: float) -> None:
+        """Fire key at (or just after) the given monotonic deadline"""
+        slot = max(math.ceil(deadline / self.tick), self.current_tick + 1) % len(self.slots)
+        with self.lock:
+            self.slots[slot].append((deadline, key))
+
+    def advance(self, now: Optional[float] = None) -> List[Any]:
+        """Move the wheel up to now and return every key whose deadline has passed"""
+        if now is None:
+            now = time.monotonic()
+        target_tick = int(now / self.tick)
+        expired: List[Any] = []
+
+        with self.lock:
+            # Never walk more than one revolution - every slot gets visited once
+            first = max(self.current_tick + 1, target_tick - len(self.slots) + 1)
+            for tick in range(first, target_tick + 1):
+                slot = tick % len(self.slots)
+                entries = self.slots[slot]
+                if not entries:
+                    continue
+                pending = []
+                for deadline, key in entries:
+                    if deadline <= now:
+                        expired.append(key)
+                    else:
+                        pending.append((deadline, key))
+                self.slots[slot] = pending
+            self.current_tick = max(self.current_tick, target_tick)
+
+        return expired
+
+    def __len__(self) -> int:
+        with self.lock:
+            return sum(len(entries) for entries in self.slots)
@@ -20,8 +20,10 @@ logging.getLogger('werkzeug').setLevel(logging.ERROR)  # Suppress Flask debug lo
 logging.getLogger('eventlet').setLevel(logging.ERROR)  # Suppress eventlet SSL warnings
 
 
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify
+import functools
 import json
+import time
 from flask_socketio import SocketIO, emit, join_room, leave_room
 import socket as py_socket
 import uuid
@@ -32,6 +34,8 @@ import ssl
 from dotenv import load_dotenv
 import sys
 
+from backend.metrics import CONTENT_TYPE, registry
+
 # Load environment variables - check multiple possible locations for .env
 if getattr(sys, 'frozen', False):
     # Running as compiled executable
@@ -71,6 +75,37 @@ _users_in_room = {}  # room_id -> [sid, sid, ...]
 _room_of_sid = {}    # sid -> room_id
 _name_of_sid = {}    # sid -> display_name
 
+# Media server metrics, exported on /metrics below
+_events_received = registry.counter('media_events', "Socket.IO events received, by event", labels=('event',))
+_event_seconds = registry.histogram('media_event_seconds', "Time spent handling one Socket.IO event", labels=('event',))
+_event_errors = registry.counter('media_event_errors', "Socket.IO handlers that raised, by event", labels=('event',))
+_connections = registry.gauge('media_connections', "Open Socket.IO connections")
+registry.gauge('media_rooms', "Rooms with at least one participant", fn=lambda: len(_users_in_room))
+registry.gauge('media_participants', "Participants across all rooms", fn=lambda: len(_room_of_sid))
+registry.gauge('media_video_sessions', "Video sessions created", fn=lambda: len(video_sessions))
+registry.gauge('media_audio_sessions', "Audio sessions created", fn=lambda: len(audio_sessions))
+
+
+def _instrumented(event: str):
+    """Count and time a Socket.IO handler (goes under @socketio.on)"""
+    counter, timer, errors = _events_received.labels(event), _event_seconds.labels(event), _event_errors.labels(event)
+
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            counter.inc()
+            started = time.perf_counter()
+            try:
+                return handler(*args, **kwargs)
+            except Exception:
+                errors.inc()
+                raise
+            finally:
+                timer.observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
 @app.route('/')
 def index():
     return "Shadow Nexus Media Server Running - Video & Audio Calls"
@@ -101,6 +136,11 @@ def audio_room(session_id):
                          session_name=session.get('name', 'Audio Call'),
                          server_ip=SERVER_IP)
 
+@app.route('/metrics')
+def metrics():
+    """Prometheus scrape endpoint"""
+    return Response(registry.render_prometheus(), content_type=CONTENT_TYPE)
+
 @app.route('/static/sounds/<filename>')
 def serve_sound(filename):
     """Explicitly serve sound files with correct MIME type"""
@@ -156,14 +196,18 @@ def api_create_audio_session():
     })
 
 @socketio.on('connect')
-def handle_connect():
+@_instrumented('connect')
+def handle_connect(auth=None):
     sid = request.sid
+    _connections.inc()
     print(f"[MEDIA SERVER] Client connected: {sid}")
     emit('connected', {'sid': sid})
 
 @socketio.on('disconnect')
-def handle_disconnect():
+@_instrumented('disconnect')
+def handle_disconnect(reason=None):
     sid = request.sid
+    _connections.dec()
     print(f"[MEDIA SERVER] Client disconnected: {sid}")
     
     # Remove from room
@@ -190,6 +234,7 @@ def handle_disconnect():
         print(f"[MEDIA SERVER] User <{sid}> left room <{room_id}>")
 
 @socketio.on('join_session')
+@_instrumented('join_session')
 def handle_join_session(data):
     """Handle user joining video or audio session (room) - mesh topology"""
     sid = request.sid
@@ -229,6 +274,7 @@ def handle_join_session(data):
         print(f"[{session_type} SERVER] New user joined. Room {room_id} now has {len(_users_in_room[room_id])} users")
 
 @socketio.on('leave_session')
+@_instrumented('leave_session')
 def handle_leave_session(data):
     """Handle user leaving video session"""
     sid = request.sid
@@ -248,6 +294,7 @@ def handle_leave_session(data):
         print(f"[MEDIA SERVER] User {sid} left room {room_id}")
 
 @socketio.on('data')
+@_instrumented('data')
 def handle_data(msg):
     """Forward WebRTC signaling data (offer/answer/ICE) between peers"""
     sender_sid = msg.get('sender_id')
@@ -266,6 +313,7 @@ def handle_data(msg):
     
     
 @socketio.on('hand_raise')
+@_instrumented('hand_raise')
 def handle_hand_raise(data):
     session_id = data['session_id']
     user_id = data['user_id']
@@ -279,6 +327,7 @@ def handle_hand_raise(data):
     }, room=session_id, skip_sid=request.sid)
     
 @socketio.on('screen_share')
+@_instrumented('screen_share')
 def handle_screen_share(data):
     session_id = data['session_id']
     user_id = data['user_id']
@@ -292,6 +341,7 @@ def handle_screen_share(data):
     }, room=session_id, skip_sid=request.sid)
 
 @socketio.on('reaction')
+@_instrumented('reaction')
 def handle_reaction(data):
     session_id = data['session_id']
     user_id = data['user_id']
@@ -305,6 +355,7 @@ def handle_reaction(data):
     }, room=session_id, skip_sid=request.sid)
 
 @socketio.on('audio_level')
+@_instrumented('audio_level')
 def handle_audio_level(data):
     session_id = data['session_id']
     user_id = data['user_id']
@@ -319,6 +370,7 @@ def handle_audio_level(data):
     }, room=session_id, skip_sid=request.sid)
 
 @socketio.on('camera_state')
+@_instrumented('camera_state')
 def handle_camera_state(data):
     session_id = data['session_id']
     user_id = data['user_id']
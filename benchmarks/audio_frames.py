@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+audio_frames.py - Audio frame encode/send and receive/decode cost per core
+Pushes N audio frames through a loopback socket as fast as one thread can
+send them and another can read them, and reports frames per CPU-second on
+each side (thread CPU time, so one core's worth), plus wall-clock rate.
+
+Paths:
+  json     the original per-frame format: dict with an ISO timestamp,
+           json.dumps, newline, bytes concatenated onto the samples
+  struct   binary header from struct.pack, concatenated onto the samples
+  sendmsg  FrameSender: header packed into a preallocated buffer, header and
+           samples handed to one sendmsg() without a copy (the shipped path)
+UDP rows skip json, which never ran over datagrams. A 20 ms call is 50 frames/s
+per speaker, so frames/s per core / 50 is the speaker budget of one core.
+
+Usage: python -m benchmarks.audio_frames [--frames 200000] [--block 320]
+       python -m benchmarks.audio_frames --json >> audio_frames.jsonl
+"""
+
+import argparse
+import json
+import socket
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict
+
+from backend import audio_transport as at
+from benchmarks.common import emit_json, git_revision
+
+
+def json_encoder(sock: socket.socket, framed: bool) -> Callable:
+    def send(seq: int, frame):
+        header = {'type': 'audio_frame', 'sender': 'bench', 'timestamp': datetime.now().isoformat(),
+                  'size': len(frame)}
+        sock.sendall((json.dumps(header) + '\n').encode() + frame.tobytes())
+    return send
+
+
+def struct_encoder(sock: socket.socket, framed: bool) -> Callable:
+    if framed:
+        return lambda seq, frame: sock.sendall(at.pack_frame(at.AUDIO, frame.tobytes(), 1, seq, seq * len(frame)))
+    return lambda seq, frame: sock.send(at.pack(at.AUDIO, 1, seq, seq * len(frame), frame.tobytes()))
+
+
+def sendmsg_encoder(sock: socket.socket, framed: bool) -> Callable:
+    sender = at.FrameSender(sock, framed=framed)
+    return lambda seq, frame: sender.send(at.AUDIO, 1, seq, seq * len(frame), frame)
+
+
+ENCODERS = {'json': json_encoder, 'struct': struct_encoder, 'sendmsg': sendmsg_encoder}
+
+
+def read_json(sock: socket.socket, frames: int) -> int:
+    stream = sock.makefile('rb')
+    n = 0
+    while n < frames:
+        line = stream.readline()
+        if not line:
+            break
+        header = json.loads(line)
+        if len(stream.read(header['size'] * 2)) < header['size'] * 2:
+            break
+        n += 1
+    return n
+
+
+def read_frames(sock: socket.socket, frames: int) -> int:
+    reader = at.FrameReader(sock)
+    n = 0
+    while n < frames and reader.read() is not None:
+        n += 1
+    return n
+
+
+def read_datagrams(sock: socket.socket, frames: int) -> int:
+    buffer = bytearray(at.MAX_DATAGRAM)
+    view = memoryview(buffer)
+    sock.settimeout(0.5)  # Loopback UDP still drops when the reader falls behind
+    n = 0
+    try:
+        while n < frames:
+            at.unpack(view[:sock.recv_into(buffer)])
+            n += 1
+    except socket.timeout:
+        pass
+    return n
+
+
+def run(path: str, transport: str, frames: int, block: int) -> Dict:
+    np = at.get_numpy()
+    frame = (np.arange(block, dtype=np.int16) * 97) % 2000
+    if transport == 'tcp':
+        listener = socket.create_server(('127.0.0.1', 0))
+        sender_sock = socket.create_connection(listener.getsockname())
+        sender_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        receiver_sock, _ = listener.accept()
+        listener.close()
+        read = read_json if path == 'json' else read_frames
+    else:
+        receiver_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 << 20)
+        receiver_sock.bind(('127.0.0.1', 0))
+        sender_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sender_sock.connect(receiver_sock.getsockname())
+        read = read_datagrams
+
+    result = {}
+
+    def receive():
+        started = time.thread_time()
+        result['received'] = read(receiver_sock, frames)
+        result['recv_cpu'] = time.thread_time() - started
+
+    receiver = threading.Thread(target=receive, daemon=True)
+    receiver.start()
+    send = ENCODERS[path](sender_sock, transport == 'tcp')
+    wall = time.perf_counter()
+    cpu = time.thread_time()
+    for seq in range(frames):
+        send(seq, frame)
+    send_cpu = time.thread_time() - cpu
+    receiver.join()
+    wall = time.perf_counter() - wall
+    sender_sock.close()
+    receiver_sock.close()
+
+    return {'path': path, 'transport': transport, 'frames': frames, 'received': result['received'],
+            'send_per_core': round(frames / send_cpu) if send_cpu else None,
+            'recv_per_core': round(result['received'] / result['recv_cpu']) if result['recv_cpu'] else None,
+            'wall_per_s': round(result['received'] / wall)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--frames', type=int, default=200000)
+    parser.add_argument('--block', type=int, default=at.FRAME_SIZE, help='samples per frame')
+    parser.add_argument('--paths', nargs='+', default=list(ENCODERS), choices=list(ENCODERS))
+    parser.add_argument('--json', action='store_true', help='print one JSON result line')
+    args = parser.parse_args()
+
+    rows = [run(path, transport, args.frames, args.block)
+            for transport in ('tcp', 'udp') for path in args.paths
+            if not (transport == 'udp' and path == 'json')]
+    if args.json:
+        emit_json({'benchmark': 'audio_frames', 'commit': git_revision(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'params': {'frames': args.frames, 'block': args.block}, 'rows': rows})
+        return
+
+    print(f"audio_frames @ {git_revision()}: {args.frames} frames of {args.block} samples")
+    print(f"{'path':<8} {'transport':<9} {'send/core':>10} {'recv/core':>10} {'wall/s':>9} {'received':>9}")
+    for row in rows:
+        print(f"{row['path']:<8} {row['transport']:<9} {row['send_per_core']:>10} {row['recv_per_core']:>10} "
+              f"{row['wall_per_s']:>9} {row['received']:>9}")
+
+
+if __name__ == '__main__':
+    main()
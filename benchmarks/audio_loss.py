@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""
+audio_loss.py - Call audio latency and concealment under induced packet loss
+Starts an AudioRelay on loopback behind a netem-style UDP proxy that drops and
+delays (with jitter, hence also reorders) datagrams in both directions, then
+has one client speak and another listen through the relay. The listener plays
+out through the same JitterBuffer AudioEngine uses, one pop per 20 ms, and
+every frame carries its number in its first samples, so each played frame maps
+back to the moment it was sent.
+
+Reports, per (loss, jitter) pair: end-to-end latency from send to playout
+(device buffers excluded), the share of played frames that were concealed on
+either leg, late drops, and where the listener's adaptive target settled.
+
+Usage: python -m benchmarks.audio_loss [--loss 0 1 5 10 20] [--jitter 0 20 40] [--seconds 5]
+       python -m benchmarks.audio_loss --delay 30 --json >> audio_loss.jsonl
+"""
+
+import argparse
+import heapq
+import logging
+import random
+import socket
+import threading
+import time
+from typing import Dict, List, Tuple
+
+from backend import audio_transport as at
+from backend.audio_relay import AudioRelay
+from backend.logger import ROOT_LOGGER
+from backend.metrics import Histogram
+from benchmarks.common import emit_json, git_revision
+
+# Samples 2 and 3 of every sent frame; concealment scales them. Everything stays under the
+# mixer's limiter knee so real frames reach the listener bit-exact.
+MARK = (0x1234, 0x2143)
+
+
+class LossyProxy:
+    """UDP proxy in front of the relay: independent loss and delay jitter per datagram, both ways"""
+
+    def __init__(self, target: Tuple[str, int], loss: float, delay: float, jitter: float, seed: int):
+        self.target = target
+        self.loss, self.delay, self.jitter = loss, delay, jitter
+        self.rng = random.Random(seed)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.address = self.sock.getsockname()
+        self.upstream: Dict[Tuple, socket.socket] = {}
+        self.heap: List[Tuple[float, int, socket.socket, bytes, Tuple]] = []
+        self.cond = threading.Condition()
+        self.count = 0
+        self.forwarded = self.dropped = 0
+        self.running = True
+        for target_fn in (self._client_loop, self._deliver_loop):
+            threading.Thread(target=target_fn, daemon=True).start()
+
+    def _schedule(self, sock: socket.socket, data: bytes, dest: Tuple):
+        with self.cond:
+            if self.rng.random() < self.loss:
+                self.dropped += 1
+                return
+            due = time.monotonic() + max(0.0, self.rng.uniform(self.delay - self.jitter, self.delay + self.jitter))
+            self.count += 1
+            heapq.heappush(self.heap, (due, self.count, sock, data, dest))
+            self.cond.notify()
+
+    def _client_loop(self):
+        while self.running:
+            try:
+                data, client = self.sock.recvfrom(4096)
+            except OSError:
+                return
+            upstream = self.upstream.get(client)
+            if upstream is None:
+                upstream = self.upstream[client] = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                upstream.bind(('127.0.0.1', 0))
+                threading.Thread(target=self._relay_loop, args=(upstream, client), daemon=True).start()
+            self._schedule(upstream, data, self.target)
+
+    def _relay_loop(self, upstream: socket.socket, client: Tuple):
+        while self.running:
+            try:
+                data = upstream.recv(4096)
+            except OSError:
+                return
+            self._schedule(self.sock, data, client)
+
+    def _deliver_loop(self):
+        while self.running:
+            with self.cond:
+                while self.running and (not self.heap or self.heap[0][0] > time.monotonic()):
+                    self.cond.wait(self.heap[0][0] - time.monotonic() if self.heap else None)
+                if not self.running:
+                    return
+                _, _, sock, data, dest = heapq.heappop(self.heap)
+            try:
+                sock.sendto(data, dest)
+                self.forwarded += 1
+            except OSError:
+                pass
+
+    def stop(self):
+        self.running = False
+        with self.cond:
+            self.cond.notify()
+        for sock in [self.sock, *self.upstream.values()]:
+            sock.close()
+
+
+def join(proxy: Tuple[str, int], username: str) -> Tuple[socket.socket, int]:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.connect(proxy)
+    sock.settimeout(0.3)
+    for _ in range(20):
+        sock.send(at.pack_json(at.JOIN, {'username': username, 'room': 'bench'}))
+        try:
+            kind, _, stream, _, _, _ = at.unpack(sock.recv(at.MAX_DATAGRAM))
+        except socket.timeout:
+            continue
+        if kind == at.JOINED:
+            return sock, stream
+    raise RuntimeError(f"{username} could not join the relay")
+
+
+def run_pair(loss: float, jitter_ms: float, delay_ms: float, seconds: float, seed: int) -> Dict:
+    np = at.get_numpy()
+
+    relay = AudioRelay('127.0.0.1', 0).start()
+    proxy = LossyProxy(('127.0.0.1', relay.port), loss, delay_ms / 1000, jitter_ms / 1000, seed)
+    listener, _ = join(proxy.address, 'listener')
+    speaker, stream = join(proxy.address, 'speaker')
+    sent: Dict[int, float] = {}
+    latency = Histogram()
+    jitter = at.JitterBuffer()
+    played: List[bool] = []  # Per played frame: concealed?
+    gaps = [0]
+    done = threading.Event()
+
+    def speak():
+        frame = np.zeros(at.FRAME_SIZE, dtype=np.int16)
+        frame[2:4] = MARK
+        next_tick = time.monotonic()
+        for seq in range(1, int(seconds / at.FRAME_SECONDS) + 1):
+            frame[0], frame[1] = seq & 0x3FFF, seq >> 14
+            sent[seq] = time.monotonic()
+            speaker.send(at.pack(at.AUDIO, stream, seq, seq * at.FRAME_SIZE, frame.tobytes()))
+            next_tick += at.FRAME_SECONDS
+            time.sleep(max(0.0, next_tick - time.monotonic()))
+        time.sleep(0.5)  # Let the tail drain through both jitter buffers
+        done.set()
+
+    def receive():
+        listener.settimeout(0.5)
+        while not done.is_set():
+            try:
+                kind, _, _, seq, timestamp, payload = at.unpack(listener.recv(at.MAX_DATAGRAM))
+            except socket.timeout:
+                listener.send(at.pack(at.KEEPALIVE))
+                continue
+            except OSError:
+                return
+            if kind == at.AUDIO:
+                jitter.put(seq, timestamp, payload)
+
+    def play():
+        started = False
+        next_tick = time.monotonic()
+        while not done.is_set():
+            frame = jitter.pop()
+            if frame is None:
+                gaps[0] += started
+            else:
+                started = True
+                real = (int(frame[2]), int(frame[3])) == MARK
+                played.append(not real)
+                if real:
+                    seq = int(frame[0]) | int(frame[1]) << 14
+                    if seq in sent:
+                        latency.observe(time.monotonic() - sent[seq])
+            next_tick += at.FRAME_SECONDS
+            time.sleep(max(0.0, next_tick - time.monotonic()))
+
+    threads = [threading.Thread(target=fn, daemon=True) for fn in (speak, receive, play)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    upstream = next((p.jitter.stats() for room in relay.rooms.values() for p in room.participants.values()
+                     if p.username == 'speaker'), {})
+    downstream = jitter.stats()
+    proxy.stop()
+    relay.stop()
+    speaker.close()
+    listener.close()
+
+    # The fade after the speaker stops is concealment too, but not of anything lost
+    while played and played[-1]:
+        played.pop()
+    p50, p95, p99 = (round(v * 1000, 1) for v in latency.percentiles((0.5, 0.95, 0.99)))
+    return {
+        'loss': loss, 'jitter_ms': jitter_ms, 'delay_ms': delay_ms,
+        'latency_ms': {'p50': p50, 'p95': p95, 'p99': p99},
+        'concealed_pct': round(100 * sum(played) / max(1, len(played)), 2),
+        'gaps': gaps[0],
+        'late': {'relay': upstream.get('late', 0), 'listener': downstream['late']},
+        'target_frames': {'relay': upstream.get('target'), 'listener': downstream['target']},
+        'datagrams': {'forwarded': proxy.forwarded, 'dropped': proxy.dropped},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--loss', type=float, nargs='+', default=[0, 1, 5, 10, 20], help='percent, each way')
+    parser.add_argument('--jitter', type=float, nargs='+', default=[0, 20, 40], help='+/- ms around --delay')
+    parser.add_argument('--delay', type=float, default=20, help='one-way ms added by the proxy')
+    parser.add_argument('--seconds', type=float, default=5, help='speech per pair')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='print one JSON result line')
+    args = parser.parse_args()
+    logging.getLogger(ROOT_LOGGER).setLevel(logging.WARNING)  # One relay per pair; skip its join/leave lines
+
+    rows = []
+    if not args.json:
+        print(f"audio_loss @ {git_revision()}: {args.delay:g} ms one-way delay, {args.seconds:g} s per pair")
+        print(f"{'loss %':>7} {'jitter':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'concealed':>10} "
+              f"{'late':>9} {'target':>7}")
+    for loss in args.loss:
+        for jitter_ms in args.jitter:
+            row = run_pair(loss / 100, jitter_ms, args.delay, args.seconds, args.seed)
+            rows.append(row)
+            if not args.json:
+                late, target, lat = row['late'], row['target_frames'], row['latency_ms']
+                print(f"{loss:>7g} {jitter_ms:>5g}ms {lat['p50']:>8.1f} {lat['p95']:>8.1f} {lat['p99']:>8.1f} "
+                      f"{row['concealed_pct']:>9.2f}% {late['relay']:>4}/{late['listener']:<4} "
+                      f"{target['relay']}/{target['listener']:>3}", flush=True)
+
+    if args.json:
+        emit_json({'benchmark': 'audio_loss', 'commit': git_revision(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'params': {k: v for k, v in vars(args).items() if k != 'json'}, 'rows': rows})
+
+
+if __name__ == '__main__':
+    main()
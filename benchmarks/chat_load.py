@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+chat_load.py - Synthetic load against the chat server over the real protocol
+Starts a CollaborationServer in its own process (or targets --port), connects
+thousands of simulated clients from a few generator processes and drives a
+weighted mix of chat, private, group_message, history requests and pings at a
+fixed aggregate rate. Reports delivery latency percentiles, throughput and
+server RSS; --json prints one line keyed by commit so runs can be compared.
+
+Usage: python -m benchmarks.chat_load [--clients 1000] [--rate 200] [--duration 15]
+       python -m benchmarks.chat_load --json >> chat_load.jsonl
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import re
+import socket
+import time
+from collections import deque
+from typing import Dict, List, Optional
+
+from backend.metrics import Histogram
+from benchmarks.common import (RssSampler, ServerProcess, emit_json, git_revision, memory,
+                               parse_quantiles, raise_fd_limit)
+
+DEFAULT_MIX = 'private=50,group_message=25,chat=5,history=10,ping=10'
+MARKER = 'bench:'
+TYPE_RE = re.compile(rb'"type":\s*"(\w+)"')
+BENCH_RE = re.compile(rb'bench:(\d+\.\d+):(\d+):')
+RECEIVER_RE = re.compile(rb'"receiver":\s*"([^"]+)"')
+MAX_BACKLOG = 1 << 20  # Don't queue more than this per socket when the server falls behind
+
+KINDS = ('private', 'group_message', 'chat', 'history', 'ping')
+
+# What each kind of load is measured by on the receiving side
+RECEIVED_AS = {'chat': 'chat', 'private': 'private', 'group_message': 'group_message',
+               'private_history': 'history', 'pong': 'ping'}
+
+
+class SimClient:
+    """One simulated user: a connection, the groups it is in and its outstanding requests"""
+
+    def __init__(self, index: int, name: str, groups: List[str], stats: Dict[str, Histogram]):
+        self.index = index
+        self.name = name
+        self.groups = groups
+        self.stats = stats
+        self.pending_history: Dict[str, deque] = {}
+        self.pending_pings: deque = deque()
+        self.writer = None
+
+    async def connect(self, port: int):
+        reader, self.writer = await asyncio.open_connection('127.0.0.1', port, limit=1 << 24)
+        self.writer.write((json.dumps({'username': self.name}) + '\n').encode('utf-8'))
+        return reader
+
+    async def read_loop(self, reader: asyncio.StreamReader):
+        while True:
+            try:
+                line = await reader.readline()
+            except (OSError, ValueError, asyncio.IncompleteReadError):
+                return
+            if not line:
+                return
+            now = time.time()
+            match = TYPE_RE.search(line, 0, 64)
+            kind = RECEIVED_AS.get(match.group(1).decode()) if match else None
+            if match and match.group(1) == b'ping':
+                self.send({'type': 'pong'})
+            if kind is None:
+                continue
+
+            if kind == 'history':
+                receiver = RECEIVER_RE.search(line)
+                started = self.pending_history.get(receiver.group(1).decode(), deque()) if receiver else deque()
+                if started:
+                    self.stats[kind].observe(now - started.popleft())
+            elif kind == 'ping':
+                if self.pending_pings:
+                    self.stats[kind].observe(now - self.pending_pings.popleft())
+            else:
+                bench = BENCH_RE.search(line)
+                # The sender's own echo isn't a delivery
+                if bench and int(bench.group(2)) != self.index:
+                    self.stats[kind].observe(now - float(bench.group(1)))
+
+    def send(self, message: Dict) -> bool:
+        if self.writer.transport.get_write_buffer_size() > MAX_BACKLOG:
+            return False
+        self.writer.write((json.dumps(message) + '\n').encode('utf-8'))
+        return True
+
+    def send_load(self, kind: str, peer: str, padding: str, rng: random.Random) -> Optional[str]:
+        """Send one message of the given kind; returns the kind actually sent, None if backlogged"""
+        if self.writer.transport.get_write_buffer_size() > MAX_BACKLOG:
+            return None
+        now = time.time()
+        content = f"{MARKER}{now:.6f}:{self.index}:{padding}"
+        if kind == 'group_message' and not self.groups:
+            kind = 'private'  # Users in no group talk privately instead
+
+        if kind == 'group_message':
+            self.send({'type': 'group_message', 'group_id': rng.choice(self.groups),
+                       'sender': self.name, 'content': content})
+        elif kind == 'chat':
+            self.send({'type': 'chat', 'sender': self.name, 'content': content})
+        elif kind == 'history':
+            self.pending_history.setdefault(peer, deque()).append(now)
+            self.send({'type': 'request_private_history', 'receiver': peer})
+        elif kind == 'ping':
+            self.pending_pings.append(now)
+            self.send({'type': 'ping'})
+        else:
+            self.send({'type': 'private', 'sender': self.name, 'receiver': peer, 'content': content})
+        return kind
+
+
+async def _drive(index: int, users: List[int], all_names: List[str], user_groups: Dict[str, List[str]],
+                 options: Dict, start_event, stop_event, results):
+    rng = random.Random(options['seed'] * 1000 + index)
+    kinds, weights = zip(*options['mix'].items())
+    stats = {kind: Histogram() for kind in KINDS}
+    clients = [SimClient(i, all_names[i], user_groups.get(all_names[i], []), stats) for i in users]
+
+    # The server accepts with a small backlog; connect a few at a time
+    gate = asyncio.Semaphore(64)
+    readers = []
+
+    async def connect(client):
+        async with gate:
+            reader = await client.connect(options['port'])
+            readers.append(asyncio.ensure_future(client.read_loop(reader)))
+
+    await asyncio.gather(*(connect(c) for c in clients))
+    results.put(('connected', index))
+    await asyncio.get_running_loop().run_in_executor(None, start_event.wait)
+
+    # Open loop: sends happen on schedule whether or not replies have arrived
+    rate = options['rate'] / options['procs']
+    padding = 'x' * options['payload']
+    sent = dict.fromkeys(KINDS, 0)
+    dropped = 0
+    started = time.perf_counter()
+    due_total = 0
+    while True:
+        elapsed = time.perf_counter() - started
+        if elapsed >= options['duration']:
+            break
+        due = int(elapsed * rate) - due_total
+        for _ in range(due):
+            client = rng.choice(clients)
+            kind = rng.choices(kinds, weights)[0]
+            peer = all_names[rng.randrange(len(all_names))]
+            if peer == client.name:
+                peer = all_names[(client.index + 1) % len(all_names)]
+            kind = client.send_load(kind, peer, padding, rng)
+            if kind is None:
+                dropped += 1
+            else:
+                sent[kind] += 1
+        due_total += due
+        await asyncio.sleep(0.005)
+
+    # Let in-flight deliveries land before counting
+    await asyncio.sleep(options['settle'])
+    results.put(('done', index, sent, dropped, {kind: h.snapshot() for kind, h in stats.items()}))
+
+    # Stay connected until the server has been measured - the disconnect storm is not the workload
+    await asyncio.get_running_loop().run_in_executor(None, stop_event.wait)
+    for client in clients:
+        client.writer.close()
+    for reader in readers:
+        reader.cancel()
+
+
+def _generator(index, users, all_names, user_groups, options, start_event, stop_event, results):
+    """Generator process entry point"""
+    raise_fd_limit()
+    asyncio.run(_drive(index, users, all_names, user_groups, options, start_event, stop_event, results))
+
+
+def create_groups(port: int, names: List[str], count: int, size: int, rng: random.Random) -> Dict[str, List[str]]:
+    """Create groups through the server and return username -> group ids"""
+    user_groups: Dict[str, List[str]] = {}
+    if not count:
+        return user_groups
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.sendall((json.dumps({'username': 'load_admin'}) + '\n').encode('utf-8'))
+    reader = sock.makefile('rb')
+    for g in range(count):
+        members = rng.sample(names, min(size, len(names)))
+        group_name = f'load_group_{g}'
+        sock.sendall((json.dumps({'type': 'group_create', 'group_name': group_name,
+                                  'members': members, 'sender': 'load_admin'}) + '\n').encode('utf-8'))
+        while True:
+            message = json.loads(reader.readline())
+            if message.get('type') == 'group_created' and message.get('group_name') == group_name:
+                break
+        for member in members:
+            user_groups.setdefault(member, []).append(message['group_id'])
+        time.sleep(0.002)  # Group ids are millisecond timestamps
+    sock.close()
+    return user_groups
+
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    mix = {}
+    for part in spec.split(','):
+        kind, _, weight = part.partition('=')
+        if kind.strip() not in KINDS:
+            raise SystemExit(f"Unknown message kind in --mix: {kind}")
+        mix[kind.strip()] = float(weight)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--rate', type=float, default=200, help='messages per second, all clients together')
+    parser.add_argument('--duration', type=float, default=15, help='seconds of load')
+    parser.add_argument('--settle', type=float, default=2, help='seconds to wait for stragglers afterwards')
+    parser.add_argument('--procs', type=int, default=min(4, os.cpu_count() or 1), help='generator processes')
+    parser.add_argument('--groups', type=int, default=50)
+    parser.add_argument('--group-size', type=int, default=20)
+    parser.add_argument('--payload', type=int, default=64, help='padding bytes per message')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f'weights per kind (default {DEFAULT_MIX})')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--port', type=int, help='use an already running server instead of starting one')
+    parser.add_argument('--json', action='store_true', help='print one JSON result line')
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    mix = parse_mix(args.mix)
+    server = None if args.port else ServerProcess()
+    port = args.port or server.chat_port
+    rng = random.Random(args.seed)
+
+    names = [f'load_{i:05d}' for i in range(args.clients)]
+    user_groups = create_groups(port, names, args.groups, args.group_size, rng)
+    options = {'port': port, 'rate': args.rate, 'duration': args.duration, 'settle': args.settle,
+               'procs': args.procs, 'payload': args.payload, 'mix': mix, 'seed': args.seed}
+
+    context = multiprocessing.get_context('spawn')
+    start_event, stop_event, results = context.Event(), context.Event(), context.Queue()
+    procs = []
+    connect_started = time.perf_counter()
+    for index in range(args.procs):
+        users = list(range(index, args.clients, args.procs))
+        proc = context.Process(target=_generator, daemon=True,
+                               args=(index, users, names, user_groups, options, start_event, stop_event, results))
+        proc.start()
+        procs.append(proc)
+    for _ in procs:
+        results.get(timeout=300)
+    connect_time = time.perf_counter() - connect_started
+    time.sleep(1.0)  # Presence deltas from the connect storm
+    connected_rss = memory(server.pid)[0] if server else None
+
+    sampler = RssSampler(server.pid).start() if server else None
+    start_event.set()
+    sent = dict.fromkeys(KINDS, 0)
+    dropped = 0
+    latency = {kind: Histogram() for kind in KINDS}
+    for _ in procs:
+        _, _, proc_sent, proc_dropped, snapshots = results.get(timeout=args.duration + args.settle + 120)
+        dropped += proc_dropped
+        for kind in KINDS:
+            sent[kind] += proc_sent[kind]
+            latency[kind].merge(snapshots[kind])
+    peak_rss = sampler.stop() if sampler else None
+    server_p99 = parse_quantiles(server.scrape(), 'chat_handler_seconds') if server else {}
+    stop_event.set()
+    for proc in procs:
+        proc.join(timeout=30)
+    if server:
+        server.stop()
+
+    wire_types = {'chat': 'chat', 'private': 'private', 'group_message': 'group_message',
+                  'history': 'request_private_history', 'ping': 'ping'}
+    per_kind = {}
+    for kind in KINDS:
+        if not sent[kind]:
+            continue
+        p50, p99, p999 = latency[kind].percentiles((0.5, 0.99, 0.999))
+        per_kind[kind] = {
+            'sent': sent[kind], 'delivered': latency[kind].count,
+            'p50_ms': round(p50 * 1000, 3), 'p99_ms': round(p99 * 1000, 3), 'p999_ms': round(p999 * 1000, 3),
+            'max_ms': round(latency[kind].max * 1000, 3),
+            'server_p99_ms': round(server_p99.get(wire_types[kind], 0.0) * 1000, 3),
+        }
+    total_sent = sum(sent.values())
+    total_delivered = sum(h.count for h in latency.values())
+    record = {
+        'benchmark': 'chat_load', 'commit': git_revision(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'params': {k: v for k, v in vars(args).items() if k not in ('json', 'port')},
+        'connect_s': round(connect_time, 3),
+        'sent_per_s': round(total_sent / args.duration, 1),
+        'delivered_per_s': round(total_delivered / args.duration, 1),
+        'backlogged_sends': dropped,
+        'rss_connected_mb': round(connected_rss / 2**20, 1) if connected_rss else None,
+        'rss_peak_mb': round(peak_rss / 2**20, 1) if peak_rss else None,
+        'kinds': per_kind,
+    }
+
+    if args.json:
+        emit_json(record)
+        return
+
+    print(f"chat_load @ {record['commit']}: {args.clients} clients / {args.procs} procs, "
+          f"{args.rate:g} msg/s for {args.duration:g}s, {args.groups} groups of {args.group_size}")
+    print(f"connected in {connect_time:.2f}s; sent {record['sent_per_s']} msg/s, "
+          f"delivered {record['delivered_per_s']} msg/s, {dropped} sends skipped for backlog")
+    print(f"{'kind':<14} {'sent':>8} {'delivered':>10} {'p50 ms':>8} {'p99 ms':>8} {'p99.9 ms':>9} "
+          f"{'max ms':>8} {'srv p99':>8}")
+    for kind, row in per_kind.items():
+        print(f"{kind:<14} {row['sent']:>8} {row['delivered']:>10} {row['p50_ms']:>8.2f} {row['p99_ms']:>8.2f} "
+              f"{row['p999_ms']:>9.2f} {row['max_ms']:>8.2f} {row['server_p99_ms']:>8.2f}")
+    if record['rss_peak_mb'] is not None:
+        per_conn = connected_rss / args.clients / 1024 if connected_rss else 0
+        print(f"server RSS: {record['rss_connected_mb']} MB connected (~{per_conn:.0f} KB/client), "
+              f"{record['rss_peak_mb']} MB peak")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+common.py - Shared pieces for the benchmark scripts
+Runs the server under test in its own process (so load generators don't share
+its GIL and its memory can be measured on its own) and reads process RSS and
+CPU time in a way that works on Linux, with psutil as an optional fallback
+"""
+
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from typing import Dict, Optional, Tuple
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def raise_fd_limit() -> None:
+    """Lift the soft open-file limit to the hard limit (thousands of sockets per process)"""
+    try:
+        import resource
+    except ImportError:
+        return  # Windows - no per-process soft limit to raise
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def git_revision() -> str:
+    """Short commit of the tree being measured, with '+dirty' for uncommitted changes"""
+    try:
+        rev = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT,
+                             capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO_ROOT,
+                               capture_output=True, text=True).stdout.strip()
+        return rev + ('+dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def memory(pid: int) -> Tuple[Optional[int], Optional[int]]:
+    """(current RSS, peak RSS) of a process in bytes; None where the platform can't tell"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line)
+        return int(fields['VmRSS'].split()[0]) * 1024, int(fields['VmHWM'].split()[0]) * 1024
+    except (OSError, KeyError, ValueError):
+        pass
+    if psutil is not None:
+        try:
+            info = psutil.Process(pid).memory_info()
+            return info.rss, getattr(info, 'peak_wset', None)
+        except psutil.Error:
+            pass
+    return None, None
+
+
+def cpu_seconds(pid: int) -> Optional[float]:
+    """User + system CPU time a process has used so far"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            # Fields after the parenthesised command name; utime/stime are 14/15
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, IndexError, ValueError):
+        pass
+    if psutil is not None:
+        try:
+            times = psutil.Process(pid).cpu_times()
+            return times.user + times.system
+        except psutil.Error:
+            pass
+    return None
+
+
+class RssSampler:
+    """Polls a process's RSS on a background thread and keeps the highest value seen"""
+
+    def __init__(self, pid: int, interval: float = 0.2):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self) -> 'RssSampler':
+        self._thread.start()
+        return self
+
+    def stop(self) -> Optional[int]:
+        """Stop sampling; returns the peak (or None if RSS isn't readable here)"""
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+        return self.peak or None
+
+    def _sample(self):
+        # Sampled RSS rather than VmHWM, which is the peak over the process's whole life
+        rss, _ = memory(self.pid)
+        self.peak = max(self.peak, rss or 0)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+
+def _serve(data_dir: str, ready):
+    """Child process: run a CollaborationServer on ephemeral loopback ports"""
+    os.chdir(data_dir)
+    # Storage and the log writer print to stdout; keep it in a file instead of the
+    # terminal. Redirect the descriptor - the log handler already holds sys.stdout
+    log_file = open(os.path.join(data_dir, 'server.log'), 'w', buffering=1)
+    sys.stdout.flush()
+    os.dup2(log_file.fileno(), sys.stdout.fileno())
+    raise_fd_limit()
+    from backend.metrics import default_admin_port
+    from backend.server import CollaborationServer
+
+    server = CollaborationServer('127.0.0.1', port=0, file_port=0, metrics_port=default_admin_port())
+    threading.Thread(target=server.start, daemon=True).start()
+    while not (server.server_socket.getsockname()[1] and server.file_server_socket.getsockname()[1]
+               and (server.metrics_port is None or server.metrics_server is not None)):
+        time.sleep(0.05)
+    ready.put((server.server_socket.getsockname()[1],
+               server.file_server_socket.getsockname()[1],
+               server.metrics_server.server_address[1] if server.metrics_server else None))
+    while server.running:
+        time.sleep(0.5)
+
+
+class ServerProcess:
+    """A CollaborationServer in a child process with a scratch data directory, removed by stop()"""
+
+    def __init__(self):
+        self.data_dir = tempfile.mkdtemp(prefix='shadow_nexus_bench_')
+        # Read by the child as it imports the benchmark module, before _serve runs
+        os.environ.setdefault('SHADOW_NEXUS_LOG', 'warning')
+        os.environ.setdefault('SHADOW_NEXUS_METRICS_PORT', '0')
+        context = multiprocessing.get_context('spawn')
+        ready = context.Queue()
+        self.process = context.Process(target=_serve, args=(self.data_dir, ready), daemon=True)
+        self.process.start()
+        self.chat_port, self.file_port, self.metrics_port = ready.get(timeout=60)
+        self.pid = self.process.pid
+
+    @property
+    def log_path(self) -> str:
+        return os.path.join(self.data_dir, 'server.log')
+
+    def scrape(self) -> str:
+        """Current /metrics text from the server's admin port ('' if it has none or is too busy)"""
+        if self.metrics_port is None:
+            return ''
+        try:
+            with urllib.request.urlopen(f'http://127.0.0.1:{self.metrics_port}/metrics', timeout=30) as response:
+                return response.read().decode('utf-8')
+        except OSError:
+            return ''
+
+    def stop(self) -> None:
+        self.process.terminate()
+        self.process.join(timeout=10)
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+
+
+def parse_quantiles(metrics_text: str, name: str, quantile: str = '0.99') -> Dict[str, float]:
+    """{type label: value} for one quantile of a labeled summary in Prometheus text"""
+    prefix = f'shadow_nexus_{name}{{type="'
+    suffix = f'",quantile="{quantile}"}}'
+    values = {}
+    for line in metrics_text.splitlines():
+        if line.startswith(prefix):
+            key, _, value = line.partition(' ')
+            if key.endswith(suffix):
+                values[key[len(prefix):-len(suffix)]] = float(value)
+    return values
+
+
+def emit_json(record: Dict) -> None:
+    """One result line, for appending to a results file and diffing across commits"""
+    print(json.dumps(record, sort_keys=True))
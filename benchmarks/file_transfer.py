@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+file_transfer.py - Upload/download throughput on the file port
+For every (file size, concurrency) pair, starts a fresh CollaborationServer in
+its own process, has N clients upload a file of that size at once and then
+download it back, and reports aggregate MB/s each way, time to first byte,
+server CPU seconds per GB moved and peak server RSS.
+
+A fresh server per round matters: uploaded bytes stay in server memory, so
+reusing one would carry every earlier round's files into the RSS numbers.
+
+Usage: python -m benchmarks.file_transfer [--sizes 1K 1M 64M] [--concurrency 1 4 16 64]
+       python -m benchmarks.file_transfer --sizes 2G --concurrency 1 --timeout 1800
+       python -m benchmarks.file_transfer --json >> file_transfer.jsonl
+"""
+
+import argparse
+import json
+import socket
+import threading
+import time
+from typing import Dict, List, Optional
+
+from backend.metrics import Histogram
+from benchmarks.common import RssSampler, ServerProcess, cpu_seconds, emit_json, git_revision, raise_fd_limit
+
+CHUNK = 1 << 20
+# Repeating pattern instead of random bytes, so generating 2 GB costs nothing
+PATTERN = memoryview(bytes(range(256)) * (CHUNK // 256))
+UNITS = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+
+
+def parse_size(text: str) -> int:
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def format_size(size: int) -> str:
+    for unit in ('G', 'M', 'K'):
+        if size >= UNITS[unit] and size % UNITS[unit] == 0:
+            return f"{size // UNITS[unit]}{unit}"
+    return str(size)
+
+
+class Transfer:
+    """Timings for one client's upload followed by its download"""
+
+    def __init__(self):
+        self.upload_ttfb = self.upload_seconds = None
+        self.download_ttfb = self.download_seconds = None
+        self.error: Optional[str] = None
+
+
+def upload(port: int, size: int, index: int, result: Transfer) -> Optional[str]:
+    """Send one file; returns its file_id"""
+    with socket.create_connection(('127.0.0.1', port)) as sock:
+        started = time.perf_counter()
+        sock.sendall(json.dumps({'file_name': f'bench_{index}.bin', 'file_size': size,
+                                 'sender': f'bench_{index}'}).encode('utf-8'))
+        reply = json.loads(sock.recv(4096).decode('utf-8'))
+        result.upload_ttfb = time.perf_counter() - started
+        if reply.get('status') != 'ready':
+            raise RuntimeError(f"upload refused: {reply}")
+
+        remaining = size
+        while remaining:
+            n = min(remaining, CHUNK)
+            sock.sendall(PATTERN[:n])
+            remaining -= n
+        # The server closes once it has every byte
+        sock.shutdown(socket.SHUT_WR)
+        while sock.recv(4096):
+            pass
+        result.upload_seconds = time.perf_counter() - started
+        return reply['file_id']
+
+
+def download(port: int, file_id: str, size: int, index: int, result: Transfer) -> None:
+    """Fetch one file back and check its length"""
+    buffer = bytearray(CHUNK)
+    with socket.create_connection(('127.0.0.1', port)) as sock:
+        started = time.perf_counter()
+        sock.sendall(json.dumps({'file_id': file_id, 'requester': f'bench_{index}'}).encode('utf-8'))
+        header = json.loads(sock.recv(4096).decode('utf-8'))
+        if header.get('status') != 'sending':
+            raise RuntimeError(f"download refused: {header}")
+        sock.sendall(b'ready')
+
+        received = sock.recv_into(buffer)
+        result.download_ttfb = time.perf_counter() - started
+        while received < size:
+            n = sock.recv_into(buffer)
+            if not n:
+                break
+            received += n
+        result.download_seconds = time.perf_counter() - started
+        if received != size:
+            raise RuntimeError(f"download returned {received} of {size} bytes")
+
+
+def run_round(size: int, concurrency: int, timeout: float) -> Dict:
+    """One fresh server, `concurrency` clients each uploading then downloading `size` bytes"""
+    server = ServerProcess()
+    results = [Transfer() for _ in range(concurrency)]
+    file_ids: List[Optional[str]] = [None] * concurrency
+
+    def run_phase(phase):
+        threads = [threading.Thread(target=phase, args=(i,), daemon=True) for i in range(concurrency)]
+        started = time.perf_counter()
+        for t in threads:
+            t.start()
+        deadline = started + timeout
+        for t in threads:
+            t.join(max(0.0, deadline - time.perf_counter()))
+        return time.perf_counter() - started, any(t.is_alive() for t in threads)
+
+    def do_upload(i):
+        try:
+            file_ids[i] = upload(server.file_port, size, i, results[i])
+        except Exception as e:
+            results[i].error = str(e)
+
+    def do_download(i):
+        if file_ids[i] is None:
+            return
+        try:
+            download(server.file_port, file_ids[i], size, i, results[i])
+        except Exception as e:
+            results[i].error = str(e)
+
+    sampler = RssSampler(server.pid, interval=0.05).start()
+    cpu_before = cpu_seconds(server.pid)
+    upload_wall, upload_timed_out = run_phase(do_upload)
+    download_wall, download_timed_out = (0.0, False) if upload_timed_out else run_phase(do_download)
+    cpu_used = (cpu_seconds(server.pid) or 0) - (cpu_before or 0) if cpu_before is not None else None
+    peak_rss = sampler.stop()
+    server.stop()
+
+    up_ttfb, down_ttfb = Histogram(), Histogram()
+    for r in results:
+        if r.upload_ttfb is not None:
+            up_ttfb.observe(r.upload_ttfb)
+        if r.download_ttfb is not None:
+            down_ttfb.observe(r.download_ttfb)
+    uploaded = sum(size for r in results if r.upload_seconds is not None)
+    downloaded = sum(size for r in results if r.download_seconds is not None and r.error is None)
+    moved_gb = (uploaded + downloaded) / UNITS['G']
+    timed_out = upload_timed_out or download_timed_out
+
+    return {
+        'size': size, 'concurrency': concurrency,
+        'upload_mb_s': round(uploaded / UNITS['M'] / upload_wall, 2) if uploaded else 0.0,
+        'download_mb_s': round(downloaded / UNITS['M'] / download_wall, 2) if downloaded else 0.0,
+        'upload_ttfb_ms': [round(v * 1000, 3) for v in up_ttfb.percentiles((0.5, 0.99))],
+        'download_ttfb_ms': [round(v * 1000, 3) for v in down_ttfb.percentiles((0.5, 0.99))],
+        # Zero CPU just means the round was shorter than one clock tick
+        'cpu_s_per_gb': round(cpu_used / moved_gb, 2) if cpu_used and moved_gb else None,
+        'peak_rss_mb': round(peak_rss / UNITS['M'], 1) if peak_rss else None,
+        'failed': concurrency if timed_out else sum(1 for r in results if r.error is not None),
+        'timed_out': timed_out,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', nargs='+', default=['1K', '64K', '1M', '8M', '64M'],
+                        help='file sizes, e.g. 1K 16M 2G')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16, 64])
+    parser.add_argument('--timeout', type=float, default=120, help='seconds per upload or download phase')
+    parser.add_argument('--max-round-bytes', default='2G',
+                        help='skip rounds where size x concurrency exceeds this (server holds every file in memory)')
+    parser.add_argument('--json', action='store_true', help='print one JSON result line')
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    sizes = sorted(parse_size(s) for s in args.sizes)
+    max_round = parse_size(args.max_round_bytes)
+    rounds = []
+    if not args.json:
+        print(f"file_transfer @ {git_revision()}")
+        print(f"{'size':>6} {'conc':>5} {'up MB/s':>9} {'down MB/s':>10} {'up ttfb':>9} {'dl ttfb p50':>12} "
+              f"{'dl ttfb p99':>12} {'CPU s/GB':>9} {'peak RSS':>9} {'failed':>7}")
+
+    for concurrency in args.concurrency:
+        for size in sizes:
+            if size * concurrency > max_round:
+                rounds.append({'size': size, 'concurrency': concurrency, 'skipped': 'max-round-bytes'})
+                continue
+            if rounds and rounds[-1].get('concurrency') == concurrency and (
+                    rounds[-1].get('timed_out') or rounds[-1].get('skipped') == 'timeout'):
+                # Larger files at the same concurrency would only time out too
+                rounds.append({'size': size, 'concurrency': concurrency, 'skipped': 'timeout'})
+                continue
+            row = run_round(size, concurrency, args.timeout)
+            rounds.append(row)
+            if not args.json:
+                print(f"{format_size(size):>6} {concurrency:>5} {row['upload_mb_s']:>9.1f} "
+                      f"{row['download_mb_s']:>10.1f} {row['upload_ttfb_ms'][0]:>7.2f}ms "
+                      f"{row['download_ttfb_ms'][0]:>10.2f}ms {row['download_ttfb_ms'][1]:>10.2f}ms "
+                      f"{row['cpu_s_per_gb'] if row['cpu_s_per_gb'] is not None else '-':>9} "
+                      f"{row['peak_rss_mb'] if row['peak_rss_mb'] is not None else '-':>9} "
+                      f"{row['failed']:>7}{'  (timed out)' if row['timed_out'] else ''}", flush=True)
+
+    if args.json:
+        emit_json({'benchmark': 'file_transfer', 'commit': git_revision(),
+                   'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'params': {'sizes': sizes, 'concurrency': args.concurrency, 'timeout': args.timeout},
+                   'rounds': rounds})
+    else:
+        skipped = [r for r in rounds if 'skipped' in r]
+        if skipped:
+            print(f"skipped {len(skipped)} rounds: " + ', '.join(
+                f"{format_size(r['size'])}x{r['concurrency']} ({r['skipped']})" for r in skipped))
+
+
+if __name__ == '__main__':
+    main()
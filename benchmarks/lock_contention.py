@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+lock_contention.py - Relay throughput vs. number of concurrent senders
+Starts an in-process CollaborationServer on loopback, connects a fixed set
+of listeners, then has 1..N senders fire screen_share messages (a pure
+fan-out path with no storage writes) and reports deliveries per second.
+
+Usage: python -m benchmarks.lock_contention [--listeners 20] [--messages 500]
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+from typing import List, Tuple
+
+
+def start_server(data_dir: str):
+    """Start a CollaborationServer on ephemeral ports inside a scratch data dir"""
+    # storage is a module-level singleton that writes into the cwd on import
+    os.chdir(data_dir)
+    os.environ.setdefault('SHADOW_NEXUS_LOG', 'warning')
+    from backend.server import CollaborationServer
+
+    server = CollaborationServer(host='127.0.0.1', port=0, file_port=0)
+    threading.Thread(target=server.start, daemon=True).start()
+    for _ in range(50):
+        if server.server_socket.getsockname()[1]:
+            break
+        time.sleep(0.1)
+    return server, server.server_socket.getsockname()[1]
+
+
+def connect(port: int, username: str) -> socket.socket:
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.sendall((json.dumps({'username': username}) + '\n').encode('utf-8'))
+    return sock
+
+
+class Listener:
+    """Counts newline-delimited messages of one type"""
+
+    def __init__(self, port: int, username: str, msg_type: str):
+        self.sock = connect(port, username)
+        self.marker = f'"type": "{msg_type}"'.encode('utf-8')
+        self.count = 0
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        buf = b''
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except OSError:
+                return
+            if not data:
+                return
+            buf += data
+            *lines, buf = buf.split(b'\n')
+            self.count += sum(1 for line in lines if self.marker in line)
+
+
+def run_round(port: int, listeners: List[Listener], senders: int, messages: int) -> Tuple[float, int]:
+    """Return (elapsed seconds, deliveries) for one sender count"""
+    sender_socks = [connect(port, f'bench_sender_{senders}_{i}') for i in range(senders)]
+    time.sleep(1.0)  # Let welcome traffic and presence deltas settle
+    baseline = sum(l.count for l in listeners)
+    payload = (json.dumps({'type': 'screen_share', 'sender': 'bench', 'content': 'x' * 64}) + '\n').encode('utf-8')
+    expected = senders * messages * len(listeners)
+
+    def fire(sock):
+        for _ in range(messages):
+            sock.sendall(payload)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=fire, args=(s,)) for s in sender_socks]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    deadline = time.time() + 60
+    while sum(l.count for l in listeners) - baseline < expected and time.time() < deadline:
+        time.sleep(0.005)
+    elapsed = time.perf_counter() - start
+
+    for sock in sender_socks:
+        sock.close()
+    return elapsed, sum(l.count for l in listeners) - baseline
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--listeners', type=int, default=20)
+    parser.add_argument('--messages', type=int, default=500, help='messages per sender')
+    parser.add_argument('--senders', type=int, nargs='+', default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    # The server is chatty on stdout (including from its own threads); keep
+    # it out of the results for the whole run
+    out = sys.stdout
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix='shadow_nexus_bench_') as data_dir, \
+            contextlib.redirect_stdout(io.StringIO()):
+        server, port = start_server(data_dir)
+        try:
+            listeners = [Listener(port, f'bench_listener_{i}', 'screen_share') for i in range(args.listeners)]
+
+            print(f"{'senders':>8} {'elapsed s':>10} {'deliveries':>11} {'deliv/s':>10}", file=out)
+            for senders in args.senders:
+                elapsed, delivered = run_round(port, listeners, senders, args.messages)
+                print(f"{senders:>8} {elapsed:>10.3f} {delivered:>11} {delivered / elapsed:>10.0f}", file=out)
+        finally:
+            server.running = False
+            os.chdir(cwd)  # Out of the scratch dir before it is removed
+
+
+if __name__ == '__main__':
+    main()
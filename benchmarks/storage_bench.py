@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""
+storage_bench.py - Storage engine microbenchmarks on a synthetic history corpus
+Generates a reproducible corpus (users, groups, global/private/group messages,
+a fraction of them voice notes with base64 audio), persists it once, then times
+load_all, add_*_message appends, get_*_chat slices, delete_* and full saves,
+and reports on-disk sizes and peak Python memory during load and save.
+
+--storage points at any class with the Storage interface, so alternative
+backends and formats can be measured on exactly the same corpus.
+
+Usage: python -m benchmarks.storage_bench [--messages 20000] [--users 200] [--groups 20]
+       python -m benchmarks.storage_bench --storage mypackage.fast_storage:Storage --json
+"""
+
+import argparse
+import base64
+import contextlib
+import importlib
+import io
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Tuple
+
+from backend.metrics import Histogram
+from benchmarks.common import emit_json, git_revision
+
+SAVE_METHODS = ('save_global_chat', 'save_private_chats', 'save_group_chats',
+                'save_groups', 'save_files', 'save_users')
+WORDS = ('ok sure meeting later build deploy lunch review ticket standup merge fix '
+         'ship tomorrow thanks done looks good see you call now').split()
+
+
+class Corpus:
+    """Deterministic synthetic chat history"""
+
+    def __init__(self, users: int, groups: int, messages: int, audio_fraction: float,
+                 audio_kb: int, global_fraction: float, group_fraction: float, seed: int):
+        rng = random.Random(seed)
+        # No underscores: private chat keys are stored as "user1_user2"
+        self.users = [f'user{i:04d}' for i in range(users)]
+        self.groups: Dict[str, Dict] = {}
+        for g in range(groups):
+            group_id = f'group_{1700000000000 + g}'
+            members = rng.sample(self.users, min(len(self.users), rng.randint(3, 30)))
+            self.groups[group_id] = {'id': group_id, 'name': f'Team {g}', 'members': members,
+                                     'created_by': members[0], 'admin': members[0],
+                                     'created_at': '2026-01-01 09:00 AM', 'version': 1}
+        # One shared audio blob keeps generation fast; every message still stores its own copy
+        self.audio = base64.b64encode(rng.randbytes(audio_kb * 1024)).decode('ascii')
+
+        self.global_chat: List[Dict] = []
+        self.private_chats: Dict[Tuple[str, str], List[Dict]] = {}
+        self.group_chats: Dict[str, List[Dict]] = {}
+        group_ids = list(self.groups)
+        for n in range(messages):
+            sender = rng.choice(self.users)
+            message = {'type': 'chat', 'sender': sender, 'id': f'm{n}',
+                       'timestamp': f'2026-01-01 {n // 3600 % 24:02d}:{n // 60 % 60:02d}:{n % 60:02d}.{n}'}
+            if rng.random() < audio_fraction:
+                message.update({'has_audio': True, 'duration': rng.randint(1, 30), 'audio_data': self.audio})
+            else:
+                message['content'] = ' '.join(rng.choices(WORDS, k=rng.randint(2, 25)))
+
+            roll = rng.random()
+            if roll < global_fraction:
+                self.global_chat.append(message)
+            elif roll < global_fraction + group_fraction and group_ids:
+                group_id = rng.choice(group_ids)
+                message.update({'type': 'group_message', 'group_id': group_id})
+                self.group_chats.setdefault(group_id, []).append(message)
+            else:
+                receiver = rng.choice(self.users)
+                message.update({'type': 'private', 'receiver': receiver})
+                self.private_chats.setdefault(tuple(sorted((sender, receiver))), []).append(message)
+
+        self.file_metadata = {f'{1700000000000 + i}_doc{i}.pdf': {'file_name': f'doc{i}.pdf', 'size': 1000 * i,
+                                                                  'sender': rng.choice(self.users)}
+                              for i in range(max(1, messages // 200))}
+        self.user_records = {u: {'ip': '10.0.0.1', 'last_seen': '2026-01-01T09:00:00'} for u in self.users}
+
+    def install(self, storage) -> None:
+        """Put the corpus into an empty storage and persist it once"""
+        storage.global_chat = self.global_chat
+        storage.private_chats = self.private_chats
+        storage.group_chats = self.group_chats
+        storage.groups = self.groups
+        storage.file_metadata = self.file_metadata
+        storage.users = self.user_records
+        for method in SAVE_METHODS:
+            getattr(storage, method)()
+
+
+def load_storage_class(spec: str):
+    module_name, _, class_name = spec.partition(':')
+    return getattr(importlib.import_module(module_name), class_name or 'Storage')
+
+
+def timed(histogram: Histogram, fn: Callable, *args):
+    started = time.perf_counter()
+    result = fn(*args)
+    histogram.observe(time.perf_counter() - started)
+    return result
+
+
+def peak_memory(fn: Callable) -> int:
+    """Peak bytes allocated during one call; tracemalloc is slow, so never mix this with timed runs"""
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run(args) -> Dict:
+    storage_class = load_storage_class(args.storage)
+    corpus = Corpus(args.users, args.groups, args.messages, args.audio_fraction, args.audio_kb,
+                    args.global_fraction, args.group_fraction, args.seed)
+    data_dir = tempfile.mkdtemp(prefix='shadow_nexus_storage_')
+    rng = random.Random(args.seed + 1)
+    ops: Dict[str, Histogram] = {}
+
+    def op(name: str) -> Histogram:
+        return ops.setdefault(name, Histogram())
+
+    try:
+        corpus.install(storage_class(data_dir))
+        sizes = {name: os.path.getsize(os.path.join(data_dir, name))
+                 for name in sorted(os.listdir(data_dir))}
+
+        # Cold load: a fresh instance reads everything back
+        for _ in range(args.load_runs):
+            timed(op('load_all'), storage_class, data_dir)
+        load_peak = peak_memory(lambda: storage_class(data_dir))
+
+        storage = storage_class(data_dir)
+        users, group_ids = corpus.users, list(corpus.groups)
+        pairs = list(storage.private_chats) or [(users[0], users[-1])]
+
+        for method in SAVE_METHODS:
+            for _ in range(args.load_runs):
+                timed(op(method), getattr(storage, method))
+
+        def save_all():
+            for method in SAVE_METHODS:
+                getattr(storage, method)()
+        save_peak = peak_memory(save_all)
+
+        # Slices are cheap; take many more samples than the write paths
+        for _ in range(args.samples * 10):
+            timed(op('get_global_chat(300)'), storage.get_global_chat, 300)
+            timed(op('get_private_chat(100)'), storage.get_private_chat, *rng.choice(pairs), 100)
+            if group_ids:
+                timed(op('get_group_chat(100)'), storage.get_group_chat, rng.choice(group_ids), 100)
+
+        n = args.messages
+        for i in range(args.samples):
+            sender, receiver = rng.sample(users, 2)
+            message = {'type': 'chat', 'sender': sender, 'content': 'benchmark append', 'id': f'a{i}',
+                       'timestamp': f'2026-01-02 00:00:00.{i}'}
+            timed(op('add_global_message'), storage.add_global_message, dict(message))
+            timed(op('add_private_message'), storage.add_private_message, sender, receiver, dict(message))
+            if group_ids:
+                timed(op('add_group_message'), storage.add_group_message, rng.choice(group_ids), dict(message))
+
+        for _ in range(args.samples):
+            victim = f'm{rng.randrange(n)}'
+            timed(op('delete_global_message'), storage.delete_global_message, victim)
+            pair = rng.choice(pairs)
+            chat = storage.private_chats.get(pair) or [{}]
+            timed(op('delete_private_message'), storage.delete_private_message, *pair,
+                  rng.choice(chat).get('id', victim))
+            if group_ids:
+                group_id = rng.choice(group_ids)
+                chat = storage.group_chats.get(group_id) or [{}]
+                timed(op('delete_group_message'), storage.delete_group_message, group_id,
+                      rng.choice(chat).get('id', victim))
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    audio_messages = sum(1 for chat in ([corpus.global_chat] + list(corpus.private_chats.values())
+                                        + list(corpus.group_chats.values()))
+                         for m in chat if 'audio_data' in m)
+    return {
+        'corpus': {'users': args.users, 'groups': args.groups, 'messages': args.messages,
+                   'audio_messages': audio_messages, 'private_chats': len(corpus.private_chats)},
+        'ops': {name: {'n': h.count, 'mean_ms': round(h.sum / h.count * 1000, 4),
+                       'p50_ms': round(h.percentiles((0.5,))[0] * 1000, 4),
+                       'p99_ms': round(h.percentiles((0.99,))[0] * 1000, 4)}
+                for name, h in ops.items()},
+        'file_bytes': sizes,
+        'load_peak_mb': round(load_peak / 2**20, 2),
+        'save_peak_mb': round(save_peak / 2**20, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--groups', type=int, default=20)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--audio-fraction', type=float, default=0.02, help='share of messages that are voice notes')
+    parser.add_argument('--audio-kb', type=int, default=32, help='raw size of each voice note before base64')
+    parser.add_argument('--global-fraction', type=float, default=0.2)
+    parser.add_argument('--group-fraction', type=float, default=0.3)
+    parser.add_argument('--samples', type=int, default=50, help='timed calls per write operation')
+    parser.add_argument('--load-runs', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--storage', default='backend.storage:Storage', help='module:Class to benchmark')
+    parser.add_argument('--json', action='store_true', help='print one JSON result line')
+    args = parser.parse_args()
+
+    out = sys.stdout
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix='shadow_nexus_bench_') as scratch:
+        # backend.storage creates its module-level instance in the cwd on import
+        os.chdir(scratch)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):  # Storage reports every load/delete on stdout
+                result = run(args)
+        finally:
+            os.chdir(cwd)
+
+    if args.json:
+        emit_json({'benchmark': 'storage', 'commit': git_revision(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'params': {k: v for k, v in vars(args).items() if k != 'json'}, **result})
+        return
+
+    corpus = result['corpus']
+    print(f"storage_bench @ {git_revision()} ({args.storage}): {corpus['messages']} messages "
+          f"({corpus['audio_messages']} voice notes), {corpus['users']} users, "
+          f"{corpus['private_chats']} private chats, {corpus['groups']} groups", file=out)
+    print(f"{'operation':<26} {'n':>6} {'mean ms':>10} {'p50 ms':>10} {'p99 ms':>10}", file=out)
+    for name, row in result['ops'].items():
+        print(f"{name:<26} {row['n']:>6} {row['mean_ms']:>10.3f} {row['p50_ms']:>10.3f} {row['p99_ms']:>10.3f}",
+              file=out)
+    total = sum(result['file_bytes'].values())
+    print("on disk: " + ', '.join(f"{name} {size / 2**20:.2f} MB" for name, size in result['file_bytes'].items())
+          + f" (total {total / 2**20:.2f} MB)", file=out)
+    print(f"peak Python memory: load_all {result['load_peak_mb']} MB, full save {result['save_peak_mb']} MB",
+          file=out)
+
+
+if __name__ == '__main__':
+    main()
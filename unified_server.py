@@ -4,6 +4,7 @@ unified_server.py - Combined Chat + Video Server
 Single executable that runs both servers with automatic IP detection
 """
 
+import argparse
 import subprocess
 import sys
 import os
@@ -19,10 +20,12 @@ import multiprocessing
 warnings.filterwarnings('ignore')
 
 class UnifiedShadowNexusServer:
-    def __init__(self):
+    def __init__(self, workers=1):
         self.chat_process = None
         self.video_process = None
         self.running = True
+        # More than one worker shards the chat server across processes
+        self.workers = max(1, workers)
         self.server_ip = self.detect_lan_ip()
         
         # Setup .env file
@@ -84,9 +87,15 @@ AUDIO_PORT=5001
         print("🚀 Starting Chat Server...")
         
         try:
+            if self.workers > 1:
+                # Coordinator owns storage and the file port; workers share the chat port
+                from backend.sharding import ShardCoordinator
+                ShardCoordinator(self.workers, metrics_port=default_admin_port()).run()
+                return
+            
             # Import and run chat server directly
             from backend import server
-            chat_server = server.CollaborationServer()
+            chat_server = server.CollaborationServer(metrics_port=default_admin_port())
             chat_server.start()
         except Exception as e:
             print(f"❌ Chat server error: {e}")
@@ -109,22 +118,37 @@ AUDIO_PORT=5001
             print("✓ Chat server will continue running without video functionality")
             # Don't crash the whole server if video fails
     
+    def start_audio_relay(self):
+        """Start the audio relay (5557) on background threads"""
+        try:
+            from backend.audio_relay import AudioRelay
+            AudioRelay().start()
+        except Exception as e:
+            print(f"❌ Audio relay error: {e}")
+            print("✓ Chat server will continue running without the audio relay")
+    
     def start(self):
         """Start both servers"""
         print("=" * 60)
         print("🚀 Shadow Nexus Unified Server")
         print("=" * 60)
         print(f"🌐 Detected Server IP: {self.server_ip}")
-        print(f"📡 Chat Server: {self.server_ip}:5555")
+        print(f"📡 Chat Server: {self.server_ip}:5555 ({self.workers} worker{'s' if self.workers > 1 else ''})")
         print(f"📁 File Server: {self.server_ip}:5556") 
         print(f"📹 Video Server: {self.server_ip}:5000")
         print(f"🔊 Audio Server: {self.server_ip}:5001")
+        print(f"🎙️ Audio Relay: {self.server_ip}:5557")
+        if default_admin_port() is not None:
+            print(f"📊 Metrics: http://127.0.0.1:{default_admin_port()}/metrics (chat), "
+                  f"https://{self.server_ip}:5000/metrics (media)")
         print("=" * 60)
         
         # Start video server in background thread
         video_thread = threading.Thread(target=self.start_video_server, daemon=True)
         video_thread.start()
         
+        self.start_audio_relay()
+        
         # Wait a moment for video server to initialize
         time.sleep(2)
         
@@ -145,10 +169,33 @@ def signal_handler(signum, frame):
     print("\n🛑 Received shutdown signal...")
     sys.exit(0)
 
+def default_admin_port():
+    """Chat server metrics port, from SHADOW_NEXUS_METRICS_PORT (default 9555)"""
+    from backend.metrics import default_admin_port
+    return default_admin_port()
+
+def default_workers():
+    """CHAT_WORKERS from the environment: a number, or 'auto' for one per core"""
+    value = os.environ.get('CHAT_WORKERS', '1')
+    if value == 'auto':
+        return os.cpu_count() or 1
+    try:
+        return int(value)
+    except ValueError:
+        return 1
+
 if __name__ == "__main__":
+    # Chat workers are child processes; needed for the frozen Windows build
+    multiprocessing.freeze_support()
+    
+    parser = argparse.ArgumentParser(description="Shadow Nexus unified server")
+    parser.add_argument('--workers', type=int, default=default_workers(),
+                        help="chat server processes (default: CHAT_WORKERS or 1)")
+    args = parser.parse_args()
+    
     # Register signal handler
     signal.signal(signal.SIGINT, signal_handler)
     
     # Start unified server
-    server = UnifiedShadowNexusServer()
+    server = UnifiedShadowNexusServer(workers=args.workers)
     server.start()
\ No newline at end of file
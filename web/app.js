@@ -1738,6 +1738,53 @@ function handleMessage(message) {
             addFileToList(message);
         }
     }
+    else if (msgType === 'group_created' || msgType === 'group_member_added') {
+        // Server only sends group changes to affected members, so apply them locally
+        const groupInfo = msgType === 'group_created' ? {
+            id: message.group_id,
+            name: message.group_name,
+            members: message.members || [],
+            created_by: message.created_by,
+            admin: message.admin,
+            version: message.version
+        } : message.group;
+
+        if (groupInfo) {
+            persistentGroups[groupInfo.id] = groupInfo;
+            saveGroupsToLocalStorage();
+        }
+        if (currentGroupContext && groupInfo && currentGroupContext.id === groupInfo.id) {
+            currentGroupContext.members = groupInfo.members;
+        }
+        if (msgType === 'group_member_added' && message.username === username) {
+            showNotification(`You were added to "${message.group_name}"`, 'info');
+        }
+        updateGroupsList();
+    }
+    else if (msgType === 'group_member_removed') {
+        console.log(`👋 ${message.username} removed from group ${message.group_id}`);
+        if (message.username === username) {
+            delete persistentGroups[message.group_id];
+            saveGroupsToLocalStorage();
+
+            const groupItem = document.querySelector(`.chat-item[data-group-id="${message.group_id}"]`);
+            if (groupItem) {
+                groupItem.remove();
+            }
+            if (currentChatType === 'group' && currentChatTarget === message.group_id) {
+                globalNetworkItem.click();
+            }
+        } else if (persistentGroups[message.group_id]) {
+            const group = persistentGroups[message.group_id];
+            group.members = (group.members || []).filter(m => m !== message.username);
+            group.version = message.version;
+            saveGroupsToLocalStorage();
+            if (currentGroupContext && currentGroupContext.id === message.group_id) {
+                currentGroupContext.members = group.members;
+            }
+        }
+        updateGroupsList();
+    }
     else if (msgType === 'group_name_changed') {
         console.log(`📝 Group name changed: ${message.group_id}`);
         if (persistentGroups[message.group_id]) {
@@ -1907,7 +1954,10 @@ function handleMessage(message) {
         updateUsersList(message.users);
     }
     else if (msgType === 'group_list') {
-        updateGroupsList(message.groups);
+        // "unchanged" answers a request that sent our version: the list we have is current
+        if (!message.unchanged) {
+            updateGroupsList(message.groups);
+        }
     }
     else if (msgType === 'user_chat_deleted') {
         const targetUser = message.target_user;
@@ -4758,7 +4808,7 @@ function showGroupModal(users) {
 
             showNotification(`Group "${groupName}" created`, 'success');
 
-            // Server will broadcast group_list with the new group
+            // Server will send group_created to every member,
             // which will automatically update the UI and save to localStorage
             console.log('⏳ Waiting for server to broadcast group...');
         } catch (error) {